@@ -1,3 +1,5 @@
 __version__ = '0.3'
 VERSION = __version__
 VERSION_STATUS = 'pre-alpha'
+
+default_app_config = 'django_rt.apps.DjangoRtConfig'
@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+class DjangoRtConfig(AppConfig):
+    name = 'django_rt'
+    verbose_name = 'Django-RT'
+
+    def ready(self):
+        # Connect the request signal receivers used by deferred publishing
+        import django_rt.publish
@@ -0,0 +1,8 @@
+"""Benchmarks for Django-RT.
+
+load: end-to-end courier load test, run with "python -m django_rt.bench.load". Boots a courier against a stub Django
+    resource endpoint (served by this process) and a loopback Redis stand-in, opens concurrent SSE clients, publishes
+    events and reports connection, handshake, delivery latency, throughput and memory figures as JSON.
+micro: serialization and framing micro-benchmarks, run with "python -m django_rt.bench.micro". Reports ops/sec and
+    allocations per operation across payload sizes as JSON, and compares two result files.
+"""
@@ -0,0 +1,453 @@
+"""End-to-end courier load test.
+
+Boots a courier (asyncio or gevent) in a child process, against a stub Django project (django_rt.bench) served by this
+process and a loopback Redis stand-in (or a real Redis server, with --redis). Opens concurrent SSE clients, publishes
+events at a fixed rate with publish(), and writes the results to stdout (or --output) as JSON:
+
+    python -m django_rt.bench.load gevent --clients 1000 --groups 10 --rate 100 --duration 10
+
+Clients are split evenly between --groups channels, so each event is delivered to clients/groups clients. Delivery
+latency is measured from the timestamp stamped by publish(), and memory per connection from the courier's resident
+set size (on Linux) before and after the clients connect. The clients, publisher, stub Django server and Redis
+stand-in share this process, so for large runs its own CPU use should be watched; results are only comparable
+between runs on the same machine.
+
+With --tracemalloc, the courier traces its memory allocations (RT_COURIER_TRACEMALLOC), and the Python memory allocated
+per idle connection is reported from its /metrics endpoint alongside the RSS figure. Both are also expressed as the
+number of idle connections which fit in 1 GiB, for sizing a node's memory budget.
+
+With --broker local, events are published with the local broker, over Unix domain sockets in a temporary directory,
+instead of through Redis.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import socketserver
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+import logging
+logger = logging.getLogger(__name__)
+
+from django_rt.utils import coroutine
+
+PUBLISHED_FIELD = b'"published":'
+
+def get_free_port():
+    sock = socket.socket()
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+def get_rss(pid):
+    """Return the resident set size of a process in bytes, or None if it is not available (Linux only)."""
+    try:
+        with open('/proc/%d/status' % (pid,)) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+def get_courier_metric(port, name):
+    """Return the value of an unlabelled metric read from a courier's /metrics endpoint, or None if it is absent."""
+    with urllib.request.urlopen('http://127.0.0.1:%d/metrics' % (port,), timeout=10) as resp:
+        for line in resp.read().decode('utf-8').splitlines():
+            sample, _, value = line.partition(' ')
+            if sample == name:
+                return float(value)
+    return None
+
+def connections_per_gib(bytes_per_connection):
+    return (1 << 30) // bytes_per_connection if bytes_per_connection else None
+
+def percentiles(values, scale=1.0):
+    """Return the p50, p90, p99 and maximum of a list of values (multiplied by scale), or None if it is empty."""
+    if not values:
+        return None
+    values = sorted(values)
+
+    def rank(p):
+        return values[min(len(values) - 1, int(len(values) * p))] * scale
+
+    return {
+        'p50': rank(0.5),
+        'p90': rank(0.9),
+        'p99': rank(0.99),
+        'max': values[-1] * scale,
+    }
+
+def parse_published(line):
+    """Return the publish timestamp of an SSE data line carrying a ResourceEvent, or None if it is not stamped.
+    Scans for the field instead of parsing the JSON, to keep the load test's own CPU use down."""
+    i = line.find(PUBLISHED_FIELD)
+    if i < 0:
+        return None
+    value = line[i + len(PUBLISHED_FIELD):].lstrip()
+    end = 0
+    while end < len(value) and value[end:end + 1] not in b',}':
+        end += 1
+    try:
+        return float(value[:end])
+    except ValueError:
+        return None
+
+class _ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+class StubDjango:
+    """Serves the stub Django project on a loopback port from background threads."""
+
+    def __init__(self):
+        from django.core.wsgi import get_wsgi_application
+
+        self._server = make_server('127.0.0.1', 0, get_wsgi_application(),
+            server_class=_ThreadingWSGIServer,
+            handler_class=_QuietHandler
+        )
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % (self._server.server_address[1],)
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name='StubDjango', daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+class SseClient:
+    """A load test SSE client, recording its handshake time and the delivery latency of each event."""
+    __slots__ = ('path', 'handshake', 'status', 'received', 'latencies')
+
+    def __init__(self, path):
+        self.path = path
+        self.handshake = None
+        self.status = None
+        self.received = 0
+        self.latencies = []
+
+    @coroutine
+    def run(self, host, port, connect_limit, stopping):
+        """Connect and read events until stopping is set. connect_limit (a semaphore) bounds concurrent handshakes."""
+        writer = None
+        yield from connect_limit.acquire()
+        try:
+            start = time.monotonic()
+            reader, writer = yield from asyncio.open_connection(host, port)
+
+            # HTTP/1.0 keeps both couriers from using chunked encoding, so the stream can be read line by line
+            writer.write(('GET %s HTTP/1.0\r\nHost: %s:%d\r\nAccept: text/event-stream\r\n\r\n' % (
+                self.path, host, port
+            )).encode('ascii'))
+
+            status_line = yield from reader.readline()
+            self.status = int(status_line.split()[1])
+            while (yield from reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            self.handshake = time.monotonic() - start
+        except (OSError, IndexError, ValueError) as e:
+            logger.debug('Client %s failed to connect: %s' % (self.path, e))
+            self.status = self.status or 0
+            if writer:
+                writer.close()
+            return
+        finally:
+            connect_limit.release()
+
+        try:
+            if self.status != 200:
+                return
+            while not stopping.is_set():
+                line = yield from reader.readline()
+                if not line:
+                    break
+                if line.startswith(b'data:'):
+                    self.received += 1
+                    published = parse_published(line)
+                    if published is not None:
+                        self.latencies.append(time.time() - published)
+        except OSError:
+            pass
+        finally:
+            writer.close()
+
+class Publisher(threading.Thread):
+    """Publishes events to the groups' channels in turn, at a fixed total rate."""
+
+    def __init__(self, groups, rate, duration, payload_size):
+        super().__init__(name='Publisher', daemon=True)
+        self.groups = groups
+        self.rate = rate
+        self.duration = duration
+        self.data = {'payload': 'x' * payload_size}
+        self.published = 0
+        self.errors = 0
+
+    def run(self):
+        from django_rt.publish import publish
+
+        start = time.monotonic()
+        total = int(self.rate * self.duration)
+        for i in range(total):
+            delay = start + i / self.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                publish('bench/%d' % (i % self.groups,), data=self.data)
+                self.published += 1
+            except Exception as e:
+                logger.warning('Error publishing event: %s' % (e,))
+                self.errors += 1
+
+class LoadTest:
+    # Time allowed for the courier to start listening, in seconds
+    STARTUP_TIMEOUT = 15.0
+
+    # Time allowed for events to drain after the last is published, in seconds
+    DRAIN_TIME = 2.0
+
+    # Time allowed for connections to settle before measuring memory, in seconds
+    SETTLE_TIME = 1.0
+
+    def __init__(self, args):
+        self.args = args
+        self._redis = None
+        self._socket_dir = None
+        self._django = None
+        self._courier = None
+
+    def start_services(self):
+        args = self.args
+
+        # Redis server
+        if args.redis:
+            redis_host, _, redis_port = args.redis.partition(':')
+            redis_port = int(redis_port or 6379)
+        else:
+            from django_rt.bench.redis_stub import LoopbackRedis
+            self._redis = LoopbackRedis()
+            self._redis.start()
+            redis_host, redis_port = self._redis.address
+
+        # Stub Django project, in this process
+        os.environ['DJANGO_SETTINGS_MODULE'] = 'django_rt.bench.settings'
+        os.environ['DJANGO_RT_BENCH_REDIS_HOST'] = redis_host
+        os.environ['DJANGO_RT_BENCH_REDIS_PORT'] = str(redis_port)
+        os.environ['DJANGO_RT_BENCH_PUBLISH_FORMAT'] = args.format
+        os.environ['DJANGO_RT_BENCH_BROKER'] = args.broker
+        os.environ['DJANGO_RT_BENCH_TRACEMALLOC'] = str(args.tracemalloc)
+        if args.broker == 'local':
+            self._socket_dir = tempfile.mkdtemp(prefix='django_rt_bench-')
+            os.environ['DJANGO_RT_BENCH_SOCKET_DIR'] = self._socket_dir
+
+        import django
+        django.setup()
+
+        self._django = StubDjango()
+        self._django.start()
+        os.environ['DJANGO_RT_BENCH_DJANGO_URL'] = self._django.url
+
+        # Courier, in a child process
+        self.courier_port = args.port or get_free_port()
+        cmd = [sys.executable, '-m', 'django_rt.runcourier', args.server_type,
+            '127.0.0.1:%d' % (self.courier_port,),
+            '--django-url', self._django.url,
+        ]
+        output = None if args.verbose else subprocess.DEVNULL
+        self._courier = subprocess.Popen(cmd, env=os.environ.copy(), stdout=output, stderr=output)
+        self._wait_for_courier()
+
+    def _wait_for_courier(self):
+        deadline = time.monotonic() + self.STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self._courier.poll() is not None:
+                raise RuntimeError('Courier exited with code %d during startup' % (self._courier.returncode,))
+            try:
+                socket.create_connection(('127.0.0.1', self.courier_port), timeout=1.0).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError('Courier did not start listening within %d seconds' % (self.STARTUP_TIMEOUT,))
+
+    def stop_services(self):
+        if self._courier and self._courier.poll() is None:
+            self._courier.terminate()
+            try:
+                self._courier.wait(10)
+            except subprocess.TimeoutExpired:
+                self._courier.kill()
+        if self._django:
+            self._django.stop()
+        if self._redis:
+            self._redis.stop()
+        if self._socket_dir:
+            shutil.rmtree(self._socket_dir, ignore_errors=True)
+
+    @coroutine
+    def _run_clients(self, clients, results):
+        args = self.args
+        connect_limit = asyncio.Semaphore(args.connect_concurrency)
+        stopping = asyncio.Event()
+
+        # Connect phase
+        start = time.monotonic()
+        tasks = [
+            asyncio.ensure_future(client.run('127.0.0.1', self.courier_port, connect_limit, stopping))
+            for client in clients
+        ]
+        while any(client.status is None for client in clients):
+            yield from asyncio.sleep(0.05)
+        connect_time = time.monotonic() - start
+        connected = sum(1 for client in clients if client.status == 200)
+        results['connect_time'] = connect_time
+        results['connected'] = connected
+        results['connect_errors'] = len(clients) - connected
+        results['connect_per_sec'] = connected / connect_time if connect_time else None
+        results['handshake_ms'] = percentiles([c.handshake for c in clients if c.handshake is not None], 1000)
+
+        # Idle memory
+        yield from asyncio.sleep(self.SETTLE_TIME)
+        rss = get_rss(self._courier.pid)
+        results['courier_rss_bytes']['connected'] = rss
+        if rss is not None and results['courier_rss_bytes']['idle'] is not None and connected:
+            results['rss_per_connection_bytes'] = (rss - results['courier_rss_bytes']['idle']) // connected
+        if args.tracemalloc and connected:
+            traced = yield from asyncio.get_event_loop().run_in_executor(None, get_courier_metric,
+                self.courier_port, 'rt_courier_traced_memory_per_connection_bytes'
+            )
+            results['traced_per_connection_bytes'] = int(traced) if traced is not None else None
+        results['connections_per_gib'] = {
+            'rss': connections_per_gib(results['rss_per_connection_bytes']),
+            'traced': connections_per_gib(results.get('traced_per_connection_bytes')),
+        }
+
+        # Publish phase
+        publisher = Publisher(args.groups, args.rate, args.duration, args.payload)
+        start = time.monotonic()
+        publisher.start()
+        while publisher.is_alive():
+            yield from asyncio.sleep(0.1)
+        yield from asyncio.sleep(self.DRAIN_TIME)
+        publish_time = time.monotonic() - start
+
+        stopping.set()
+        for task in tasks:
+            task.cancel()
+        yield from asyncio.gather(*tasks, return_exceptions=True)
+
+        # Delivery results
+        per_group = {}
+        for i, client in enumerate(clients):
+            if client.status == 200:
+                per_group[i % args.groups] = per_group.get(i % args.groups, 0) + 1
+        expected = sum(
+            count * len(range(group, publisher.published, args.groups))
+            for group, count in per_group.items()
+        )
+        delivered = sum(client.received for client in clients)
+        latencies = [latency for client in clients for latency in client.latencies]
+
+        results['published'] = publisher.published
+        results['publish_errors'] = publisher.errors
+        results['delivered'] = delivered
+        results['delivery_ratio'] = delivered / expected if expected else None
+        results['events_per_sec'] = delivered / publish_time if publish_time else None
+        results['latency_ms'] = percentiles(latencies, 1000)
+
+    def run(self):
+        args = self.args
+        results = {
+            'server_type': args.server_type,
+            'redis': args.redis or 'loopback',
+            'clients': args.clients,
+            'groups': args.groups,
+            'rate': args.rate,
+            'duration': args.duration,
+            'payload_bytes': args.payload,
+            'format': args.format,
+            'broker': args.broker,
+            'courier_rss_bytes': {},
+            'rss_per_connection_bytes': None,
+            'traced_per_connection_bytes': None,
+        }
+
+        self.start_services()
+        try:
+            results['courier_rss_bytes']['idle'] = get_rss(self._courier.pid)
+            clients = [SseClient('/bench/%d/%d.sse' % (i % args.groups, i)) for i in range(args.clients)]
+
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                loop.run_until_complete(self._run_clients(clients, results))
+            finally:
+                loop.close()
+        finally:
+            self.stop_services()
+
+        return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run an end-to-end Django-RT courier load test.')
+    parser.add_argument('server_type', choices=['asyncio', 'gevent'], help='courier server type')
+    parser.add_argument('--clients', type=int, default=100, help='number of concurrent SSE clients (default 100)')
+    parser.add_argument('--groups', type=int, default=1,
+        help='number of channels the clients are split between (default 1)'
+    )
+    parser.add_argument('--rate', type=float, default=100, help='events published per second (default 100)')
+    parser.add_argument('--duration', type=float, default=10, help='publishing time in seconds (default 10)')
+    parser.add_argument('--payload', type=int, default=100, help='event payload size in bytes (default 100)')
+    parser.add_argument('--format', choices=['json', 'msgpack'], default='json',
+        help='format events are published in (RT_PUBLISH_FORMAT)'
+    )
+    parser.add_argument('--broker', choices=['redis', 'local'], default='redis',
+        help='broker events are published through (RT_BROKER)'
+    )
+    parser.add_argument('--connect-concurrency', type=int, default=100,
+        help='maximum number of handshakes in progress at once (default 100)'
+    )
+    parser.add_argument('--redis', metavar='HOST:PORT',
+        help='use a real Redis server instead of the loopback stand-in'
+    )
+    parser.add_argument('--tracemalloc', metavar='FRAMES', type=int, nargs='?', const=1, default=0,
+        help='trace the courier\'s memory allocations, keeping FRAMES stack frames each (default 1), and report the '
+            'traced memory per idle connection'
+    )
+    parser.add_argument('--port', type=int, help='courier port (default: any free port)')
+    parser.add_argument('--output', metavar='FILE', help='write results to FILE instead of stdout')
+    parser.add_argument('--verbose', action='store_true', help='show courier output and debug messages')
+    args = parser.parse_args(argv)
+
+    if args.clients < 1 or args.groups < 1 or args.rate <= 0:
+        parser.error('--clients, --groups and --rate must be positive')
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+
+    results = LoadTest(args).run()
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+"""Micro-benchmarks for the serialization and framing hot path.
+
+Times the functions which run for every published event or every connection, across event payload sizes, and writes
+the results to stdout (or --output) as JSON:
+
+    python -m django_rt.bench.micro --output before.json
+    python -m django_rt.bench.micro --output after.json
+    python -m django_rt.bench.micro --compare before.json after.json
+
+Each benchmark reports the best of several timed rounds in operations per second, and the memory allocated by one
+operation: the peak growth in memory traced by tracemalloc while it runs, in bytes, and the number of memory blocks
+it leaves allocated (which should be zero for anything but caches). Compare mode prints the change in ops/sec and
+allocated bytes of each benchmark present in both runs.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+
+# Payload sizes benchmarked by the sized benchmarks, in bytes of event data
+PAYLOAD_SIZES = (16, 256, 4096, 65536)
+
+BENCHMARKS = OrderedDict()
+
+def benchmark(name, sized=False):
+    """Register a benchmark. The decorated function takes the payload size (if sized) and returns the operation to
+    time, a callable without arguments."""
+    def decorator(func):
+        BENCHMARKS[name] = (func, sized)
+        return func
+    return decorator
+
+def make_event(size):
+    from django_rt.event import ResourceEvent
+    return ResourceEvent(data={'payload': 'x' * size}, event_type='update')
+
+@benchmark('ResourceEvent.to_json', sized=True)
+def bench_event_to_json(size):
+    event = make_event(size)
+    return event.to_json
+
+@benchmark('ResourceEvent.from_json', sized=True)
+def bench_event_from_json(size):
+    from django_rt.event import ResourceEvent
+    event_json = make_event(size).to_json()
+    return lambda: ResourceEvent.from_json(event_json)
+
+@benchmark('JsonDateTimeEncoder', sized=True)
+def bench_datetime_encoder(size):
+    from django_rt.utils import JsonDateTimeEncoder
+    obj = make_event(size).serialize()
+    encoder = JsonDateTimeEncoder()
+    return lambda: encoder.encode(obj)
+
+@benchmark('SseEvent.__str__', sized=True)
+def bench_sse_event_str(size):
+    from django_rt.sse import SseEvent
+    event = SseEvent(event='update', id='1500000000000-0', data=make_event(size).to_json())
+    return event.__str__
+
+@benchmark('SseEvent.as_utf8', sized=True)
+def bench_sse_event_as_utf8(size):
+    from django_rt.sse import SseEvent
+    event = SseEvent(event='update', id='1500000000000-0', data=make_event(size).to_json())
+    return event.as_utf8
+
+@benchmark('encode_raw_event', sized=True)
+def bench_encode_raw_event(size):
+    from django_rt.sse import encode_raw_event
+    event_json = make_event(size).to_json()
+    return lambda: encode_raw_event(event_json, 'update', '1500000000000-0')
+
+@benchmark('ChannelEvent.from_message', sized=True)
+def bench_channel_event_from_message(size):
+    from django_rt.couriers.common import ChannelEvent
+    message = ('1500000000000-0 ' + make_event(size).to_json()).encode('utf-8')
+    return lambda: ChannelEvent.from_message(message)
+
+@benchmark('SseHeartbeat.as_utf8')
+def bench_sse_heartbeat():
+    from django_rt.sse import SseHeartbeat
+    return SseHeartbeat().as_utf8
+
+@benchmark('get_full_channel_name')
+def bench_full_channel_name():
+    from django_rt.utils import get_full_channel_name
+    return lambda: get_full_channel_name('/chat/room1/messages')
+
+@benchmark('get_cors_headers')
+def bench_cors_headers():
+    from django_rt.utils import get_cors_headers
+    return lambda: get_cors_headers('https://example.com')
+
+@benchmark('ResourceRequest.get_signature')
+def bench_request_signing():
+    from django_rt.resource import ResourceRequest
+    res_req = ResourceRequest('/chat/room1/messages', 'subscribe', sub_id='0123456789abcdef')
+    return res_req.get_signature
+
+@benchmark('ResourceRequest.verify_signature')
+def bench_request_verification():
+    from django_rt.resource import ResourceRequest
+    res_req = ResourceRequest('/chat/room1/messages', 'subscribe', sub_id='0123456789abcdef')
+    res_req = ResourceRequest.from_json(res_req.to_json())
+    res_req.path = '/chat/room1/messages'
+    return res_req.verify_signature
+
+def time_op(op, min_time, rounds):
+    """Return the best time per call of op over a number of rounds, each lasting at least min_time seconds."""
+    # Calibrate the number of calls per round
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(number):
+            op()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+
+    best = elapsed / number
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for r in range(rounds - 1):
+            start = time.perf_counter()
+            for i in range(number):
+                op()
+            best = min(best, (time.perf_counter() - start) / number)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return best
+
+def measure_allocations(op, samples=5):
+    """Return the fewest bytes allocated at peak, and memory blocks left allocated, by one call of op."""
+    op() # warm up any caches first
+    peak_bytes = retained_blocks = None
+    tracemalloc.start()
+    try:
+        for i in range(samples):
+            gc.collect()
+            tracemalloc.clear_traces()
+            before, _ = tracemalloc.get_traced_memory()
+            blocks_before = sys.getallocatedblocks()
+            result = op()
+            blocks = sys.getallocatedblocks() - blocks_before
+            _, peak = tracemalloc.get_traced_memory()
+            del result
+
+            peak_bytes = peak - before if peak_bytes is None else min(peak_bytes, peak - before)
+            retained_blocks = blocks if retained_blocks is None else min(retained_blocks, blocks)
+    finally:
+        tracemalloc.stop()
+    return peak_bytes, retained_blocks
+
+def run_benchmarks(names=None, sizes=PAYLOAD_SIZES, min_time=0.2, rounds=5):
+    results = OrderedDict()
+    for name, (func, sized) in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+
+        for size in (sizes if sized else (None,)):
+            op = func(size) if sized else func()
+            key = '%s[%d]' % (name, size) if sized else name
+
+            per_call = time_op(op, min_time, rounds)
+            alloc_bytes, alloc_blocks = measure_allocations(op)
+            results[key] = {
+                'ops_per_sec': 1.0 / per_call if per_call else None,
+                'ns_per_op': per_call * 1e9,
+                'alloc_bytes_per_op': alloc_bytes,
+                'retained_blocks_per_op': alloc_blocks,
+            }
+            print('%-45s %14.0f ops/sec %10d bytes/op' % (key, results[key]['ops_per_sec'], alloc_bytes),
+                file=sys.stderr)
+    return results
+
+def get_environment():
+    import django
+    from django_rt.utils import get_json_backend
+
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'django': django.get_version(),
+        'json_backend': get_json_backend()[1].__module__,
+    }
+
+def compare(before_path, after_path):
+    """Print the change in each benchmark's ops/sec and allocated bytes between two result files."""
+    with open(before_path) as f:
+        before = json.load(f)['results']
+    with open(after_path) as f:
+        after = json.load(f)['results']
+
+    print('%-45s %14s %14s %8s %10s %10s' % ('benchmark', 'before ops/s', 'after ops/s', 'change', 'bytes', 'after'))
+    for key, a in after.items():
+        b = before.get(key)
+        if b is None:
+            continue
+        change = (a['ops_per_sec'] / b['ops_per_sec'] - 1) * 100 if b['ops_per_sec'] else 0
+        print('%-45s %14.0f %14.0f %+7.1f%% %10d %10d' % (
+            key, b['ops_per_sec'], a['ops_per_sec'], change, b['alloc_bytes_per_op'], a['alloc_bytes_per_op']
+        ))
+
+    for key in before:
+        if key not in after:
+            print('%-45s only in %s' % (key, before_path))
+    for key in after:
+        if key not in before:
+            print('%-45s only in %s' % (key, after_path))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run Django-RT serialization and framing micro-benchmarks.')
+    parser.add_argument('benchmarks', nargs='*', metavar='NAME',
+        help='benchmarks to run (default all): %s' % (', '.join(BENCHMARKS),)
+    )
+    parser.add_argument('--sizes', type=lambda s: [int(size) for size in s.split(',')], default=PAYLOAD_SIZES,
+        help='comma-separated event payload sizes in bytes (default %s)' % (','.join(map(str, PAYLOAD_SIZES)),)
+    )
+    parser.add_argument('--min-time', type=float, default=0.2, help='minimum time per round in seconds (default 0.2)')
+    parser.add_argument('--rounds', type=int, default=5, help='timed rounds per benchmark (default 5)')
+    parser.add_argument('--output', metavar='FILE', help='write results to FILE instead of stdout')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+        help='compare two result files instead of running benchmarks'
+    )
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: %s' % (', '.join(sorted(unknown)),))
+
+    # Benchmark against the stub Django project unless another is configured
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_rt.bench.settings')
+    import django
+    django.setup()
+
+    output = json.dumps({
+        'environment': get_environment(),
+        'results': run_benchmarks(args.benchmarks, args.sizes, args.min_time, args.rounds),
+    }, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+"""Loopback stand-in for a Redis server, for benchmarks.
+
+LoopbackRedis speaks the Redis protocol (RESP2, or RESP3 after HELLO 3) over TCP and implements the subset of commands used by publish(),
+RtResourceView and the couriers without event retention: strings (GET, SET, SETNX, DEL, EXISTS) and pub/sub (PUBLISH,
+SUBSCRIBE, UNSUBSCRIBE), plus connection commands. Any Redis client library can talk to it, so couriers run against
+it unmodified. Keys never expire, and each connection is served by its own thread.
+"""
+import socketserver
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+class _Status(bytes):
+    pass
+
+class _Error(str):
+    pass
+
+OK = _Status(b'OK')
+
+# Returned by commands which send their own replies
+NO_REPLY = object()
+
+def encode_reply(value, resp3=False, push=False):
+    """Encode a reply value in RESP2 or RESP3: None, int, bytes, str (as bulk strings), lists, dicts (RESP3 maps),
+    statuses and errors. Under RESP3, lists are encoded as push messages if push is True."""
+    if value is None:
+        return b'_\r\n' if resp3 else b'$-1\r\n'
+    elif isinstance(value, _Status):
+        return b'+' + value + b'\r\n'
+    elif isinstance(value, _Error):
+        return ('-ERR %s\r\n' % (value,)).encode('utf-8')
+    elif isinstance(value, int):
+        return b':%d\r\n' % (value,)
+    elif isinstance(value, str):
+        value = value.encode('utf-8')
+    if isinstance(value, bytes):
+        return b'$%d\r\n' % (len(value),) + value + b'\r\n'
+    elif isinstance(value, dict):
+        return b'%%%d\r\n' % (len(value),) + b''.join(
+            encode_reply(k, resp3) + encode_reply(v, resp3) for k, v in value.items()
+        )
+    else:
+        return (b'>' if resp3 and push else b'*') + b'%d\r\n' % (len(value),) + b''.join(
+            encode_reply(item, resp3) for item in value
+        )
+
+def read_command(rfile):
+    """Read a command from a buffered socket file. Returns a list of bytes arguments, or None at end of stream."""
+    line = rfile.readline()
+    if not line:
+        return None
+    if line[:1] != b'*':
+        # Inline command
+        return line.split()
+
+    args = []
+    for i in range(int(line[1:])):
+        size = int(rfile.readline()[1:])
+        args.append(rfile.read(size + 2)[:-2])
+    return args
+
+class _Handler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.channels = set()
+        self.protocol = 2
+        self._write_lock = threading.Lock()
+
+    def send(self, value):
+        data = encode_reply(value, self.protocol == 3)
+        with self._write_lock:
+            self.wfile.write(data)
+
+    def send_push(self, value):
+        """Send a pub/sub message, which is a push message under RESP3."""
+        data = encode_reply(value, self.protocol == 3, push=True)
+        with self._write_lock:
+            self.wfile.write(data)
+
+    def handle(self):
+        store = self.server.store
+        try:
+            while True:
+                args = read_command(self.rfile)
+                if args is None:
+                    break
+                if not args:
+                    continue
+
+                name = args[0].decode('ascii', 'replace').upper()
+                method = getattr(store, 'cmd_' + name.lower(), None)
+                if method is None:
+                    self.send(_Error("unknown command '%s'" % (name,)))
+                    continue
+                try:
+                    reply = method(self, *args[1:])
+                except TypeError:
+                    reply = _Error("wrong number of arguments for '%s' command" % (name,))
+
+                if reply is not NO_REPLY:
+                    self.send(reply)
+                if name == 'QUIT':
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            store.unsubscribe_all(self)
+
+class _Store:
+    """Keyspace and pub/sub state of a LoopbackRedis server. Command methods take the connection handler and the
+    command arguments, and return the reply (or NO_REPLY if they sent their own replies)."""
+
+    def __init__(self):
+        self.data = {}
+        self.subscribers = {} # channel -> set of handlers
+        self.lock = threading.Lock()
+        self.published = 0
+
+    # Connection
+    def cmd_ping(self, conn, message=None):
+        if conn.channels and conn.protocol == 2:
+            return [b'pong', message or b'']
+        return message if message is not None else _Status(b'PONG')
+
+    def cmd_hello(self, conn, protover=b'2', *args):
+        if protover not in (b'2', b'3'):
+            return _Error('NOPROTO unsupported protocol version')
+        conn.protocol = int(protover)
+        info = {b'server': b'redis', b'version': b'6.0.0', b'proto': conn.protocol, b'mode': b'standalone',
+            b'role': b'master', b'modules': []}
+        if conn.protocol == 2:
+            return [item for pair in info.items() for item in pair]
+        return info
+
+    def cmd_echo(self, conn, message):
+        return message
+
+    def cmd_select(self, conn, db):
+        return OK
+
+    def cmd_auth(self, conn, *args):
+        return OK
+
+    def cmd_client(self, conn, *args):
+        return OK
+
+    def cmd_quit(self, conn):
+        return OK
+
+    def cmd_flushdb(self, conn, *args):
+        with self.lock:
+            self.data.clear()
+        return OK
+
+    # Strings
+    def cmd_get(self, conn, key):
+        return self.data.get(key)
+
+    def cmd_set(self, conn, key, value, *options):
+        options = [opt.upper() for opt in options]
+        with self.lock:
+            if b'NX' in options and key in self.data:
+                return None
+            if b'XX' in options and key not in self.data:
+                return None
+            self.data[key] = value
+        return OK
+
+    def cmd_setnx(self, conn, key, value):
+        with self.lock:
+            if key in self.data:
+                return 0
+            self.data[key] = value
+            return 1
+
+    def cmd_del(self, conn, *keys):
+        with self.lock:
+            return sum(1 for key in keys if self.data.pop(key, None) is not None)
+
+    def cmd_exists(self, conn, *keys):
+        return sum(1 for key in keys if key in self.data)
+
+    # Pub/sub
+    def cmd_publish(self, conn, channel, message):
+        with self.lock:
+            receivers = list(self.subscribers.get(channel, ()))
+            self.published += 1
+        for receiver in receivers:
+            try:
+                receiver.send_push([b'message', channel, message])
+            except OSError:
+                pass
+        return len(receivers)
+
+    def cmd_subscribe(self, conn, *channels):
+        for channel in channels:
+            with self.lock:
+                self.subscribers.setdefault(channel, set()).add(conn)
+                conn.channels.add(channel)
+            conn.send_push([b'subscribe', channel, len(conn.channels)])
+        return NO_REPLY
+
+    def cmd_unsubscribe(self, conn, *channels):
+        if not channels:
+            channels = list(conn.channels)
+            if not channels:
+                conn.send_push([b'unsubscribe', None, 0])
+        for channel in channels:
+            self._unsubscribe(conn, channel)
+            conn.send_push([b'unsubscribe', channel, len(conn.channels)])
+        return NO_REPLY
+
+    def _unsubscribe(self, conn, channel):
+        with self.lock:
+            conn.channels.discard(channel)
+            receivers = self.subscribers.get(channel)
+            if receivers:
+                receivers.discard(conn)
+                if not receivers:
+                    del self.subscribers[channel]
+
+    def unsubscribe_all(self, conn):
+        for channel in list(conn.channels):
+            self._unsubscribe(conn, channel)
+
+class _Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class LoopbackRedis:
+    """Redis stand-in serving on a loopback TCP port from background threads. Port 0 picks a free port."""
+
+    def __init__(self, addr='127.0.0.1', port=0):
+        self.store = _Store()
+        self._server = _Server((addr, port), _Handler)
+        self._server.store = self.store
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='LoopbackRedis', daemon=True)
+        self._thread.start()
+        logger.info('Loopback Redis stand-in running on %s:%d' % self.address)
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,34 @@
+"""Django settings for the stub Django project used by the courier load test.
+
+The load test sets the DJANGO_RT_BENCH_* environment variables before starting Django and the courier, so both
+processes use the same Redis server, broker and Django URL.
+"""
+import os
+
+SECRET_KEY = 'django-rt-bench-not-secret'
+
+DEBUG = False
+
+ALLOWED_HOSTS = ['*']
+
+INSTALLED_APPS = (
+    'django_rt',
+)
+
+MIDDLEWARE_CLASSES = ()
+MIDDLEWARE = ()
+
+ROOT_URLCONF = 'django_rt.bench.urls'
+
+DATABASES = {}
+
+USE_TZ = True
+
+RT_REDIS_HOST = os.getenv('DJANGO_RT_BENCH_REDIS_HOST', '127.0.0.1')
+RT_REDIS_PORT = int(os.getenv('DJANGO_RT_BENCH_REDIS_PORT', 6379))
+RT_DJANGO_URL = os.getenv('DJANGO_RT_BENCH_DJANGO_URL', 'http://127.0.0.1:8000')
+RT_PUBLISH_FORMAT = os.getenv('DJANGO_RT_BENCH_PUBLISH_FORMAT', 'json')
+RT_BROKER = os.getenv('DJANGO_RT_BENCH_BROKER', 'redis')
+RT_LOCAL_BROKER_SOCKET_DIR = os.getenv('DJANGO_RT_BENCH_SOCKET_DIR')
+RT_COURIER_TRACEMALLOC = int(os.getenv('DJANGO_RT_BENCH_TRACEMALLOC', 0))
+RT_COURIER_IPS = ['127.0.0.1']
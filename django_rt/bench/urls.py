@@ -0,0 +1,7 @@
+from django.conf.urls import url
+
+from .views import BenchResourceView
+
+urlpatterns = [
+    url(r'^bench/(?P<group>[0-9]+)/(?P<client>[0-9]+)$', BenchResourceView.as_view()),
+]
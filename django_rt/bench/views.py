@@ -0,0 +1,11 @@
+from django_rt.views import RtResourceView
+
+class BenchResourceView(RtResourceView):
+    """Resource which allows every subscription. Clients of the same group share a channel, so each event is
+    delivered to the whole group."""
+
+    def rt_get_permission(self, action, request):
+        return True
+
+    def rt_get_channel(self, request):
+        return 'bench/%s' % (self.kwargs['group'],)
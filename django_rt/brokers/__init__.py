@@ -0,0 +1,39 @@
+from importlib import import_module
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from django_rt.settings import settings
+
+# Short names accepted by RT_BROKER, besides dotted paths to Broker classes
+BROKERS = {
+    'redis': 'django_rt.brokers.redis.RedisBroker',
+    'local': 'django_rt.brokers.local.LocalBroker',
+    'memory': 'django_rt.brokers.memory.MemoryBroker',
+}
+
+_broker = None
+
+def _load_broker_class(name):
+    path = BROKERS.get(name, name)
+    module_name, _, class_name = path.rpartition('.')
+    try:
+        return getattr(import_module(module_name), class_name)
+    except (ImportError, AttributeError, ValueError) as e:
+        raise ImproperlyConfigured('Cannot load RT_BROKER "%s": %s' % (name, e))
+
+def get_broker():
+    """Return the process-wide Broker selected by the RT_BROKER setting, creating it on first use."""
+    global _broker
+    if _broker is None:
+        _broker = _load_broker_class(settings.RT_BROKER)()
+    return _broker
+
+@receiver(setting_changed)
+def _reset_broker(setting, **kwargs):
+    global _broker
+    if setting == 'RT_BROKER' or setting.startswith(('RT_REDIS_', 'RT_LOCAL_BROKER_')):
+        if _broker is not None:
+            _broker.close()
+            _broker = None
@@ -0,0 +1,133 @@
+class Broker:
+    """Message broker between Django and the couriers.
+
+    A broker carries published events from publish() to couriers over pub/sub channels, optionally retains recent
+    events for replay, and stores the status of subscriptions during the subscription handshake. Pub/sub methods take
+    broker channel names, such as those returned by get_full_channel_name(); publish_event() and get_events_after()
+    take Django-RT channel names, and apply the channel's RT_EVENT_RETENTION setting.
+
+    Methods block; coroutine versions for asyncio are provided by the broker's AsyncBroker, returned by get_async().
+    """
+
+    # Events
+    def publish(self, channel, message):
+        """Publish a message (str or bytes) to a broker channel. Returns the number of subscribers which received it,
+        if known."""
+        raise NotImplementedError('publish() not implemented')
+
+    def publish_event(self, channel, message):
+        """Publish a serialized event to a Django-RT channel, retaining it for replay if the channel retains events.
+        Returns the number of couriers which received it, if known."""
+        raise NotImplementedError('publish_event() not implemented')
+
+    def publish_events(self, events):
+        """Publish a batch of (channel, serialized event) tuples like publish_event(), returning a list of receiver
+        counts in the same order. Brokers may send the batch in one round trip."""
+        return [self.publish_event(channel, message) for channel, message in events]
+
+    def get_events_after(self, channel, last_event_id, count):
+        """Return an (events, found) tuple of up to count (event ID, serialized event) tuples retained for a Django-RT
+        channel after the given event ID, oldest first, and whether the given event itself is still retained. If it is
+        not (the stream was trimmed past it, or is empty), events published in between may have been lost."""
+        return [], False
+
+    # Subscription handshake
+    def create_subscription(self, sub_id):
+        """Create a subscription with the 'requested' status. Returns False if the subscription ID is taken."""
+        raise NotImplementedError('create_subscription() not implemented')
+
+    def get_subscription_status(self, sub_id):
+        """Return the status of a subscription, or None if it does not exist."""
+        raise NotImplementedError('get_subscription_status() not implemented')
+
+    def set_subscription_status(self, sub_id, status):
+        """Change the status of a subscription. Returns True on success."""
+        raise NotImplementedError('set_subscription_status() not implemented')
+
+    def delete_subscription(self, sub_id):
+        """Delete a subscription. Returns True if it existed."""
+        raise NotImplementedError('delete_subscription() not implemented')
+
+    # Pub/sub
+    def subscriber(self):
+        """Return a new Subscriber, which receives messages from the broker channels it subscribes to."""
+        raise NotImplementedError('subscriber() not implemented')
+
+    def get_async(self, loop=None, poolsize=None):
+        """Return the AsyncBroker for the given (or current) event loop. Brokers which keep a pool of connections
+        open up to poolsize of them for the loop."""
+        raise NotImplementedError('get_async() not implemented')
+
+    def close_async(self, loop):
+        """Close the AsyncBroker created by get_async() for an event loop, if any. It holds the loop and its
+        connections until then, so call this before closing a loop which used it."""
+        pass
+
+    def close(self):
+        """Release connections held by the broker, including those of its AsyncBrokers."""
+        pass
+
+class Subscriber:
+    """Blocking subscription to broker channels, read by one thread or greenlet."""
+
+    def subscribe(self, channel):
+        raise NotImplementedError('subscribe() not implemented')
+
+    def unsubscribe(self, channel):
+        raise NotImplementedError('unsubscribe() not implemented')
+
+    def get_message(self, timeout=None):
+        """Wait up to timeout seconds for a message. Returns a (channel, message) tuple, where the channel name is a
+        str and the message is bytes, or None if no message arrived in time."""
+        raise NotImplementedError('get_message() not implemented')
+
+    def close(self):
+        pass
+
+class AsyncBroker:
+    """Coroutine versions of the Broker methods, for one asyncio event loop."""
+
+    def publish(self, channel, message):
+        raise NotImplementedError('publish() not implemented')
+
+    def publish_event(self, channel, message):
+        raise NotImplementedError('publish_event() not implemented')
+
+    def publish_events(self, events):
+        raise NotImplementedError('publish_events() not implemented')
+
+    def create_subscription(self, sub_id):
+        raise NotImplementedError('create_subscription() not implemented')
+
+    def get_subscription_status(self, sub_id):
+        raise NotImplementedError('get_subscription_status() not implemented')
+
+    def set_subscription_status(self, sub_id, status):
+        raise NotImplementedError('set_subscription_status() not implemented')
+
+    def delete_subscription(self, sub_id):
+        raise NotImplementedError('delete_subscription() not implemented')
+
+    def subscriber(self):
+        """Coroutine returning a new AsyncSubscriber."""
+        raise NotImplementedError('subscriber() not implemented')
+
+    def close(self):
+        pass
+
+class AsyncSubscriber:
+    """Subscription to broker channels, read by one task."""
+
+    def subscribe(self, channel):
+        raise NotImplementedError('subscribe() not implemented')
+
+    def unsubscribe(self, channel):
+        raise NotImplementedError('unsubscribe() not implemented')
+
+    def next_message(self):
+        """Coroutine returning the next (channel, message) tuple, where the channel name is a str and the message is
+        bytes."""
+        raise NotImplementedError('next_message() not implemented')
+
+    def close(self):
+        pass
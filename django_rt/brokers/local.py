@@ -0,0 +1,448 @@
+import asyncio
+import errno
+import itertools
+import os
+import queue
+import socket
+import stat
+import tempfile
+import threading
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+from django.core.exceptions import ImproperlyConfigured
+
+from django_rt.brokers.base import AsyncSubscriber, Subscriber
+from django_rt.brokers.redis import AsyncRedisBroker, RedisBroker
+from django_rt.settings import settings
+from django_rt.utils import coroutine, get_event_retention, get_full_channel_name
+
+# Largest datagram sent to a courier socket; larger events go through Redis. Linux limits Unix datagrams to the
+# sender's socket buffer size, which is about 208 KiB by default.
+MAX_DATAGRAM_SIZE = 200*1024
+
+# Seconds for which a publisher's list of courier sockets is reused before the socket directory is scanned again
+SCAN_INTERVAL = 1.0
+
+SOCKET_PREFIX = 'courier-'
+SOCKET_SUFFIX = '.sock'
+
+_socket_ids = itertools.count()
+
+def _to_bytes(message):
+    return message.encode('utf-8') if isinstance(message, str) else message
+
+def encode_datagram(channel, message):
+    """Frame a message published to a broker channel as one datagram: the channel name, a NUL byte and the
+    message."""
+    return channel.encode('utf-8') + b'\0' + _to_bytes(message)
+
+def decode_datagram(data):
+    """Return the (channel, message) tuple framed by encode_datagram()."""
+    channel, _, message = data.partition(b'\0')
+    return channel.decode('utf-8'), message
+
+class LocalBroker(RedisBroker):
+    """Redis broker which delivers events to couriers on the same host over Unix domain sockets.
+
+    Each courier process binds a datagram socket in the RT_LOCAL_BROKER_SOCKET_DIR directory, and publish() sends
+    every event straight to all the sockets in it, without a round trip through Redis. When RT_LOCAL_BROKER_REDIS is
+    enabled, events are also published to Redis for couriers on other hosts, tagged with this host's origin
+    (RT_LOCAL_BROKER_ORIGIN), and couriers discard the Redis copies of events which originated on their own host.
+    All couriers and Django processes must therefore use this broker, and those sharing a socket directory must
+    share an origin.
+
+    Couriers which do not accept an event within RT_LOCAL_BROKER_SEND_TIMEOUT are sent it through Redis instead: the
+    Redis copy is tagged with their socket names, so they keep it while the other local couriers discard it. Until the
+    socket directory is scanned again, their events go straight through Redis rather than waiting for them again.
+
+    Everything else goes through Redis as with RedisBroker: events on channels which retain events (their IDs are
+    assigned by Redis), events too large for one datagram, subscription status and multiplexed stream control
+    messages.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.socket_dir = settings.RT_LOCAL_BROKER_SOCKET_DIR or os.path.join(tempfile.gettempdir(), 'django_rt')
+        # The default directory is in a shared, world-writable location, so it is only used if it is private to us
+        self._dir_checked = bool(settings.RT_LOCAL_BROKER_SOCKET_DIR)
+        self.origin = settings.RT_LOCAL_BROKER_ORIGIN or socket.gethostname()
+        self._tag = b'@' + self.origin.encode('utf-8') + b' '
+        self._lock = threading.Lock()
+        self._sock = None
+        self._paths = ()
+        self._slow = set() # paths of couriers which timed out since the last scan
+        self._scanned = None
+
+    def check_socket_dir(self):
+        """Check the default socket directory is a real directory owned by this user and not writable by others, so
+        other users cannot plant sockets receiving our events. Raises ImproperlyConfigured if not, or FileNotFoundError
+        if the directory does not exist."""
+        if self._dir_checked:
+            return
+        st = os.lstat(self.socket_dir)
+        if not stat.S_ISDIR(st.st_mode):
+            raise ImproperlyConfigured('Local broker socket directory %s is not a directory' % (self.socket_dir,))
+        if st.st_uid != os.getuid() or st.st_mode & 0o022:
+            raise ImproperlyConfigured(
+                'Local broker socket directory %s must be owned by the current user and not writable by group or '
+                'others; remove it or set RT_LOCAL_BROKER_SOCKET_DIR' % (self.socket_dir,)
+            )
+        self._dir_checked = True
+
+    def get_courier_sockets(self):
+        """Return the paths of the courier sockets in the socket directory. The directory is scanned at most once
+        every SCAN_INTERVAL seconds."""
+        now = time.monotonic()
+        if self._scanned is None or now - self._scanned >= SCAN_INTERVAL:
+            try:
+                self.check_socket_dir()
+                names = os.listdir(self.socket_dir)
+            except FileNotFoundError:
+                names = ()
+            self._paths = tuple(
+                os.path.join(self.socket_dir, name) for name in names
+                if name.startswith(SOCKET_PREFIX) and name.endswith(SOCKET_SUFFIX)
+            )
+            self._slow = set()
+            self._scanned = now
+        return self._paths
+
+    def _forget_socket(self, path):
+        self._paths = tuple(p for p in self._paths if p != path)
+
+    def send_local(self, channel, message):
+        """Send a message published to a broker channel to every courier on this host. Returns a (delivered, missed)
+        tuple of the number of couriers which received it and the paths of those which could not be sent it in time,
+        or None if the message is too large for a datagram."""
+        data = encode_datagram(channel, message)
+        if len(data) > MAX_DATAGRAM_SIZE:
+            return None
+
+        with self._lock:
+            if self._sock is None:
+                self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                # Wait for couriers which fall behind, rather than dropping events
+                self._sock.settimeout(settings.RT_LOCAL_BROKER_SEND_TIMEOUT)
+            sock = self._sock
+
+        delivered = 0
+        missed = []
+        for path in self.get_courier_sockets():
+            if path in self._slow:
+                missed.append(path)
+                continue
+            try:
+                sock.sendto(data, path)
+                delivered += 1
+            except socket.timeout:
+                logger.warning('Timed out sending event to courier socket %s; sending through Redis' % (path,))
+                self._slow.add(path)
+                missed.append(path)
+            except OSError as e:
+                if e.errno == errno.EMSGSIZE:
+                    return None
+                elif e.errno == errno.ECONNREFUSED:
+                    # Left behind by a courier which exited without removing it
+                    logger.debug('Removing stale courier socket %s' % (path,))
+                    self._forget_socket(path)
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                elif e.errno == errno.ENOENT:
+                    self._forget_socket(path)
+                else:
+                    logger.warning('Error sending event to courier socket %s: %s; sending through Redis' % (path, e))
+                    missed.append(path)
+        return delivered, missed
+
+    def tag_message(self, message, missed=()):
+        """Prefix a message published to Redis with this host's origin, and the socket names of the local couriers it
+        could not be sent to."""
+        if not missed:
+            return self._tag + _to_bytes(message)
+        names = ','.join(os.path.basename(path) for path in missed).encode('utf-8')
+        return self._tag[:-1] + b'>' + names + b' ' + _to_bytes(message)
+
+    def untag_message(self, message, path=None):
+        """Strip the origin from a message received from Redis by the courier bound to the given socket path. Returns
+        None if the message originated on this host, and was already delivered over the courier's socket."""
+        if message[:1] != b'@':
+            return message
+        tag, _, message = message.partition(b' ')
+        origin, _, names = tag.partition(b'>')
+        if origin + b' ' != self._tag:
+            return message
+        if path and names and os.path.basename(path).encode('utf-8') in names.split(b','):
+            return message
+        return None
+
+    def redis_copy(self, message, missed):
+        """Return the tagged copy of a message sent over the courier sockets to publish to Redis, for couriers on other
+        hosts and the local couriers it missed, or None if no courier needs it."""
+        if settings.RT_LOCAL_BROKER_REDIS or missed:
+            return self.tag_message(message, missed)
+        return None
+
+    def bind_courier_socket(self):
+        """Create and bind a courier socket in the socket directory. Returns the socket and its path."""
+        os.makedirs(self.socket_dir, mode=0o700, exist_ok=True)
+        self.check_socket_dir()
+        path = os.path.join(self.socket_dir, '%s%d-%d%s' % (SOCKET_PREFIX, os.getpid(), next(_socket_ids), SOCKET_SUFFIX))
+        if os.path.exists(path):
+            os.unlink(path)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        return sock, path
+
+    def publish_event(self, channel, message):
+        if get_event_retention(channel):
+            # Event IDs are assigned by Redis
+            return super().publish_event(channel, message)
+
+        full_channel = get_full_channel_name(channel)
+        sent = self.send_local(full_channel, message)
+        if sent is None:
+            return super().publish_event(channel, message)
+        delivered, missed = sent
+        copy = self.redis_copy(message, missed)
+        if copy is not None:
+            received = self.get_connection().publish(full_channel, copy)
+            return received if settings.RT_LOCAL_BROKER_REDIS else delivered + len(missed)
+        return delivered
+
+    def publish_events(self, events):
+        # Deliver local events first, then publish the rest to Redis in one pipelined round trip
+        pipe = self.get_connection().pipeline(transaction=False)
+        results = [] # (receiver count, or None to use the Redis reply; whether a command was pipelined)
+        for channel, message in events:
+            sent = None
+            if not get_event_retention(channel):
+                full_channel = get_full_channel_name(channel)
+                sent = self.send_local(full_channel, message)
+
+            if sent is None:
+                self._publish_command(pipe, channel, message)
+                results.append((None, True))
+                continue
+
+            delivered, missed = sent
+            copy = self.redis_copy(message, missed)
+            if copy is None:
+                results.append((delivered, False))
+            else:
+                pipe.publish(full_channel, copy)
+                results.append((None if settings.RT_LOCAL_BROKER_REDIS else delivered + len(missed), True))
+
+        replies = iter(pipe.execute())
+        counts = []
+        for delivered, pipelined in results:
+            reply = next(replies) if pipelined else None
+            counts.append(reply if delivered is None else delivered)
+        return counts
+
+    def subscriber(self):
+        return LocalSubscriber(self, super().subscriber())
+
+    def create_async(self, loop, poolsize):
+        return AsyncLocalBroker(self, loop, poolsize)
+
+    def close(self):
+        super().close()
+        with self._lock:
+            if self._sock:
+                self._sock.close()
+                self._sock = None
+
+class LocalSubscriber(Subscriber):
+    """Blocking subscription receiving messages from both a courier socket and Redis. Each source is read by its own
+    thread (or greenlet, in the gevent courier)."""
+
+    # Socket reader poll interval, in seconds
+    POLL_TIMEOUT = 1.0
+
+    def __init__(self, broker, redis_subscriber):
+        self._broker = broker
+        self._redis = redis_subscriber
+        self._channels = set()
+        self._queue = queue.Queue()
+        self._closed = False
+        self._redis_reader = None
+
+        self._sock, self.path = broker.bind_courier_socket()
+        self._sock.settimeout(self.POLL_TIMEOUT)
+        self._socket_reader = threading.Thread(target=self._read_socket, daemon=True)
+        self._socket_reader.start()
+
+    def _read_socket(self):
+        buf = bytearray(MAX_DATAGRAM_SIZE)
+        try:
+            while not self._closed:
+                try:
+                    size = self._sock.recv_into(buf)
+                except socket.timeout:
+                    continue
+
+                channel, message = decode_datagram(bytes(buf[:size]))
+                if channel in self._channels:
+                    self._queue.put((channel, message))
+        except Exception as e:
+            if not self._closed:
+                self._queue.put(e)
+
+    def _read_redis(self):
+        try:
+            while not self._closed:
+                msg = self._redis.get_message(timeout=self.POLL_TIMEOUT)
+                if not msg:
+                    continue
+
+                channel, message = msg
+                message = self._broker.untag_message(message, self.path)
+                if message is not None:
+                    self._queue.put((channel, message))
+        except Exception as e:
+            if not self._closed:
+                self._queue.put(e)
+
+    def subscribe(self, channel):
+        self._channels.add(channel)
+        self._redis.subscribe(channel)
+
+        # Redis can only be read once subscribed to a channel
+        if not self._redis_reader:
+            self._redis_reader = threading.Thread(target=self._read_redis, daemon=True)
+            self._redis_reader.start()
+
+    def unsubscribe(self, channel):
+        self._channels.discard(channel)
+        self._redis.unsubscribe(channel)
+
+    def get_message(self, timeout=None):
+        try:
+            item = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+        if isinstance(item, Exception):
+            # Reader failed
+            raise item
+        return item
+
+    def close(self):
+        self._closed = True
+        self._sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        self._redis.close()
+
+class AsyncLocalBroker(AsyncRedisBroker):
+    """Coroutine versions of the LocalBroker methods. Sockets are written from the default executor, so a courier
+    which falls behind does not block the event loop."""
+
+    def __init__(self, broker, loop, poolsize):
+        super().__init__(loop, poolsize)
+        self._broker = broker
+
+    @coroutine
+    def publish_event(self, channel, message):
+        if get_event_retention(channel):
+            return (yield from super().publish_event(channel, message))
+
+        full_channel = get_full_channel_name(channel)
+        sent = yield from self._loop.run_in_executor(None, self._broker.send_local, full_channel, message)
+        if sent is None:
+            return (yield from super().publish_event(channel, message))
+        delivered, missed = sent
+        copy = self._broker.redis_copy(message, missed)
+        if copy is not None:
+            # The pool encodes messages as text
+            pool = yield from self.get_pool()
+            received = yield from pool.publish(full_channel, copy.decode('utf-8'))
+            return received if settings.RT_LOCAL_BROKER_REDIS else delivered + len(missed)
+        return delivered
+
+    @coroutine
+    def subscriber(self):
+        redis_subscriber = yield from super().subscriber()
+        return AsyncLocalSubscriber(self._broker, self._loop, redis_subscriber)
+
+class AsyncLocalSubscriber(AsyncSubscriber):
+    """Subscription receiving messages from both a courier socket, read by the event loop, and Redis."""
+
+    def __init__(self, broker, loop, redis_subscriber):
+        self._broker = broker
+        self._loop = loop
+        self._redis = redis_subscriber
+        self._channels = set()
+        # Created on the event loop, by AsyncLocalBroker.subscriber()
+        self._queue = asyncio.Queue()
+        self._buf = bytearray(MAX_DATAGRAM_SIZE)
+
+        self._sock, self.path = broker.bind_courier_socket()
+        self._sock.setblocking(False)
+        loop.add_reader(self._sock.fileno(), self._on_readable)
+        self._redis_reader = asyncio.ensure_future(self._read_redis(), loop=loop)
+
+    def _on_readable(self):
+        # Read every datagram waiting on the socket
+        while True:
+            try:
+                size = self._sock.recv_into(self._buf)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self._loop.remove_reader(self._sock.fileno())
+                self._queue.put_nowait(e)
+                return
+
+            channel, message = decode_datagram(bytes(self._buf[:size]))
+            if channel in self._channels:
+                self._queue.put_nowait((channel, message))
+
+    @coroutine
+    def _read_redis(self):
+        try:
+            while True:
+                channel, message = yield from self._redis.next_message()
+                message = self._broker.untag_message(message, self.path)
+                if message is not None:
+                    self._queue.put_nowait((channel, message))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._queue.put_nowait(e)
+
+    @coroutine
+    def subscribe(self, channel):
+        self._channels.add(channel)
+        yield from self._redis.subscribe(channel)
+
+    @coroutine
+    def unsubscribe(self, channel):
+        self._channels.discard(channel)
+        yield from self._redis.unsubscribe(channel)
+
+    @coroutine
+    def next_message(self):
+        item = yield from self._queue.get()
+        if isinstance(item, Exception):
+            # Reader failed
+            raise item
+        return item
+
+    def close(self):
+        self._loop.remove_reader(self._sock.fileno())
+        self._sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        self._redis_reader.cancel()
+        self._redis.close()
@@ -0,0 +1,210 @@
+import asyncio
+import queue
+import threading
+import time
+from collections import deque
+
+from django_rt.brokers.base import AsyncBroker, AsyncSubscriber, Broker, Subscriber
+from django_rt.utils import get_event_retention, get_full_channel_name, parse_event_id
+
+def _to_bytes(message):
+    return message.encode('utf-8') if isinstance(message, str) else message
+
+class MemoryBroker(Broker):
+    """In-process broker, for tests and deployments where Django and the courier run in the same process.
+
+    Messages are passed to subscribers' queues directly, and retained events are kept in a bounded deque per channel.
+    All state lives in the broker object, so nothing crosses a process boundary. The broker is thread-safe, and its
+    AsyncBrokers deliver to subscribers on their own event loops.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {} # channel -> set of subscribers
+        self._subscriptions = {} # subscription ID -> status
+        self._streams = {} # Django-RT channel -> deque of (event ID, message)
+        self._last_id = (0, 0)
+        self._async_brokers = {} # event loop -> AsyncMemoryBroker
+
+    def _next_event_id(self):
+        """Return a new event ID in the same format as Redis stream IDs. Called with the lock held."""
+        ms = int(time.time() * 1000)
+        last_ms, seq = self._last_id
+        self._last_id = (ms, 0) if ms > last_ms else (last_ms, seq + 1)
+        return '%d-%d' % self._last_id
+
+    def _add_subscriber(self, channel, subscriber):
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(subscriber)
+
+    def _remove_subscriber(self, channel, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(channel)
+            if subscribers:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[channel]
+
+    def publish(self, channel, message):
+        message = _to_bytes(message)
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscriber in subscribers:
+            subscriber.deliver(channel, message)
+        return len(subscribers)
+
+    def publish_event(self, channel, message):
+        message = _to_bytes(message)
+        retention = get_event_retention(channel)
+        if retention:
+            with self._lock:
+                id = self._next_event_id()
+                stream = self._streams.get(channel)
+                if stream is None or stream.maxlen != retention:
+                    stream = self._streams[channel] = deque(stream or (), maxlen=retention)
+                stream.append((id, message))
+
+            # Prefix the event ID, like the Redis broker
+            message = id.encode('ascii') + b' ' + message
+        return self.publish(get_full_channel_name(channel), message)
+
+    def get_events_after(self, channel, last_event_id, count):
+        after = parse_event_id(last_event_id)
+        with self._lock:
+            entries = list(self._streams.get(channel, ()))
+        found = any(id == last_event_id for id, message in entries)
+        return [(id, message) for id, message in entries if parse_event_id(id) > after][:count], found
+
+    def create_subscription(self, sub_id):
+        with self._lock:
+            if sub_id in self._subscriptions:
+                return False
+            self._subscriptions[sub_id] = 'requested'
+            return True
+
+    def get_subscription_status(self, sub_id):
+        return self._subscriptions.get(sub_id)
+
+    def set_subscription_status(self, sub_id, status):
+        self._subscriptions[sub_id] = status
+        return True
+
+    def delete_subscription(self, sub_id):
+        return self._subscriptions.pop(sub_id, None) is not None
+
+    def subscriber(self):
+        return MemorySubscriber(self)
+
+    def get_async(self, loop=None, poolsize=None):
+        loop = loop or asyncio.get_event_loop()
+        async_broker = self._async_brokers.get(loop)
+        if async_broker is None:
+            for closed_loop in [l for l in self._async_brokers if l.is_closed()]:
+                del self._async_brokers[closed_loop]
+            async_broker = self._async_brokers[loop] = AsyncMemoryBroker(self, loop)
+        return async_broker
+
+    def close_async(self, loop):
+        self._async_brokers.pop(loop, None)
+
+    def close(self):
+        self._async_brokers.clear()
+
+class MemorySubscriber(Subscriber):
+    def __init__(self, broker):
+        self._broker = broker
+        self._queue = queue.Queue()
+        self._channels = set()
+
+    def deliver(self, channel, message):
+        self._queue.put((channel, message))
+
+    def subscribe(self, channel):
+        self._channels.add(channel)
+        self._broker._add_subscriber(channel, self)
+
+    def unsubscribe(self, channel):
+        self._channels.discard(channel)
+        self._broker._remove_subscriber(channel, self)
+
+    def get_message(self, timeout=None):
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        for channel in list(self._channels):
+            self.unsubscribe(channel)
+
+class AsyncMemoryBroker(AsyncBroker):
+    """Coroutine versions of the MemoryBroker methods. The broker never blocks for long, so each call completes
+    immediately and returns a finished future."""
+
+    def __init__(self, broker, loop):
+        self._broker = broker
+        self._loop = loop
+
+    def _done(self, result):
+        future = asyncio.Future(loop=self._loop)
+        future.set_result(result)
+        return future
+
+    def publish(self, channel, message):
+        return self._done(self._broker.publish(channel, message))
+
+    def publish_event(self, channel, message):
+        return self._done(self._broker.publish_event(channel, message))
+
+    def publish_events(self, events):
+        return self._done(self._broker.publish_events(events))
+
+    def create_subscription(self, sub_id):
+        return self._done(self._broker.create_subscription(sub_id))
+
+    def get_subscription_status(self, sub_id):
+        return self._done(self._broker.get_subscription_status(sub_id))
+
+    def set_subscription_status(self, sub_id, status):
+        return self._done(self._broker.set_subscription_status(sub_id, status))
+
+    def delete_subscription(self, sub_id):
+        return self._done(self._broker.delete_subscription(sub_id))
+
+    def subscriber(self):
+        return self._done(AsyncMemorySubscriber(self._broker, self._loop))
+
+class AsyncMemorySubscriber(AsyncSubscriber):
+    def __init__(self, broker, loop):
+        self._broker = broker
+        self._loop = loop
+        # Created on the event loop, by AsyncMemoryBroker.subscriber()
+        self._queue = asyncio.Queue()
+        self._channels = set()
+
+    def deliver(self, channel, message):
+        # Publishers may run in other threads
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, (channel, message))
+
+    def subscribe(self, channel):
+        self._channels.add(channel)
+        self._broker._add_subscriber(channel, self)
+        return self._done()
+
+    def unsubscribe(self, channel):
+        self._channels.discard(channel)
+        self._broker._remove_subscriber(channel, self)
+        return self._done()
+
+    def _done(self):
+        future = asyncio.Future(loop=self._loop)
+        future.set_result(None)
+        return future
+
+    def next_message(self):
+        return self._queue.get()
+
+    def close(self):
+        for channel in list(self._channels):
+            self._broker._remove_subscriber(channel, self)
+        self._channels.clear()
@@ -0,0 +1,282 @@
+import asyncio
+import redis
+
+from django_rt.brokers.base import AsyncBroker, AsyncSubscriber, Broker, Subscriber
+from django_rt.settings import settings
+from django_rt.utils import coroutine, get_event_retention, get_full_channel_name, get_stream_key, get_subscription_key
+
+# Appends an event to its channel's capped retention stream, then publishes it prefixed with the new stream ID so
+# couriers can send the ID to clients and replay missed events from the stream on reconnect
+RETAINED_PUBLISH_SCRIPT = """
+local id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], '*', 'event', ARGV[2])
+return redis.call('PUBLISH', KEYS[2], id .. ' ' .. ARGV[2])
+"""
+
+class RedisBroker(Broker):
+    """Broker backed by a Redis server, configured by the RT_REDIS_* settings.
+
+    Events are published with PUBLISH, and retained events are kept in capped Redis streams. Subscription status is
+    kept in string keys. Blocking methods use a process-wide redis-py connection pool; the AsyncBroker of each event
+    loop uses an asyncio_redis pool.
+    """
+
+    def __init__(self):
+        self.connection_pool = redis.ConnectionPool(
+            host=settings.RT_REDIS_HOST,
+            port=settings.RT_REDIS_PORT,
+            db=settings.RT_REDIS_DB,
+            password=settings.RT_REDIS_PASSWORD,
+            max_connections=settings.RT_REDIS_MAX_CONNECTIONS
+        )
+        self._publish_script = None
+        self._async_brokers = {} # event loop -> AsyncRedisBroker
+
+    def get_connection(self):
+        """Return a redis-py client backed by the broker's connection pool."""
+        return redis.StrictRedis(connection_pool=self.connection_pool)
+
+    def _publish_command(self, client, channel, message):
+        """Issue the command publishing a serialized event to a channel, on a redis-py client or pipeline."""
+        retention = get_event_retention(channel)
+        if retention:
+            if self._publish_script is None:
+                self._publish_script = client.register_script(RETAINED_PUBLISH_SCRIPT)
+            return self._publish_script(
+                keys=[get_stream_key(channel), get_full_channel_name(channel)],
+                args=[retention, message],
+                client=client
+            )
+        else:
+            return client.publish(get_full_channel_name(channel), message)
+
+    def publish(self, channel, message):
+        return self.get_connection().publish(channel, message)
+
+    def publish_event(self, channel, message):
+        return self._publish_command(self.get_connection(), channel, message)
+
+    def publish_events(self, events):
+        # One pipelined round trip for the whole batch
+        pipe = self.get_connection().pipeline(transaction=False)
+        for channel, message in events:
+            self._publish_command(pipe, channel, message)
+        return pipe.execute()
+
+    def get_events_after(self, channel, last_event_id, count):
+        entries = self.get_connection().xrange(get_stream_key(channel),
+            min=last_event_id,
+            max='+',
+            count=count + 1
+        )
+
+        events = []
+        found = False
+        for id, fields in entries:
+            id = id.decode('utf-8')
+            if id == last_event_id:
+                # XRANGE is inclusive, so the event is still retained if it comes first; the client already has it
+                found = True
+                continue
+            events.append((id, fields[b'event']))
+        return events[:count], found
+
+    def create_subscription(self, sub_id):
+        return bool(self.get_connection().setnx(get_subscription_key(sub_id), 'requested'))
+
+    def get_subscription_status(self, sub_id):
+        status = self.get_connection().get(get_subscription_key(sub_id))
+        return status.decode('utf-8') if status is not None else None
+
+    def set_subscription_status(self, sub_id, status):
+        return bool(self.get_connection().set(get_subscription_key(sub_id), status))
+
+    def delete_subscription(self, sub_id):
+        return bool(self.get_connection().delete(get_subscription_key(sub_id)))
+
+    def subscriber(self):
+        return RedisSubscriber(self.get_connection().pubsub(ignore_subscribe_messages=True))
+
+    def get_async(self, loop=None, poolsize=None):
+        """Return the AsyncRedisBroker for the given (or current) event loop, creating it on first use. Its pool
+        holds up to poolsize connections (default RT_REDIS_ASYNC_POOL_SIZE)."""
+        loop = loop or asyncio.get_event_loop()
+        async_broker = self._async_brokers.get(loop)
+        if async_broker is None:
+            # Forget the AsyncBrokers of loops closed without close_async(); their connections can no longer be closed
+            for closed_loop in [l for l in self._async_brokers if l.is_closed()]:
+                del self._async_brokers[closed_loop]
+
+            async_broker = self._async_brokers[loop] = self.create_async(loop,
+                poolsize or settings.RT_REDIS_ASYNC_POOL_SIZE
+            )
+        return async_broker
+
+    def create_async(self, loop, poolsize):
+        """Create the AsyncBroker for an event loop. Subclasses may return a subclass of AsyncRedisBroker."""
+        return AsyncRedisBroker(loop, poolsize)
+
+    def close_async(self, loop):
+        async_broker = self._async_brokers.pop(loop, None)
+        if async_broker is not None and not loop.is_closed():
+            async_broker.close()
+
+    def close(self):
+        self.connection_pool.disconnect()
+        for loop in list(self._async_brokers):
+            self.close_async(loop)
+
+class RedisSubscriber(Subscriber):
+    """Blocking subscription over a redis-py PubSub connection."""
+
+    def __init__(self, pubsub):
+        self._pubsub = pubsub
+
+    def subscribe(self, channel):
+        self._pubsub.subscribe(channel)
+
+    def unsubscribe(self, channel):
+        self._pubsub.unsubscribe(channel)
+
+    def get_message(self, timeout=None):
+        msg = self._pubsub.get_message(timeout=timeout)
+        if not msg or msg['type'] != 'message':
+            return None
+        return msg['channel'].decode('utf-8'), msg['data']
+
+    def close(self):
+        self._pubsub.close()
+
+class AsyncRedisBroker(AsyncBroker):
+    """Coroutine versions of the RedisBroker methods, backed by a persistent asyncio_redis pool. The pool encodes
+    messages as text, so events are published as JSON."""
+
+    def __init__(self, loop, poolsize):
+        self._loop = loop
+        self._poolsize = poolsize
+        self._pool_task = None
+        self._publish_script = None
+
+    @coroutine
+    def get_pool(self):
+        """Return the broker's asyncio_redis connection pool, creating it on first use."""
+        import asyncio_redis
+
+        # Store the creation task rather than the pool, so concurrent first calls share one pool
+        pool_task = self._pool_task
+        if pool_task is None:
+            pool_task = self._pool_task = asyncio.ensure_future(asyncio_redis.Pool.create(
+                host=settings.RT_REDIS_HOST,
+                port=settings.RT_REDIS_PORT,
+                db=settings.RT_REDIS_DB,
+                password=settings.RT_REDIS_PASSWORD,
+                poolsize=self._poolsize,
+                loop=self._loop
+            ), loop=self._loop)
+
+        try:
+            return (yield from pool_task)
+        except Exception:
+            # Allow the next call to retry
+            if self._pool_task is pool_task:
+                self._pool_task = None
+            raise
+
+    @coroutine
+    def publish(self, channel, message):
+        pool = yield from self.get_pool()
+        return (yield from pool.publish(channel, message))
+
+    @coroutine
+    def publish_event(self, channel, message):
+        pool = yield from self.get_pool()
+        retention = get_event_retention(channel)
+        if retention:
+            if self._publish_script is None:
+                self._publish_script = yield from pool.register_script(RETAINED_PUBLISH_SCRIPT)
+            reply = yield from self._publish_script.run(
+                keys=[get_stream_key(channel), get_full_channel_name(channel)],
+                args=[str(retention), message]
+            )
+            return (yield from reply.return_value())
+        else:
+            return (yield from pool.publish(get_full_channel_name(channel), message))
+
+    @coroutine
+    def publish_events(self, events):
+        # The commands are issued together, so they are pipelined over the pool's connections
+        return (yield from asyncio.gather(*[
+            self.publish_event(channel, message)
+            for channel, message in events
+        ]))
+
+    @coroutine
+    def create_subscription(self, sub_id):
+        pool = yield from self.get_pool()
+        return bool((yield from pool.setnx(get_subscription_key(sub_id), 'requested')))
+
+    @coroutine
+    def get_subscription_status(self, sub_id):
+        pool = yield from self.get_pool()
+        return (yield from pool.get(get_subscription_key(sub_id)))
+
+    @coroutine
+    def set_subscription_status(self, sub_id, status):
+        pool = yield from self.get_pool()
+        return bool((yield from pool.set(get_subscription_key(sub_id), status)))
+
+    @coroutine
+    def delete_subscription(self, sub_id):
+        pool = yield from self.get_pool()
+        return bool((yield from pool.delete([get_subscription_key(sub_id)])))
+
+    @coroutine
+    def subscriber(self):
+        import asyncio_redis
+        import asyncio_redis.encoders
+
+        conn = yield from asyncio_redis.Connection.create(
+            host=settings.RT_REDIS_HOST,
+            port=settings.RT_REDIS_PORT,
+            db=settings.RT_REDIS_DB,
+            password=settings.RT_REDIS_PASSWORD,
+            # Messages may be binary event envelopes
+            encoder=asyncio_redis.encoders.BytesEncoder(),
+            loop=self._loop
+        )
+        subscription = yield from conn.start_subscribe()
+        return AsyncRedisSubscriber(conn, subscription)
+
+    def close(self):
+        pool_task = self._pool_task
+        self._pool_task = None
+        self._publish_script = None
+        if pool_task is None:
+            return
+        if not pool_task.done():
+            # Still connecting
+            pool_task.cancel()
+        elif not pool_task.cancelled() and not pool_task.exception():
+            pool_task.result().close()
+
+class AsyncRedisSubscriber(AsyncSubscriber):
+    """Subscription over a dedicated asyncio_redis connection, which carries bytes."""
+
+    def __init__(self, conn, subscription):
+        self._conn = conn
+        self._subscription = subscription
+
+    @coroutine
+    def subscribe(self, channel):
+        yield from self._subscription.subscribe([channel.encode('utf-8')])
+
+    @coroutine
+    def unsubscribe(self, channel):
+        yield from self._subscription.unsubscribe([channel.encode('utf-8')])
+
+    @coroutine
+    def next_message(self):
+        reply = yield from self._subscription.next_published()
+        return reply.channel.decode('utf-8'), reply.value
+
+    def close(self):
+        self._conn.close()
@@ -1,24 +1,119 @@
 import asyncio
-import asyncio_redis
+import json
 import aiohttp
 from aiohttp import web
 import django
+import socket
+import time
+from collections import OrderedDict
 from urllib.parse import urlunparse
 
 import logging
 logger = logging.getLogger(__name__)
 
-from django_rt.event import ResourceEvent
-from django_rt.utils import get_cors_headers, get_full_channel_name, verify_resource_view, generate_subscription_id, get_subscription_key, get_django_url
+from django_rt.couriers.asyncio_hub import ClientQueue, SubscriptionHub
+from django_rt.couriers.metrics import Timer, metrics
+from django_rt.couriers.common import ClientConnection, HeartbeatWheel, get_missed_events, get_resume_cookie, load_resume_token, record_write
+from django_rt.brokers import get_broker
+from django_rt.utils import get_cors_headers, is_metrics_client_allowed, get_full_channel_name, verify_resource_view, generate_subscription_id, get_django_url, get_event_retention, get_conflation, get_mux_control_channel, parse_event_id
 from django_rt.resource import NotAnRtResourceError, Resource, ResourceError, ResourceRequest
 from django_rt.settings import settings
-from django_rt.sse import SseEvent, SseHeartbeat
+from django_rt.sse import SseEvent, SseHeartbeat, SseRetry
+
+HEARTBEAT_FRAME = SseHeartbeat().as_utf8()
+
+# Seconds for which the event loop is run on shutdown, for tasks of closed connections to finish
+CLOSE_TASKS_TIMEOUT = 5.0
+
+class MuxStream:
+    """Resource subscriptions multiplexed onto one client queue. Resources sharing a channel cause a single hub
+    subscription, and each event on the channel is delivered once per resource, tagged with its path."""
+
+    def __init__(self, hub, queue, control_channel=None):
+        self.hub = hub
+        self.queue = queue
+        self.control_channel = control_channel
+
+        # Maps resource paths to full channel names, in subscription order
+        self.paths = OrderedDict()
+
+        # Maps full channel names to the list of resource paths subscribed to them
+        self.channels = {}
+
+    @asyncio.coroutine
+    def add(self, path, res, view_class=None):
+        if path in self.paths:
+            yield from self.remove(path)
+
+        chan = get_full_channel_name(res.channel)
+        paths = self.channels.get(chan)
+        if paths is None:
+            conflate, max_rate = get_conflation(res.channel, view_class)
+            yield from self.hub.subscribe(chan, conflate, max_rate, queue=self.queue)
+            paths = self.channels[chan] = []
+        paths.append(path)
+        self.paths[path] = chan
+
+    @asyncio.coroutine
+    def remove(self, path):
+        """Remove a resource subscription. Returns True if the resource was subscribed."""
+        chan = self.paths.pop(path, None)
+        if chan is None:
+            return False
+
+        paths = self.channels[chan]
+        paths.remove(path)
+        if not paths:
+            del self.channels[chan]
+            yield from self.hub.unsubscribe(chan, self.queue)
+        return True
+
+    @asyncio.coroutine
+    def close(self):
+        for chan in list(self.channels):
+            yield from self.hub.unsubscribe(chan, self.queue)
+        self.channels = {}
+        self.paths = OrderedDict()
+        if self.control_channel:
+            yield from self.hub.unsubscribe(self.control_channel, self.queue)
 
 class AsyncioCourier:
     _django_url = None
 
     def __init__(self):
         self._ev_loop = None
+        self._hub = None
+        self._broker = None
+        self._http_session = None
+        self._heartbeats = None
+        self._heartbeat_timer = None
+
+    def create_http_session(self, loop):
+        """Create the long-lived HTTP client session used for all requests to Django. Its connector keeps a bounded
+        pool of keep-alive connections, over TCP or a Unix domain socket."""
+        if self._django_url.scheme == 'http+unix':
+            connector = aiohttp.UnixConnector(path=self._django_url.path,
+                limit=settings.RT_COURIER_DJANGO_MAX_CONNECTIONS,
+                keepalive_timeout=settings.RT_COURIER_DJANGO_KEEPALIVE,
+                loop=loop
+            )
+        else:
+            connector = aiohttp.TCPConnector(
+                limit=settings.RT_COURIER_DJANGO_MAX_CONNECTIONS,
+                keepalive_timeout=settings.RT_COURIER_DJANGO_KEEPALIVE,
+                loop=loop
+            )
+        return aiohttp.ClientSession(connector=connector, loop=loop)
+
+    @asyncio.coroutine
+    def broker_command(self, command):
+        """Wait for a broker coroutine to complete, recording its time and any error in the metrics."""
+        try:
+            with Timer(metrics.handshake_seconds.labels('broker')):
+                return (yield from command)
+        except Exception:
+            metrics.broker_errors.inc()
+            raise
 
     @asyncio.coroutine
     def request_resource(self, path, request, sub_id):
@@ -30,22 +125,39 @@ class AsyncioCourier:
 
         # Build resource URL
         if self._django_url.scheme == 'http+unix':
-            conn = aiohttp.UnixConnector(path=self._django_url.path)
             # aiohttp expects a hostname in the URL, even when requesting over a domain socket; correct host should be present in header
             url = urlunparse(('http', 'unknown', res_req.path, '', '', ''))
         else:
-            conn = None
             url = urlunparse((self._django_url.scheme, self._django_url.netloc, res_req.path, '', '', ''))
 
-        # Make request
+        # Make request over a pooled keep-alive connection
         logger.debug('Requesting subscription from %s%s' % (url,
-            ' over Unix socket %s' % (self._django_url.path,) if conn else '')
-        )
-        resp = yield from aiohttp.post(url,
-            data=res_req.to_json().encode('utf-8'),
-            headers=res_req.get_headers(),
-            connector=conn
+            ' over Unix socket %s' % (self._django_url.path,) if self._django_url.scheme == 'http+unix' else '')
         )
+        for attempt in range(2):
+            try:
+                with Timer(metrics.handshake_seconds.labels('django')):
+                    resp = yield from asyncio.wait_for(
+                        self._http_session.post(url,
+                            data=res_req.to_json().encode('utf-8'),
+                            headers=res_req.get_headers()
+                        ),
+                        settings.RT_COURIER_DJANGO_TIMEOUT
+                    )
+                break
+            except asyncio.TimeoutError:
+                logger.warning('Timed out requesting %s from Django' % (res_req.path,))
+                metrics.django_errors.labels('504').inc()
+                raise ResourceError(504)
+            except (aiohttp.ClientError, ConnectionResetError) as e:
+                if attempt == 0:
+                    # The pooled keep-alive connection may have been closed by Django; retry once on a fresh one
+                    logger.debug('Retrying request for %s after error: %s' % (res_req.path, e))
+                    continue
+                logger.warning('Error requesting %s from Django: %s' % (res_req.path, e))
+                metrics.django_errors.labels('502').inc()
+                raise ResourceError(502)
+
         try:
             if resp.status == 200:
                 # Check returned data has the requested content type
@@ -55,36 +167,116 @@ class AsyncioCourier:
                 res_json = yield from resp.text()
                 return Resource.from_json(res_json)
             else:
+                metrics.django_errors.labels(str(resp.status)).inc()
                 raise ResourceError(resp.status)
         finally:
             # Ensure response is closed
             yield from resp.release()
 
     @asyncio.coroutine
-    def cleanup_request(self, sub_id, redis_conn, redis_subscription):
-        logger.debug('Connection closed; cleaning up')
+    def authorize_resource(self, res_path, request):
+        """Perform the subscription handshake with Django for a resource path, returning the authorized Resource.
+        Throws ResourceError or NotAnRtResourceError if the subscription is denied."""
 
-        # Close existing Redis connection
-        if redis_conn:
-            redis_conn.close()
-
-        # Ensure subscription key is removed
-        if sub_id:
-            # Open new connection (this is necessary as asyncio_redis won't allow the DEL command to run after a subscription)
-            redis_conn = yield from asyncio_redis.Connection.create(
-                host=settings.RT_REDIS_HOST,
-                port=settings.RT_REDIS_PORT,
-                db=settings.RT_REDIS_DB,
-                password=settings.RT_REDIS_PASSWORD
-            )
+        sub_id = None
+        if settings.RT_SIGNED_HANDSHAKE:
+            # Stateless handshake: Django validates the signed, timestamped request without any broker subscription
+            nonce = generate_subscription_id()
+        else:
+            # Create subscription
+            while True:
+                sub_id = generate_subscription_id()
+                result = yield from self.broker_command(self._broker.create_subscription(sub_id))
+                if result:
+                    break
+            logger.debug('Created subscription ID: %s' % (sub_id,))
+            nonce = sub_id
 
-            # Remove key
-            res = yield from redis_conn.delete([get_subscription_key(sub_id)])
-            if res:
-                logger.debug('Removed subscription %s' % (sub_id,))
+        try:
+            res = yield from self.request_resource(res_path, request, nonce)
+
+            if settings.RT_SIGNED_HANDSHAKE:
+                logger.debug('Subscription granted')
+            else:
+                # Check subscription status and change to 'subscribed'
+                sub_status = yield from self.broker_command(self._broker.get_subscription_status(sub_id))
+                assert sub_status == 'granted'
+                logger.debug('Subscription granted')
+                result = yield from self.broker_command(self._broker.set_subscription_status(sub_id, 'subscribed'))
+                if result:
+                    logger.debug('Subscription %s status changed to "subscribed"' % (sub_id,))
+        finally:
+            # Delete subscription (not currently used for anything else)
+            if sub_id:
+                deleted = yield from self.broker_command(self._broker.delete_subscription(sub_id))
+                if deleted:
+                    logger.debug('Removed subscription %s' % (sub_id,))
+
+        return res
+
+    @asyncio.coroutine
+    def authorize_resources(self, paths, request):
+        """Authorize several resource paths in parallel. Returns a list of (path, Resource, view class) tuples for the
+        granted resources, and a dict mapping each denied path to an HTTP status."""
+
+        @asyncio.coroutine
+        def authorize(path):
+            if not path.startswith('/'):
+                raise ResourceError(400)
+            try:
+                with Timer(metrics.handshake_seconds.labels('verify')):
+                    view_class = verify_resource_view(path)
+            except NotAnRtResourceError:
+                raise ResourceError(406)
+            res = yield from self.authorize_resource(path, request)
+            return res, view_class
+
+        results = yield from asyncio.gather(*[authorize(path) for path in paths],
+            loop=self._ev_loop,
+            return_exceptions=True
+        )
+
+        granted = []
+        denied = {}
+        for path, result in zip(paths, results):
+            if isinstance(result, NotAnRtResourceError):
+                denied[path] = 406
+            elif isinstance(result, ResourceError):
+                denied[path] = result.status
+            elif isinstance(result, Exception):
+                raise result
+            else:
+                granted.append((path, result[0], result[1]))
+
+        if denied:
+            logger.debug('Subscriptions denied: %s' % (denied,))
+        return granted, denied
+
+    @staticmethod
+    def send_heartbeat(conn):
+        if isinstance(conn.response, web.WebSocketResponse):
+            # WebSocket clients get a ping frame, and are closed if nothing (not even a pong) was heard from them
+            # for two heartbeat intervals
+            if time.monotonic() - conn.last_read > 2 * settings.RT_SSE_HEARTBEAT:
+                logger.debug('WebSocket client not responding; closing')
+                asyncio.ensure_future(conn.response.close())
+            else:
+                conn.response.ping()
+        else:
+            conn.response.write(HEARTBEAT_FRAME)
+
+    def _heartbeat_tick(self):
+        # Send heartbeats to idle connections, once per tick for the whole process
+        self._heartbeats.tick()
+        self._heartbeat_timer = self._ev_loop.call_later(settings.RT_SSE_HEARTBEAT_TICK, self._heartbeat_tick)
+
+    @asyncio.coroutine
+    def cleanup_request(self, channel, queue):
+        logger.debug('Connection closed; cleaning up')
 
-            # Close connection
-            redis_conn.close()
+        # Release channel subscription
+        if queue:
+            yield from self._hub.unsubscribe(channel, queue)
 
     @asyncio.coroutine
     def handle_sse(self, request):
@@ -96,14 +288,15 @@ class AsyncioCourier:
         if suffix.endswith('/'):
             res_path += '/'
 
-        redis_conn = None
-        redis_subscription = None
-        sub_id = None
+        chan = None
+        queue = None
+        conn = None
         try:
             # Check route is a Django-RT resource
             try:
                 logger.debug('Verifying %s is an RT resource' % (res_path,))
-                verify_resource_view(res_path)
+                with Timer(metrics.handshake_seconds.labels('verify')):
+                    view_class = verify_resource_view(res_path)
             except NotAnRtResourceError:
                 logger.debug('Not an RT resource; aborting')
                 return web.Response(status=406)
@@ -111,50 +304,153 @@ class AsyncioCourier:
                 logger.debug('Caught ResourceError; aborting')
                 return web.Response(status=e.status)
 
-            # Connect to Redis server
-            redis_conn = yield from asyncio_redis.Connection.create(
-                host=settings.RT_REDIS_HOST,
-                port=settings.RT_REDIS_PORT,
-                db=settings.RT_REDIS_DB,
-                password=settings.RT_REDIS_PASSWORD
-            )
+            # Resume a recent subscription without asking Django, if the client holds a valid resume token
+            res = load_resume_token(request.cookies.get(settings.RT_RESUME_COOKIE_NAME), res_path)
+            resume_cookie = None
+            if res:
+                logger.debug('Resuming subscription for %s' % (res_path,))
+            else:
+                # Request resource from Django API
+                try:
+                    logger.debug('Requesting subscription for %s' % (res_path,))
+                    res = yield from self.authorize_resource(res_path, request)
+                except NotAnRtResourceError:
+                    logger.debug("Subscription denied: not an rt resource. This shouldn't happen...")
+                    return web.Response(status=406)
+                except ResourceError as e:
+                    logger.debug('Subscription denied: HTTP error %d' % (e.status,))
+                    return web.Response(status=e.status)
+
+                if settings.RT_RESUME_TOKEN_TTL:
+                    resume_cookie = get_resume_cookie(res, request.path)
+
+            # Subscribe to broker channel through the shared subscription hub
+            chan = get_full_channel_name(res.channel)
+            conflate, max_rate = get_conflation(res.channel, view_class)
+            queue = yield from self._hub.subscribe(chan, conflate, max_rate)
 
-            # Create subscription
+            # Prepare response
+            response = web.StreamResponse()
+            response.content_type = 'text/event-stream'
+            if resume_cookie:
+                response.headers['Set-Cookie'] = resume_cookie
+            cors_hdrs = get_cors_headers(request.headers.get('Origin', None))
+            response.headers.update(cors_hdrs)
+            yield from response.prepare(request)
+
+            # Send 'retry' field as a prelude frame
+            if settings.RT_SSE_RETRY:
+                response.write(SseRetry(settings.RT_SSE_RETRY).as_utf8())
+
+            # Register connection for heartbeats
+            conn = ClientConnection(queue, response, chan)
+            if self._heartbeats:
+                self._heartbeats.add(conn)
+            metrics.connections.labels(conn.transport).inc()
+
+            # Replay events missed since the client's last event, if the channel retains them, or send the 'rt-reset'
+            # event standing in for too many of them. This happens after subscribing, so nothing is lost in between;
+            # queued events which were also replayed (or reset) are skipped below.
+            last_event_id = request.headers.get('Last-Event-ID', None)
+            if last_event_id and parse_event_id(last_event_id) and get_event_retention(res.channel):
+                logger.debug('Replaying events after %s' % (last_event_id,))
+                missed = yield from self._ev_loop.run_in_executor(None,
+                    get_missed_events, get_broker(), res.channel, last_event_id
+                )
+                for event in missed:
+                    response.write(event.frame)
+                    record_write(event, len(event.frame))
+                if missed:
+                    conn.replayed_id = parse_event_id(missed[-1].id)
+                    conn.last_write = time.monotonic()
+                    yield from response.drain()
+
+            # Loop
             while True:
-                sub_id = generate_subscription_id()
-                result = yield from redis_conn.setnx(get_subscription_key(sub_id), 'requested')
-                if result:
+                # Wait for event on channel; heartbeats are written by the heartbeat wheel while idle
+                event = yield from queue.get()
+                if event is None:
+                    # Subscription terminated by the hub, or client too slow to keep up
+                    if queue.overflowed:
+                        response.write(SseRetry(settings.RT_SEND_QUEUE_RETRY).as_utf8())
                     break
-            logger.debug('Created subscription ID: %s' % (sub_id,))
+                if event.is_before(conn.replayed_id) or queue.is_stale(event):
+                    continue
+
+                # Send pre-encoded SSE event to client
+                response.write(event.frame)
+                record_write(event, len(event.frame))
+                conn.last_write = time.monotonic()
+                yield from response.drain()
+
+            yield from response.write_eof()
+            return response
+        finally:
+            # Cleanup
+            if conn:
+                metrics.connections.labels(conn.transport).dec()
+                if self._heartbeats:
+                    self._heartbeats.remove(conn)
+            asyncio.ensure_future(self.cleanup_request(chan, queue))
+
+    @staticmethod
+    def get_mux_status_frame(**data):
+        return SseEvent(event='rt-mux', data=json.dumps(data)).as_utf8()
 
-            # Request resource from Django API
+    @asyncio.coroutine
+    def apply_mux_control(self, mux, message):
+        """Apply subscription changes published by handle_mux_control() to a multiplexed stream. Returns the
+        subscribed and unsubscribed resource paths."""
+        data = json.loads(message)
+
+        unsubscribed = []
+        for path in data.get('unsubscribe', []):
+            if (yield from mux.remove(path)):
+                unsubscribed.append(path)
+
+        subscribed = []
+        for path, res_data in data.get('subscribe', []):
+            if path not in mux.paths and len(mux.paths) >= settings.RT_MUX_MAX_RESOURCES:
+                logger.warning('Multiplexed stream is at RT_MUX_MAX_RESOURCES; not subscribing to %s' % (path,))
+                continue
             try:
-                logger.debug('Requesting subscription for %s' % (res_path,))
-                res = yield from self.request_resource(res_path, request, sub_id)
-            except NotAnRtResourceError:
-                logger.debug("Subscription denied: not an rt resource. This shouldn't happen...")
-                return web.Response(status=406)
-            except ResourceError as e:
-                logger.debug('Subscription denied: HTTP error %d' % (e.status,))
-                return web.Response(status=e.status)
+                view_class = verify_resource_view(path)
+            except (NotAnRtResourceError, ResourceError):
+                continue
+            yield from mux.add(path, Resource.deserialize(res_data), view_class)
+            subscribed.append(path)
 
-            # Check subscription status and change to 'subscribed'
-            sub_key = get_subscription_key(sub_id)
-            sub_status = yield from redis_conn.get(sub_key)
-            assert sub_status == 'granted'
-            logger.debug('Subscription granted')
-            result = yield from redis_conn.set(sub_key, 'subscribed')
-            if result:
-                logger.debug('Subscription %s status changed to "subscribed"' % (sub_id,))
+        return subscribed, unsubscribed
 
-            # Delete subscription key (not currently used for anything else)
-            yield from redis_conn.delete([sub_key])
+    @asyncio.coroutine
+    def handle_mux_sse(self, request):
+        """Stream events from several resources over one SSE connection. Resource paths are given by 'resource'
+        query parameters, and are authorized in parallel. Events are sent as JSON objects tagged with their resource
+        path: {"resource": path, "event": event}.
+
+        The stream starts with an 'rt-mux' event giving its stream ID and the subscribed and denied paths.
+        Subscriptions can be changed without reconnecting by POSTing to /_rt/mux/<stream ID> (see
+        handle_mux_control()); changes are confirmed by further 'rt-mux' events."""
+        paths = list(OrderedDict.fromkeys(request.GET.getall('resource', [])))
+        if len(paths) > settings.RT_MUX_MAX_RESOURCES:
+            return web.Response(status=400)
+
+        stream_id = generate_subscription_id()
+        control_chan = get_mux_control_channel(stream_id)
+
+        mux = None
+        conn = None
+        try:
+            # Request resources from Django API
+            granted, denied = yield from self.authorize_resources(paths, request)
+            if paths and not granted:
+                return web.Response(status=denied[paths[0]])
 
-            # Subscribe to Redis channel
-            chan = get_full_channel_name(res.channel)
-            logger.debug('Subscribing to Redis channel %s' % (chan,))
-            redis_subscription = yield from redis_conn.start_subscribe()
-            yield from redis_subscription.subscribe([ chan ])
+            # Subscribe to the stream's control channel and each resource's channel, all on one queue
+            queue = yield from self._hub.subscribe(control_chan, control=True)
+            mux = MuxStream(self._hub, queue, control_chan)
+            for path, res, view_class in granted:
+                yield from mux.add(path, res, view_class)
 
             # Prepare response
             response = web.StreamResponse()
@@ -163,48 +459,248 @@ class AsyncioCourier:
             response.headers.update(cors_hdrs)
             yield from response.prepare(request)
 
+            # Send 'retry' field and stream status as prelude frames
+            if settings.RT_SSE_RETRY:
+                response.write(SseRetry(settings.RT_SSE_RETRY).as_utf8())
+            response.write(self.get_mux_status_frame(stream=stream_id, subscribed=list(mux.paths), denied=denied))
+
+            # Register connection for heartbeats
+            conn = ClientConnection(queue, response, transport='mux')
+            if self._heartbeats:
+                self._heartbeats.add(conn)
+            metrics.connections.labels(conn.transport).inc()
+
             # Loop
-            first_event = True
             while True:
-                # Wait for event on channel
-                try:
-                    reply = yield from asyncio.wait_for(
-                        redis_subscription.next_published(),
-                        settings.RT_SSE_HEARTBEAT
-                    )
-                except asyncio.TimeoutError:
-                    # Timeout, send SSE heartbeat
-                    response.write(SseHeartbeat().as_utf8()) 
-                    yield from response.drain()
-                else:
-                    # Deserialize ResourceEvent
-                    event = ResourceEvent.from_json(reply.value)
-
-                    # Create SSE event
-                    sse_evt = SseEvent.from_resource_event(event)
+                event = yield from queue.get()
+                if event is None:
+                    # Subscription terminated by the hub, or client too slow to keep up
+                    if queue.overflowed:
+                        response.write(SseRetry(settings.RT_SEND_QUEUE_RETRY).as_utf8())
+                    break
 
-                    # Send 'retry' field on first SSE event delivered
-                    if first_event:
-                        sse_evt.retry = settings.RT_SSE_RETRY
-                        first_event = False
+                if event.channel == control_chan:
+                    # Subscription change
+                    try:
+                        subscribed, unsubscribed = yield from self.apply_mux_control(mux, event.event_json)
+                    except (ValueError, TypeError, KeyError):
+                        logger.warning('Discarding malformed control message for multiplexed stream %s' % (stream_id,))
+                        continue
+                    response.write(self.get_mux_status_frame(subscribed=subscribed, unsubscribed=unsubscribed))
+                elif queue.is_stale(event):
+                    continue
+                else:
+                    # Send pre-encoded event once for each resource on its channel
+                    for path in mux.channels.get(event.channel, ()):
+                        frame = event.get_mux_frame(path)
+                        response.write(frame)
+                        record_write(event, len(frame))
 
-                    # Send SSE event to client
-                    response.write(sse_evt.as_utf8())
-                    yield from response.drain()
+                conn.last_write = time.monotonic()
+                yield from response.drain()
 
             yield from response.write_eof()
             return response
         finally:
             # Cleanup
-            asyncio.async(self.cleanup_request(sub_id, redis_conn, redis_subscription))
+            if conn:
+                metrics.connections.labels(conn.transport).dec()
+                if self._heartbeats:
+                    self._heartbeats.remove(conn)
+            if mux:
+                asyncio.ensure_future(mux.close())
+
+    @asyncio.coroutine
+    def handle_mux_control(self, request):
+        """Change the subscriptions of a multiplexed stream. The request body is a JSON object with optional
+        'subscribe' and 'unsubscribe' lists of resource paths. New resources are authorized with this request's
+        headers, then the changes are published to the stream's control channel, so they reach the stream whichever
+        courier process holds it. Responds with the subscribed and denied paths, or 404 if no stream is listening."""
+        stream_id = request.match_info.get('stream')
+        cors_hdrs = get_cors_headers(request.headers.get('Origin', None))
+
+        try:
+            body = yield from request.json()
+            subscribe = list(OrderedDict.fromkeys(body.get('subscribe', [])))
+            unsubscribe = list(body.get('unsubscribe', []))
+            assert all(isinstance(path, str) for path in subscribe + unsubscribe)
+        except (ValueError, AttributeError, TypeError, AssertionError):
+            return web.Response(status=400, headers=cors_hdrs)
+        if len(subscribe) > settings.RT_MUX_MAX_RESOURCES:
+            return web.Response(status=400, headers=cors_hdrs)
+
+        # Request new resources from Django API
+        granted, denied = yield from self.authorize_resources(subscribe, request)
+
+        # Publish changes to the stream
+        message = json.dumps({
+            'subscribe': [[path, res.serialize()] for path, res, view_class in granted],
+            'unsubscribe': unsubscribe,
+        })
+        receivers = yield from self.broker_command(self._broker.publish(get_mux_control_channel(stream_id), message))
+        if not receivers:
+            return web.Response(status=404, headers=cors_hdrs)
+
+        hdrs = {'Content-Type': 'application/json'}
+        hdrs.update(cors_hdrs)
+        return web.Response(
+            body=json.dumps({'subscribed': [path for path, res, view_class in granted], 'denied': denied}).encode('utf-8'),
+            headers=hdrs
+        )
+
+    @asyncio.coroutine
+    def handle_mux_preflight(self, request):
+        """Answer the CORS preflight request browsers send before a cross-origin handle_mux_control() POST."""
+        hdrs = get_cors_headers(request.headers.get('Origin', None))
+        if hdrs:
+            hdrs['Access-Control-Allow-Methods'] = 'POST'
+            hdrs['Access-Control-Allow-Headers'] = request.headers.get('Access-Control-Request-Headers', 'Content-Type')
+        return web.Response(status=200, headers=hdrs)
+
+    @asyncio.coroutine
+    def ws_subscribe(self, ws, mux, request, subscribe=(), unsubscribe=()):
+        """Apply a WebSocket client's subscription changes, and send it a control message with the result."""
+        unsubscribed = []
+        for path in unsubscribe:
+            if (yield from mux.remove(path)):
+                unsubscribed.append(path)
+
+        subscribe = [path for path in OrderedDict.fromkeys(subscribe) if path not in mux.paths]
+        if len(mux.paths) + len(subscribe) > settings.RT_MUX_MAX_RESOURCES:
+            ws.send_str(json.dumps({'unsubscribed': unsubscribed, 'error': 'Too many resources'}))
+            return
+
+        # Request new resources from Django API, with the headers of the WebSocket handshake
+        granted, denied = yield from self.authorize_resources(subscribe, request)
+        for path, res, view_class in granted:
+            yield from mux.add(path, res, view_class)
+
+        ws.send_str(json.dumps({
+            'subscribed': [path for path, res, view_class in granted],
+            'unsubscribed': unsubscribed,
+            'denied': denied,
+        }))
+
+    @asyncio.coroutine
+    def ws_write(self, ws, conn, mux, binary):
+        """Write queued events to a WebSocket client until its subscriptions are terminated."""
+        queue = conn.queue
+        while True:
+            event = yield from queue.get()
+            if event is None:
+                # Subscription terminated by the hub, or client too slow to keep up
+                if queue.overflowed:
+                    # 1013: try again later
+                    yield from ws.close(code=1013, message=str(settings.RT_SEND_QUEUE_RETRY).encode('utf-8'))
+                else:
+                    yield from ws.close()
+                break
+            if queue.is_stale(event):
+                continue
+
+            # Send pre-encoded event once for each resource on its channel
+            for path in mux.channels.get(event.channel, ()):
+                payload = event.get_ws_payload(path, binary)
+                if binary:
+                    ws.send_bytes(payload)
+                else:
+                    ws.send_str(payload)
+                record_write(event, len(payload))
+            conn.last_write = time.monotonic()
+            yield from ws.drain()
+
+    @asyncio.coroutine
+    def handle_ws(self, request):
+        """Stream events from any number of resources over a WebSocket. Initial resource paths may be given by
+        'resource' query parameters; the client can then send JSON text messages with optional 'subscribe' and
+        'unsubscribe' lists of resource paths. Each change is answered by a JSON object listing the subscribed,
+        unsubscribed and denied paths.
+
+        Events are sent as compact JSON arrays of resource path and event: ["/path/", {...}]. With the 'binary=1'
+        query parameter they are sent in binary frames (UTF-8 JSON) instead of text frames. The server pings idle
+        clients every RT_SSE_HEARTBEAT seconds. A client which falls too far behind under the 'disconnect' queue
+        policy is closed with code 1013, and RT_SEND_QUEUE_RETRY as the close reason."""
+        ws = web.WebSocketResponse(autoping=False)
+        yield from ws.prepare(request)
+
+        binary = request.GET.get('binary', '') in ('1', 'true')
+        queue = ClientQueue(loop=self._ev_loop)
+        mux = MuxStream(self._hub, queue)
+        conn = ClientConnection(queue, ws, transport='ws')
+        writer = None
+        try:
+            paths = request.GET.getall('resource', [])
+            if paths:
+                yield from self.ws_subscribe(ws, mux, request, subscribe=paths)
+
+            if self._heartbeats:
+                self._heartbeats.add(conn)
+            metrics.connections.labels(conn.transport).inc()
+            writer = asyncio.ensure_future(self.ws_write(ws, conn, mux, binary), loop=self._ev_loop)
+
+            # Read control messages until the client goes away
+            while True:
+                msg = yield from ws.receive()
+                conn.last_read = time.monotonic()
+                if msg.tp == aiohttp.MsgType.text:
+                    try:
+                        data = json.loads(msg.data)
+                        subscribe = list(data.get('subscribe', []))
+                        unsubscribe = list(data.get('unsubscribe', []))
+                        assert all(isinstance(path, str) for path in subscribe + unsubscribe)
+                    except (ValueError, AttributeError, TypeError, AssertionError):
+                        ws.send_str(json.dumps({'error': 'Malformed message'}))
+                        continue
+                    yield from self.ws_subscribe(ws, mux, request, subscribe, unsubscribe)
+                elif msg.tp == aiohttp.MsgType.ping:
+                    ws.pong(msg.data)
+                elif msg.tp == aiohttp.MsgType.pong:
+                    pass
+                else:
+                    # Closed, or error
+                    break
+
+            return ws
+        finally:
+            # Cleanup
+            logger.debug('WebSocket closed; cleaning up')
+            if writer:
+                writer.cancel()
+                metrics.connections.labels(conn.transport).dec()
+            if self._heartbeats:
+                self._heartbeats.remove(conn)
+            asyncio.ensure_future(mux.close())
+            if not ws.closed:
+                asyncio.ensure_future(ws.close())
+
+    @asyncio.coroutine
+    def handle_metrics(self, request):
+        peername = request.transport.get_extra_info('peername') if request.transport else None
+        addr = peername[0] if isinstance(peername, tuple) else None
+        if not is_metrics_client_allowed(addr):
+            return web.Response(status=403)
+
+        return web.Response(
+            body=metrics.render(self._hub).encode('utf-8'),
+            headers={'Content-Type': metrics.CONTENT_TYPE}
+        )
 
     def create_app(self, loop):
         app = web.Application(loop=loop)
+        # Multiplexed stream routes must be matched before resource routes
+        app.router.add_route('GET', r'/_rt/mux.sse', self.handle_mux_sse)
+        app.router.add_route('POST', r'/_rt/mux/{stream:[0-9a-f]+}', self.handle_mux_control)
+        app.router.add_route('OPTIONS', r'/_rt/mux/{stream:[0-9a-f]+}', self.handle_mux_preflight)
+        app.router.add_route('GET', r'/_rt/ws', self.handle_ws)
+        if settings.RT_COURIER_METRICS:
+            app.router.add_route('GET', r'/metrics', self.handle_metrics)
         app.router.add_route('GET', r'/{resource:.+}{suffix:\.sse/?}', self.handle_sse)
         return app
 
-    def run(self, addr=None, port=None, unix_socket=None, django_url=None):
-        assert (addr and port) or unix_socket
+    def run(self, addr=None, port=None, unix_socket=None, django_url=None, sock=None):
+        """Run the server until stopped. Listens on a TCP address and port, a Unix domain socket, or an already
+        bound listening socket (sock), e.g. one inherited from a supervisor process."""
+        assert (addr and port) or unix_socket or sock
 
         self._django_url = get_django_url(django_url)
 
@@ -218,7 +714,13 @@ class AsyncioCourier:
         loop = asyncio.get_event_loop()
         app = self.create_app(loop)
         handler = app.make_handler()
-        if unix_socket:
+        if sock:
+            if sock.family == socket.AF_UNIX:
+                f = loop.create_unix_server(handler, sock=sock)
+            else:
+                f = loop.create_server(handler, sock=sock)
+            listen_str = str(sock.getsockname())
+        elif unix_socket:
             f = loop.create_unix_server(handler, unix_socket)
             listen_str = unix_socket
         else:
@@ -228,6 +730,17 @@ class AsyncioCourier:
         srv = loop.run_until_complete(f)
 
         self._ev_loop = loop
+        # Broker commands shared by all clients; with Redis, they use a pool of RT_COURIER_REDIS_POOL_SIZE connections
+        self._broker = get_broker().get_async(loop, poolsize=settings.RT_COURIER_REDIS_POOL_SIZE)
+        self._hub = SubscriptionHub(self._broker, loop)
+        self._http_session = self.create_http_session(loop)
+        if settings.RT_SSE_HEARTBEAT:
+            self._heartbeats = HeartbeatWheel(settings.RT_SSE_HEARTBEAT, settings.RT_SSE_HEARTBEAT_TICK,
+                self.send_heartbeat
+            )
+            self._heartbeat_timer = loop.call_later(settings.RT_SSE_HEARTBEAT_TICK, self._heartbeat_tick)
+        if settings.RT_COURIER_TRACEMALLOC:
+            metrics.start_memory_tracing(settings.RT_COURIER_TRACEMALLOC)
         try:
             loop.run_forever()
         except KeyboardInterrupt:
@@ -235,13 +748,42 @@ class AsyncioCourier:
         finally:
             # Shutdown
             self._ev_loop = None
+            if self._heartbeat_timer:
+                self._heartbeat_timer.cancel()
+                self._heartbeat_timer = None
             logger.info('Closing connections...')
-            loop.run_until_complete(handler.finish_connections(1.0))
+            loop.run_until_complete(handler.finish_connections(settings.RT_COURIER_SHUTDOWN_TIMEOUT))
             srv.close()
             loop.run_until_complete(srv.wait_closed())
             loop.run_until_complete(app.finish())
+            reader = self._hub.close()
+            if reader:
+                loop.run_until_complete(asyncio.gather(reader, return_exceptions=True))
+            self._hub = None
+            self._heartbeats = None
+            self._http_session.close()
+            self._http_session = None
+            get_broker().close_async(loop)
+            self._broker = None
+            # Let the closed broker and HTTP connections finish their tasks, so none is destroyed while still pending
+            self.finish_tasks(loop)
             loop.close()
 
+    @staticmethod
+    def finish_tasks(loop):
+        """Run the event loop until its remaining tasks are done, cancelling any still running after
+        CLOSE_TASKS_TIMEOUT seconds."""
+        all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+        tasks = [task for task in all_tasks(loop) if not task.done()]
+        if not tasks:
+            return
+
+        done, pending = loop.run_until_complete(asyncio.wait(tasks, timeout=CLOSE_TASKS_TIMEOUT))
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+
     def stop(self):
         # Stop event loop from running
         if self._ev_loop:
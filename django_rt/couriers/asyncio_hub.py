@@ -0,0 +1,201 @@
+import asyncio
+
+import logging
+logger = logging.getLogger(__name__)
+
+from django_rt.couriers.metrics import metrics
+from django_rt.couriers.common import ChannelConflator, ChannelEvent, SendQueueMixin
+
+class ClientQueue(SendQueueMixin, asyncio.Queue):
+    """Bounded queue of ChannelEvents waiting to be written to one client."""
+
+    def _get(self):
+        # Called by both get() and get_nowait()
+        item = super()._get()
+        self._taken(item)
+        return item
+
+class SubscriptionHub:
+    """Process-wide broker subscription shared by all clients of an asyncio courier.
+
+    A single broker AsyncSubscriber is held for the whole process. Channel subscriptions are reference counted: the
+    first client on a channel subscribes to it at the broker, and the last client to leave unsubscribes. Each message
+    received from the broker is encoded into an SSE frame once, and the same ChannelEvent
+    is dispatched to the queues of all local clients subscribed to its channel. On conflated channels, only the
+    newest events are held and dispatched at the channel's maximum flush rate.
+    """
+
+    def __init__(self, broker, loop=None):
+        self._broker = broker
+        self._loop = loop or asyncio.get_event_loop()
+        self._lock = asyncio.Lock(loop=self._loop)
+        self._subscriber = None
+        self._reader = None
+
+        # Maps full broker channel names to the set of client queues subscribed to them
+        self._channels = {}
+
+        # Maps full broker channel names of conflated channels to their ChannelConflator
+        self._conflators = {}
+
+        # Channels carrying control messages for this courier's clients rather than events
+        self._control_channels = set()
+
+    @asyncio.coroutine
+    def _connect(self):
+        logger.debug('Opening shared broker subscriber')
+        self._subscriber = yield from self._broker.subscriber()
+        self._reader = asyncio.ensure_future(self._read_loop(), loop=self._loop)
+
+    @asyncio.coroutine
+    def _read_loop(self):
+        try:
+            while True:
+                channel, message = yield from self._subscriber.next_message()
+                queues = self._channels.get(channel)
+                if not queues:
+                    continue
+
+                if channel in self._control_channels:
+                    # Control messages are never dropped by the queue policy
+                    event = ChannelEvent.control(channel, message.decode('utf-8'))
+                    for queue in queues:
+                        queue.put_nowait(event)
+                    continue
+
+                # Encode SSE frame once for all subscribers
+                metrics.events_received.inc()
+                conflator = self._conflators.get(channel)
+                try:
+                    event = ChannelEvent.from_message(message, channel, conflator and conflator.mode)
+                except (ValueError, KeyError, AssertionError):
+                    metrics.events_malformed.inc()
+                    logger.warning('Discarding malformed event on broker channel %s' % (channel,))
+                    continue
+
+                if conflator:
+                    if conflator.add(event):
+                        conflator.timer = self._loop.call_later(conflator.get_delay(self._loop.time()),
+                            self._flush, channel
+                        )
+                else:
+                    for queue in queues:
+                        queue.offer(event)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            metrics.broker_errors.inc()
+            logger.exception('Shared broker subscriber failed; disconnecting clients')
+            self._reset()
+
+    def _flush(self, channel):
+        """Dispatch the events held for a conflated channel."""
+        conflator = self._conflators.get(channel)
+        if not conflator:
+            return
+
+        events = conflator.take(self._loop.time())
+        for queue in self._channels.get(channel, ()):
+            for event in events:
+                queue.offer(event)
+
+    def _remove_conflator(self, channel):
+        conflator = self._conflators.pop(channel, None)
+        if conflator and conflator.timer:
+            conflator.timer.cancel()
+
+    def _reset(self):
+        """Drop the subscriber connection and tell every client queue that the subscription has ended."""
+        for queues in self._channels.values():
+            for queue in queues:
+                queue.put_nowait(None)
+        self._channels = {}
+        self._control_channels = set()
+        for channel in list(self._conflators):
+            self._remove_conflator(channel)
+
+        if self._subscriber:
+            self._subscriber.close()
+        self._subscriber = None
+        self._reader = None
+
+    @property
+    def channel_count(self):
+        return len(self._channels)
+
+    def get_stats(self):
+        """Return the number of client subscriptions per channel, and the events and bytes waiting in client queues."""
+        queues = set(queue for queues in self._channels.values() for queue in queues)
+        return {
+            'channels': {channel: len(queues) for channel, queues in self._channels.items() if channel not in self._control_channels},
+            'queued_events': sum(queue.qsize() for queue in queues),
+            'queued_bytes': sum(queue.buffered_bytes for queue in queues),
+        }
+
+    @property
+    def buffered_bytes(self):
+        """Total bytes of encoded frames waiting in client queues."""
+        queues = set(queue for queues in self._channels.values() for queue in queues)
+        return sum(queue.buffered_bytes for queue in queues)
+
+    @asyncio.coroutine
+    def subscribe(self, channel, conflate=None, max_rate=None, queue=None, control=False):
+        """Subscribe to a broker channel. Returns a ClientQueue which receives a ChannelEvent for each message
+        published to the channel, or None if the subscription is terminated by the hub or the queue overflows.
+
+        If conflate is set (see get_conflation()), the channel is conflated with the given maximum flush rate. The
+        first subscriber to a channel decides whether it is conflated.
+
+        An existing queue may be passed to receive events from several channels on one queue. Messages on control
+        channels are queued as they are, with ChannelEvent.control()."""
+        if queue is None:
+            queue = ClientQueue(loop=self._loop)
+
+        with (yield from self._lock):
+            while True:
+                if not self._subscriber:
+                    yield from self._connect()
+                subscriber = self._subscriber
+
+                queues = self._channels.get(channel)
+                if queues is None:
+                    logger.debug('Subscribing to broker channel %s' % (channel,))
+                    yield from subscriber.subscribe(channel)
+                    if self._subscriber is not subscriber:
+                        # The subscriber failed and was reset while subscribing; reconnect and subscribe again
+                        continue
+
+                    queues = self._channels[channel] = set()
+                    if control:
+                        self._control_channels.add(channel)
+                    elif conflate:
+                        self._conflators[channel] = ChannelConflator(conflate, max_rate)
+                queues.add(queue)
+                break
+
+        return queue
+
+    @asyncio.coroutine
+    def unsubscribe(self, channel, queue):
+        """Remove a client queue returned by subscribe()."""
+        with (yield from self._lock):
+            queues = self._channels.get(channel)
+            if not queues or queue not in queues:
+                return
+
+            queues.remove(queue)
+            if not queues:
+                del self._channels[channel]
+                self._control_channels.discard(channel)
+                self._remove_conflator(channel)
+                logger.debug('Unsubscribing from broker channel %s' % (channel,))
+                yield from self._subscriber.unsubscribe(channel)
+
+    def close(self):
+        """Close the shared subscriber. Returns the cancelled reader task, if any, which must be left to finish before
+        the event loop is closed."""
+        reader = self._reader
+        if reader:
+            reader.cancel()
+        self._reset()
+        return reader
@@ -0,0 +1,434 @@
+import json
+import math
+import random
+import time
+from collections import OrderedDict
+from http.cookies import SimpleCookie
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.core.signing import BadSignature
+from django.dispatch import receiver
+
+import logging
+logger = logging.getLogger(__name__)
+trace_logger = logging.getLogger('django_rt.couriers.trace')
+
+from django_rt.event import get_event_header
+from django_rt.resource import Resource
+from django_rt.settings import settings
+from django_rt.couriers.metrics import metrics
+from django_rt.envelope import is_envelope, unpack_envelope
+from django_rt.sse import encode_mux_event, encode_raw_event
+from django_rt.utils import CONFLATE_EVENT_TYPE, get_channel_setting, get_full_channel_name, parse_event_id, split_published_message
+
+def decode_event(body):
+    """Return the event type, JSON and publish timestamp (None if not stamped) of a serialized ResourceEvent received
+    from the broker, as JSON (str or bytes) or a binary envelope. Envelopes carry the event type and timestamp in their
+    header, so their payload is not parsed."""
+    if is_envelope(body):
+        event_type, timestamp, seq, payload = unpack_envelope(body)
+        return event_type, payload.decode('utf-8'), timestamp / 1000000 if timestamp else None
+
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    event_type, published = get_event_header(body)
+    return event_type, body, published
+
+class DeliveryLatency:
+    """Delivery latency histograms of the channels sharing a label from RT_LATENCY_CHANNEL_PREFIXES."""
+    __slots__ = ('label', 'received', 'written', 'trace_rate')
+
+    def __init__(self, label):
+        self.label = label
+        self.received = metrics.delivery_seconds.labels(label, 'received')
+        self.written = metrics.delivery_seconds.labels(label, 'written')
+        self.trace_rate = settings.RT_LATENCY_TRACE_RATE
+
+_delivery_latencies = {}
+
+def get_delivery_latency(channel):
+    """Return the DeliveryLatency for a full broker channel name. Channels are labelled with the longest matching
+    prefix in RT_LATENCY_CHANNEL_PREFIXES, or '' if none match, which keeps the number of histograms bounded."""
+    latency = _delivery_latencies.get(channel)
+    if latency is None:
+        name = channel[len(get_full_channel_name('')):]
+        prefixes = {prefix: prefix for prefix in settings.RT_LATENCY_CHANNEL_PREFIXES or ()}
+        label = get_channel_setting(prefixes, name, '')
+        latency = _delivery_latencies[channel] = DeliveryLatency(label)
+    return latency
+
+@receiver(setting_changed)
+def _reset_delivery_latencies(setting, **kwargs):
+    if setting.startswith('RT_LATENCY_') or setting == 'RT_PREFIX':
+        _delivery_latencies.clear()
+
+def record_write(event, size):
+    """Record an event frame of the given size, just written to a client, in the metrics. Live events stamped by
+    publish() also record their publish-to-write latency, and a RT_LATENCY_TRACE_RATE fraction of writes is logged."""
+    metrics.events_delivered.inc()
+    metrics.bytes_written.inc(size)
+
+    latency = event.latency
+    if latency is not None:
+        now = time.time()
+        latency.written.observe(max(0.0, now - event.published))
+        if latency.trace_rate and random.random() < latency.trace_rate:
+            trace_logger.info('Event %s on %s: received %.2fms and written %.2fms after publish' % (
+                event.id or '-', event.channel,
+                (event.received - event.published) * 1000, (now - event.published) * 1000
+            ))
+
+class ChannelEvent:
+    """An event received from a broker channel. It is decoded and encoded into an SSE frame once, and the same
+    object is shared by every subscriber of the channel. Events on conflated channels carry a conflation key; a
+    newer event with the same key supersedes older ones.
+
+    Live events stamped by publish() carry their publish timestamp, the time they were received from the broker (both in
+    seconds since the epoch) and the DeliveryLatency of their channel."""
+    __slots__ = ('id', 'frame', 'key', 'channel', 'event_json', 'published', 'received', 'latency', '_mux_frames',
+        '_ws_payloads')
+
+    def __init__(self, id, frame, key=None, channel=None, event_json=None):
+        self.id = id
+        self.frame = frame
+        self.key = key
+        self.channel = channel
+        self.event_json = event_json
+        self.published = self.received = self.latency = None
+        self._mux_frames = None
+        self._ws_payloads = None
+
+    def is_before(self, id_key):
+        """Return True if this event was published at or before the event with the given parsed ID."""
+        if self.id is None or id_key is None:
+            return False
+        return parse_event_id(self.id) <= id_key
+
+    def get_mux_frame(self, resource):
+        """Return the SSE frame for this event tagged with a resource path, for multiplexed streams. Frames are
+        cached per resource path, so they are encoded once for all streams subscribed to that resource."""
+        if self._mux_frames is None:
+            self._mux_frames = {}
+        frame = self._mux_frames.get(resource)
+        if frame is None:
+            frame = self._mux_frames[resource] = encode_mux_event(self.event_json, resource)
+        return frame
+
+    def get_ws_payload(self, resource, binary=False):
+        """Return the WebSocket message payload for this event tagged with a resource path: a JSON array of the path
+        and the event, as a str, or UTF-8 encoded bytes for binary frames. Payloads are cached like mux frames."""
+        if self._ws_payloads is None:
+            self._ws_payloads = {}
+        payload = self._ws_payloads.get((resource, binary))
+        if payload is None:
+            payload = '[' + json.dumps(resource) + ',' + self.event_json + ']'
+            if binary:
+                payload = payload.encode('utf-8')
+            self._ws_payloads[(resource, binary)] = payload
+        return payload
+
+    @classmethod
+    def from_message(cls, message, channel=None, conflate=None):
+        id, body = split_published_message(message)
+        event_type, event_json, published = decode_event(body)
+        if conflate == CONFLATE_EVENT_TYPE:
+            key = (channel, event_type)
+        elif conflate:
+            key = (channel,)
+        else:
+            key = None
+        event = cls(id, encode_raw_event(event_json, event_type, id), key, channel, event_json)
+
+        if published is not None and channel is not None:
+            # Clock adjustments between hosts can make latencies negative; count them as zero
+            event.published = published
+            event.received = time.time()
+            event.latency = get_delivery_latency(channel)
+            event.latency.received.observe(max(0.0, event.received - published))
+        return event
+
+    @classmethod
+    def control(cls, channel, message):
+        """Wrap a control message received on a courier's own channel, which is passed to clients as is."""
+        return cls(None, b'', None, channel, message)
+
+    @property
+    def is_control(self):
+        """True for control messages wrapped by control(), which have no SSE frame."""
+        return not self.frame
+
+class ChannelConflator:
+    """Holds the newest events of a conflated channel between flushes. The subscription hub adds each event received
+    on the channel, and flushes the held events to subscribers at most max_rate times per second."""
+    __slots__ = ('mode', 'interval', 'pending', 'last_flush', 'timer')
+
+    def __init__(self, mode, max_rate=None):
+        self.mode = mode
+        self.interval = 1.0 / max_rate if max_rate else 0.0
+        self.pending = OrderedDict()
+        self.last_flush = None
+
+        # Handle of the scheduled flush, owned by the hub
+        self.timer = None
+
+    def add(self, event):
+        """Hold an event, replacing any held event with the same key. Returns True if a flush should be scheduled."""
+        self.pending.pop(event.key, None)
+        self.pending[event.key] = event
+        return self.timer is None
+
+    def get_delay(self, now):
+        """Return the time to wait before the next flush, in seconds."""
+        if self.last_flush is None:
+            return 0.0
+        return max(0.0, self.last_flush + self.interval - now)
+
+    def take(self, now):
+        """Return the held events, oldest first, and start a new flush interval."""
+        events = list(self.pending.values())
+        self.pending.clear()
+        self.last_flush = now
+        self.timer = None
+        return events
+
+class SendQueueMixin:
+    """Bounded outbound queue behaviour shared by the per-client queues of both couriers.
+
+    The subscription hub calls offer() for each event. Once a client's queue holds RT_SEND_QUEUE_MAX_EVENTS events
+    or RT_SEND_QUEUE_MAX_BYTES bytes of encoded frames, RT_SEND_QUEUE_POLICY decides what happens: 'drop_oldest'
+    discards queued events to make room, 'drop_newest' discards the incoming event, and 'disconnect' empties the
+    queue and ends the subscription with a None item, after which the client is sent a RT_SEND_QUEUE_RETRY hint.
+
+    Subclasses mix this into a framework queue class, and must call _taken() for every item removed from the queue.
+    """
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+    DISCONNECT = 'disconnect'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.max_events = settings.RT_SEND_QUEUE_MAX_EVENTS
+        self.max_bytes = settings.RT_SEND_QUEUE_MAX_BYTES
+        self.policy = settings.RT_SEND_QUEUE_POLICY
+        if self.policy not in (self.DROP_OLDEST, self.DROP_NEWEST, self.DISCONNECT):
+            raise ImproperlyConfigured('Unknown RT_SEND_QUEUE_POLICY "%s"' % (self.policy,))
+
+        # Bytes of encoded frames waiting in the queue
+        self.buffered_bytes = 0
+
+        # Number of events discarded by the overflow policy
+        self.dropped = 0
+
+        # Set when the client is being disconnected by the 'disconnect' policy
+        self.overflowed = False
+
+        # Newest queued event for each conflation key
+        self._latest = {}
+
+    def _is_full(self, size, kept=0):
+        # kept counts items taken off the queue which will be put back
+        if self.max_events and self.qsize() + kept >= self.max_events:
+            return True
+        if self.max_bytes and self.buffered_bytes + size > self.max_bytes:
+            return True
+        return False
+
+    def _taken(self, item):
+        if item is not None:
+            self.buffered_bytes -= len(item.frame)
+            if item.key is not None and self._latest.get(item.key) is item:
+                del self._latest[item.key]
+
+    def is_stale(self, event):
+        """Return True if a newer event with the same conflation key is waiting in the queue, so the client may skip
+        this one."""
+        if event.key is None:
+            return False
+        latest = self._latest.get(event.key)
+        return latest is not None and latest is not event
+
+    def offer(self, event):
+        """Queue an event for the client, applying the overflow policy if the queue is full. Returns True if the
+        event was queued."""
+        if self.overflowed:
+            return False
+
+        size = len(event.frame)
+        if self._is_full(size):
+            if self.policy == self.DISCONNECT:
+                logger.info('Client send queue full (%d events, %d bytes); disconnecting' % (
+                    self.qsize(), self.buffered_bytes
+                ))
+                metrics.clients_evicted.inc()
+                self.overflowed = True
+                while self.qsize():
+                    self.get_nowait()
+                self.put_nowait(None)
+                return False
+
+            if self.policy == self.DROP_OLDEST:
+                # Control messages and the end-of-subscription None are never dropped; they are queued again,
+                # behind the remaining events
+                kept = []
+                while self.qsize() and self._is_full(size, len(kept)):
+                    item = self.get_nowait()
+                    if item is None or item.is_control:
+                        kept.append(item)
+                        continue
+                    self.dropped += 1
+                    metrics.events_dropped.inc()
+                for item in kept:
+                    self.put_nowait(item)
+
+            if self._is_full(size):
+                # Queue is still full under 'drop_oldest' only if this event alone exceeds RT_SEND_QUEUE_MAX_BYTES, or
+                # the queue holds nothing but control messages
+                self.dropped += 1
+                metrics.events_dropped.inc()
+                return False
+
+        self.buffered_bytes += size
+        if event.key is not None:
+            self._latest[event.key] = event
+        self.put_nowait(event)
+        return True
+
+class ClientConnection:
+    """State of one streaming client connection, as tracked by a courier. Couriers keep everything they need about an
+    idle connection here, in one slotted record, so its memory footprint stays small and predictable."""
+    __slots__ = ('transport', 'channel', 'queue', 'response', 'replayed_id', 'last_write', 'last_read')
+
+    def __init__(self, queue, response=None, channel=None, transport='sse'):
+        self.transport = transport
+        self.channel = channel
+        self.queue = queue
+        self.response = response
+
+        # Parsed ID of the last event replayed to the client, if any; queued events up to it are skipped
+        self.replayed_id = None
+
+        # time.monotonic() of the last write to, and last message from, the client
+        self.last_write = self.last_read = time.monotonic()
+
+class HeartbeatWheel:
+    """Hashed timer wheel which sends heartbeats to idle client connections.
+
+    Connections are placed in the wheel slot of their heartbeat deadline (last write time plus the heartbeat
+    interval). Writers only update a connection's last_write time; once per tick the wheel visits the slot which has
+    come due, calls send_heartbeat(conn) for connections which have been idle for the whole interval, and moves the
+    others to the slot of their new deadline. Heartbeats may be sent up to one tick early.
+    """
+
+    def __init__(self, interval, tick, send_heartbeat):
+        self.interval = interval
+        self.tick_length = tick
+        self._send_heartbeat = send_heartbeat
+
+        # Deadlines are never more than one interval ahead, so this many slots never wrap around
+        self._slots = [set() for i in range(int(math.ceil(interval / tick)) + 1)]
+        self._slot_of = {}
+
+        # Last tick number processed
+        self._cursor = self._tick_of(time.monotonic())
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    def _tick_of(self, t):
+        return int(t // self.tick_length)
+
+    def _schedule(self, conn):
+        tick = max(self._tick_of(conn.last_write + self.interval), self._cursor + 1)
+        slot = tick % len(self._slots)
+        self._slots[slot].add(conn)
+        self._slot_of[conn] = slot
+
+    def add(self, conn):
+        self._schedule(conn)
+
+    def remove(self, conn):
+        slot = self._slot_of.pop(conn, None)
+        if slot is not None:
+            self._slots[slot].discard(conn)
+
+    def tick(self, now=None):
+        """Process all slots which have come due. Returns the number of heartbeats sent."""
+        if now is None:
+            now = time.monotonic()
+        current = self._tick_of(now)
+
+        # After a stall, one pass over every slot is enough
+        self._cursor = max(self._cursor, current - len(self._slots))
+
+        sent = 0
+        while self._cursor < current:
+            self._cursor += 1
+            slot = self._slots[self._cursor % len(self._slots)]
+            if not slot:
+                continue
+
+            due = list(slot)
+            slot.clear()
+            for conn in due:
+                del self._slot_of[conn]
+                if self._tick_of(conn.last_write + self.interval) <= self._cursor:
+                    try:
+                        self._send_heartbeat(conn)
+                    except Exception:
+                        logger.exception('Error sending heartbeat; dropping connection from scheduler')
+                        continue
+                    conn.last_write = now
+                    sent += 1
+                self._schedule(conn)
+
+        metrics.heartbeats_sent.inc(sent)
+
+        return sent
+
+# SSE event type sent instead of replaying missed events when they cannot all be replayed
+REPLAY_RESET_EVENT_TYPE = 'rt-reset'
+
+def get_missed_events(broker, channel, last_event_id):
+    """Return the ChannelEvents published to a channel after the given event ID, as retained by the (blocking)
+    broker. If more than RT_REPLAY_MAX_EVENTS events were missed, or the client's last event is no longer retained (so
+    some missed events may have been trimmed), none are replayed; a single 'rt-reset' event is returned instead,
+    telling the client to reload the resource's full state. Its ID is that of the last retained event it stands for,
+    if any, so replayed live events are skipped as usual."""
+    max_events = settings.RT_REPLAY_MAX_EVENTS
+    retained, found = broker.get_events_after(channel, last_event_id, max_events + 1)
+    if not found or len(retained) > max_events:
+        if not found:
+            logger.info('Event %s is no longer retained on %s; sending reset' % (last_event_id, channel))
+        else:
+            logger.info('More than %d events missed on %s after %s; sending reset' % (max_events, channel, last_event_id))
+        id = retained[-1][0] if retained else None
+        return [ChannelEvent(id, encode_raw_event('{}', REPLAY_RESET_EVENT_TYPE, id))]
+
+    events = []
+    for id, message in retained:
+        event_type, event_json, published = decode_event(message)
+        events.append(ChannelEvent(id, encode_raw_event(event_json, event_type, id), event_json=event_json))
+    return events
+
+def load_resume_token(token, path):
+    """Return the Resource bound by a client's resume token for the given path, or None if resume tokens are
+    disabled or the token is missing, invalid or expired."""
+    if not token or not settings.RT_RESUME_TOKEN_TTL:
+        return None
+
+    try:
+        return Resource.from_resume_token(token, path, settings.RT_RESUME_TOKEN_TTL)
+    except BadSignature:
+        return None
+
+def get_resume_cookie(res, request_path):
+    """Return a Set-Cookie header value carrying a resume token for a newly authorized Resource. The cookie is
+    scoped to the SSE request path, so browsers send it back when the stream reconnects."""
+    cookie = SimpleCookie()
+    name = settings.RT_RESUME_COOKIE_NAME
+    cookie[name] = res.get_resume_token()
+    cookie[name]['path'] = request_path
+    cookie[name]['max-age'] = settings.RT_RESUME_TOKEN_TTL
+    cookie[name]['httponly'] = True
+    return cookie[name].OutputString()
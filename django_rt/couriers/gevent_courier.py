@@ -3,24 +3,90 @@ from gevent import monkey
 monkey.patch_all()
 
 import re
+import socket
+import time
 import urllib3
+from urllib3.connection import HTTPConnection
+import gevent
 from gevent.pywsgi import WSGIServer
-import redis
 import django
-from urllib.parse import urlunparse
+from http.cookies import SimpleCookie
 
 import logging
 logger = logging.getLogger(__name__)
 
-from django_rt.event import ResourceEvent
-from django_rt.utils import get_full_channel_name, get_http_status_reason, verify_resource_view, generate_subscription_id, get_subscription_key, get_django_url, get_cors_headers
+from django_rt.brokers import get_broker
+from django_rt.couriers.common import ChannelEvent, ClientConnection, HeartbeatWheel, get_missed_events, get_resume_cookie, load_resume_token, record_write
+from django_rt.couriers.gevent_hub import SubscriptionHub
+from django_rt.couriers.metrics import Timer, metrics
+from django_rt.utils import get_full_channel_name, get_http_status_reason, verify_resource_view, generate_subscription_id, get_django_url, get_cors_headers, is_metrics_client_allowed, get_event_retention, get_conflation, parse_event_id, create_listen_socket
 from django_rt.resource import NotAnRtResourceError, Resource, ResourceError, ResourceRequest
 from django_rt.settings import settings
-from django_rt.sse import SseEvent, SseHeartbeat
+from django_rt.sse import SseHeartbeat, SseRetry
+
+HEARTBEAT_FRAME = SseHeartbeat().as_utf8()
+
+# Queued for idle clients by the heartbeat wheel
+HEARTBEAT_EVENT = ChannelEvent(None, HEARTBEAT_FRAME)
+
+class UnixHTTPConnection(HTTPConnection):
+    """urllib3 HTTP connection over a Unix domain socket."""
+    def __init__(self, *args, socket_path=None, **kwargs):
+        self.socket_path = socket_path
+        super().__init__(*args, **kwargs)
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if isinstance(self.timeout, (int, float)):
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+class UnixHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = UnixHTTPConnection
+
+class ResetRetry(urllib3.Retry):
+    """Retry policy allowing a request to be resent once on a fresh connection, when its pooled keep-alive connection
+    fails to connect or has been reset by Django. urllib3 reports such resets as read errors, so read retries are
+    allowed, but timeouts are raised straight away as with retries disabled."""
+
+    def increment(self, *args, error=None, **kwargs):
+        if isinstance(error, urllib3.exceptions.TimeoutError):
+            raise error
+        return super().increment(*args, error=error, **kwargs)
+
+    @classmethod
+    def once(cls):
+        kwargs = {'total': 1, 'redirect': False}
+        try:
+            # Retry all methods, as the subscription request is a POST; urllib3 < 1.26 calls this method_whitelist
+            return cls(allowed_methods=False, **kwargs)
+        except TypeError:
+            return cls(method_whitelist=False, **kwargs)
 
 class GeventCourier:
     def __init__(self):
         self._wsgi_server = None
+        self._broker = None
+        self._hub = None
+        self._http_pool = None
+        self._heartbeats = None
+        self._heartbeat_greenlet = None
+
+    def create_http_pool(self):
+        """Create the long-lived, bounded pool of keep-alive connections used for all requests to Django, over TCP or a
+        Unix domain socket."""
+        pool_kwargs = {
+            'maxsize': settings.RT_COURIER_DJANGO_MAX_CONNECTIONS,
+            'block': True,
+            'timeout': urllib3.Timeout(total=settings.RT_COURIER_DJANGO_TIMEOUT),
+            'retries': ResetRetry.once(),
+        }
+        if self._django_url.scheme == 'http+unix':
+            # Host is only used for logging; correct host should be present in header
+            return UnixHTTPConnectionPool('localhost', socket_path=self._django_url.path, **pool_kwargs)
+        else:
+            return urllib3.HTTPConnectionPool(self._django_url.hostname, self._django_url.port, **pool_kwargs)
 
     @staticmethod
     def full_status(code):
@@ -30,6 +96,12 @@ class GeventCourier:
         else:
             return str(code)
 
+    @staticmethod
+    def get_cookie(env, name):
+        """Get a cookie value from environment"""
+        cookie = SimpleCookie(env.get('HTTP_COOKIE', ''))
+        return cookie[name].value if name in cookie else None
+
     @staticmethod
     def get_headers(env):
         """Get HTTP headers from environment"""
@@ -43,13 +115,23 @@ class GeventCourier:
         res_req = ResourceRequest(path, 'subscribe',
             sub_id=sub_id
         )
-        url = urlunparse((self._django_url.scheme, self._django_url.netloc, res_req.path, '', '', ''))
         res_req.prepare(client_headers=req_hdrs)
-        http = urllib3.PoolManager()
-        resp = http.urlopen('POST', url,
-            body=res_req.to_json(),
-            headers=res_req.get_headers()
-        )
+
+        # Make request over a pooled keep-alive connection
+        try:
+            with Timer(metrics.handshake_seconds.labels('django')):
+                resp = self._http_pool.urlopen('POST', res_req.path,
+                    body=res_req.to_json(),
+                    headers=res_req.get_headers()
+                )
+        except urllib3.exceptions.TimeoutError:
+            logger.warning('Timed out requesting %s from Django' % (res_req.path,))
+            metrics.django_errors.labels('504').inc()
+            raise ResourceError(504)
+        except urllib3.exceptions.HTTPError as e:
+            logger.warning('Error requesting %s from Django: %s' % (res_req.path, e))
+            metrics.django_errors.labels('502').inc()
+            raise ResourceError(502)
 
         if resp.status == 200:
             # Check returned data has the requested content type
@@ -59,8 +141,67 @@ class GeventCourier:
             res_json = resp.data.decode('utf-8')
             return Resource.from_json(res_json)
         else:
+            metrics.django_errors.labels(str(resp.status)).inc()
             raise ResourceError(resp.status)
 
+    def broker_command(self, name, *args):
+        """Call a method of the broker, recording its time and any error in the metrics."""
+        try:
+            with Timer(metrics.handshake_seconds.labels('broker')):
+                return getattr(self._broker, name)(*args)
+        except Exception:
+            metrics.broker_errors.inc()
+            raise
+
+    def authorize_resource(self, path, req_hdrs):
+        """Perform the subscription handshake with Django for a resource path, returning the authorized Resource.
+        Throws ResourceError or NotAnRtResourceError if the subscription is denied."""
+
+        created = False
+        if settings.RT_SIGNED_HANDSHAKE:
+            # Stateless handshake: Django validates the signed, timestamped request without any broker subscription
+            sub_id = generate_subscription_id()
+        else:
+            # Create subscription
+            while True:
+                sub_id = generate_subscription_id()
+                result = self.broker_command('create_subscription', sub_id)
+                if result:
+                    break
+            logger.debug('Created subscription ID: %s' % (sub_id,))
+            created = True
+
+        try:
+            res = self.request_resource(path, sub_id, req_hdrs)
+
+            if settings.RT_SIGNED_HANDSHAKE:
+                logger.debug('Subscription granted')
+            else:
+                # Check subscription status and change to 'subscribed'
+                sub_status = self.broker_command('get_subscription_status', sub_id)
+                assert sub_status == 'granted'
+                logger.debug('Subscription granted')
+                if self.broker_command('set_subscription_status', sub_id, 'subscribed'):
+                    logger.debug('Subscription %s status changed to "subscribed"' % (sub_id,))
+        finally:
+            # Delete subscription (not currently used for anything else)
+            if created:
+                self.broker_command('delete_subscription', sub_id)
+
+        return res
+
+    @staticmethod
+    def send_heartbeat(conn):
+        # Only idle clients need a heartbeat; the writer greenlet sends it
+        if not conn.queue.qsize():
+            conn.queue.offer(HEARTBEAT_EVENT)
+
+    def run_heartbeats(self):
+        """Send heartbeats to idle connections, once per tick for the whole process."""
+        while True:
+            gevent.sleep(settings.RT_SSE_HEARTBEAT_TICK)
+            self._heartbeats.tick()
+
     def handle_sse(self, path, suffix, env, start_response):
         res_path = path
 
@@ -73,7 +214,8 @@ class GeventCourier:
         # Check route is a Django-RT resource
         try:
             logger.debug('Verifying %s is an RT resource' % (res_path,))
-            verify_resource_view(res_path)
+            with Timer(metrics.handshake_seconds.labels('verify')):
+                view_class = verify_resource_view(res_path)
         except NotAnRtResourceError:
             logger.debug('Not an RT resource; aborting')
             start_response(self.full_status(406), [])
@@ -83,87 +225,110 @@ class GeventCourier:
             start_response(self.full_status(e.status), [])
             return [b'']
 
-        # Connect to Redis server
-        redis_conn = redis.StrictRedis(
-            host=settings.RT_REDIS_HOST,
-            port=settings.RT_REDIS_PORT,
-            db=settings.RT_REDIS_DB,
-            password=settings.RT_REDIS_PASSWORD
-        )
-
-        # Create subscription
-        while True:
-            sub_id = generate_subscription_id()
-            result = redis_conn.setnx(get_subscription_key(sub_id), 'requested')
-            if result:
-                break
-        logger.debug('Created subscription ID: %s' % (sub_id,))
-
-        # Request resource from Django API
-        try:
-            logger.debug('Requesting subscription for %s' % (res_path,))
-            res = self.request_resource(path, sub_id, req_hdrs)
-        except NotAnRtResourceError:
-            logger.debug("Subscription denied: not an rt resource. This shouldn't happen...")
-            start_response(self.full_status(406), [])
-            return [b'']
-        except ResourceError as e:
-            logger.debug('Subscription denied: HTTP error %d' % (e.status,))
-            start_response(self.full_status(e.status), [])
-            return [b'']
-
-        # Check subscription status and change to 'subscribed'
-        sub_key = get_subscription_key(sub_id)
-        sub_status = redis_conn.get(sub_key).decode('utf-8')
-        assert sub_status == 'granted'
-        logger.debug('Subscription granted')
-        if redis_conn.set(sub_key, 'subscribed'):
-            logger.debug('Subscription %s status changed to "subscribed"' % (sub_id,))
-
-        # Delete subscription key (not currently used for anything else)
-        redis_conn.delete(sub_key)
-
-        # Subscribe to Redis channel
-        pubsub = redis_conn.pubsub()
-        pubsub.subscribe(get_full_channel_name(res.channel))
+        # Resume a recent subscription without asking Django, if the client holds a valid resume token
+        res = load_resume_token(self.get_cookie(env, settings.RT_RESUME_COOKIE_NAME), res_path)
+        resume_cookie = None
+        if res:
+            logger.debug('Resuming subscription for %s' % (res_path,))
+        else:
+            # Request resource from Django API
+            try:
+                logger.debug('Requesting subscription for %s' % (res_path,))
+                res = self.authorize_resource(res_path, req_hdrs)
+            except NotAnRtResourceError:
+                logger.debug("Subscription denied: not an rt resource. This shouldn't happen...")
+                start_response(self.full_status(406), [])
+                return [b'']
+            except ResourceError as e:
+                logger.debug('Subscription denied: HTTP error %d' % (e.status,))
+                start_response(self.full_status(e.status), [])
+                return [b'']
+
+            if settings.RT_RESUME_TOKEN_TTL:
+                resume_cookie = get_resume_cookie(res, env['PATH_INFO'])
 
         # Prepare response
         hdrs = {
             'Content-Type': 'text/event-stream'
         }
+        if resume_cookie:
+            hdrs['Set-Cookie'] = resume_cookie
         cors_hdrs = get_cors_headers(req_hdrs.get('ORIGIN', None))
         hdrs.update(cors_hdrs)
         start_response('200 OK', [hdr for hdr in hdrs.items()])
 
-        # Loop
-        first_event = True
-        while True:
-            # Wait for event on channel
-            msg = pubsub.get_message(
-                timeout=settings.RT_SSE_HEARTBEAT if settings.RT_SSE_HEARTBEAT else (10*60.0)
-            )
-            if msg:
-                if msg['type'] == 'message':
-                    # Deserialize ResourceEvent
-                    event_json = msg['data'].decode('utf-8')
-                    event = ResourceEvent.from_json(event_json)
-
-                    # Create SSE event
-                    sse_evt = SseEvent.from_resource_event(event)
-
-                    # Send 'retry' field on first SSE event delivered
-                    if first_event:
-                        sse_evt.retry = settings.RT_SSE_RETRY
-                        first_event = False
-
-                    # Send SSE event to client
-                    yield sse_evt.as_utf8()
+        return self.stream_sse(res, view_class, req_hdrs.get('LAST_EVENT_ID', None))
+
+    def stream_sse(self, res, view_class, last_event_id):
+        # Subscribe to broker channel through the shared subscription hub. This happens once the server starts
+        # iterating the response, so the subscription is always released by the finally clause below.
+        chan = get_full_channel_name(res.channel)
+        conflate, max_rate = get_conflation(res.channel, view_class)
+        queue = self._hub.subscribe(chan, conflate, max_rate)
+        conn = ClientConnection(queue, channel=chan)
+
+        # Register connection for heartbeats
+        if self._heartbeats:
+            self._heartbeats.add(conn)
+        metrics.connections.labels(conn.transport).inc()
+
+        try:
+            # Send 'retry' field as a prelude frame
+            if settings.RT_SSE_RETRY:
+                yield SseRetry(settings.RT_SSE_RETRY).as_utf8()
+
+            # Replay events missed since the client's last event, if the channel retains them, or the 'rt-reset'
+            # event standing in for too many of them. Subscription happened first, so nothing is lost in between;
+            # queued events which were also replayed (or reset) are skipped below.
+            if last_event_id and parse_event_id(last_event_id) and get_event_retention(res.channel):
+                logger.debug('Replaying events after %s' % (last_event_id,))
+                missed = get_missed_events(self._broker, res.channel, last_event_id)
             else:
-                # Timeout, send SSE heartbeat if necessary
-                if settings.RT_SSE_HEARTBEAT:
-                    yield SseHeartbeat().as_utf8()
+                missed = []
+            for event in missed:
+                yield event.frame
+                record_write(event, len(event.frame))
+            if missed:
+                conn.replayed_id = parse_event_id(missed[-1].id)
+                conn.last_write = time.monotonic()
+
+            # Loop
+            while True:
+                # Wait for event on channel; heartbeats are queued by the heartbeat wheel while idle
+                event = queue.get()
+                if event is None:
+                    # Subscription terminated by the hub, or client too slow to keep up
+                    if queue.overflowed:
+                        yield SseRetry(settings.RT_SEND_QUEUE_RETRY).as_utf8()
+                    break
+                if event.is_before(conn.replayed_id) or queue.is_stale(event):
+                    continue
+
+                # Send pre-encoded SSE event to client
+                yield event.frame
+                if event is not HEARTBEAT_EVENT:
+                    record_write(event, len(event.frame))
+                conn.last_write = time.monotonic()
+        finally:
+            logger.debug('Connection closed; cleaning up')
+            metrics.connections.labels(conn.transport).dec()
+            if self._heartbeats:
+                self._heartbeats.remove(conn)
+            self._hub.unsubscribe(conn.channel, queue)
+
+    def handle_metrics(self, env, start_response):
+        # REMOTE_ADDR is empty for Unix domain socket peers
+        if not is_metrics_client_allowed(env.get('REMOTE_ADDR') or None):
+            start_response(self.full_status(403), [])
+            return [b'']
+
+        start_response('200 OK', [('Content-Type', metrics.CONTENT_TYPE)])
+        return [metrics.render(self._hub).encode('utf-8')]
 
     def application(self, env, start_response):
+        if env['PATH_INFO'] == '/metrics' and settings.RT_COURIER_METRICS:
+            return self.handle_metrics(env, start_response)
+
         m = re.match(r'^(.+)\.(.+)$', env['PATH_INFO'])
         if not m:
             start_response('404 Not Found', [('Content-Type', 'text/plain')])
@@ -178,27 +343,56 @@ class GeventCourier:
             start_response('404 Not Found', [('Content-Type', 'text/plain')])
             return [b'Not found']
 
-    def run(self, addr=None, port=None, unix_socket=None, django_url=None):
-        assert (addr and port) or unix_socket
+    def run(self, addr=None, port=None, unix_socket=None, django_url=None, sock=None):
+        """Run the server until stopped. Listens on a TCP address and port, a Unix domain socket, or an already
+        bound listening socket (sock), e.g. one inherited from a supervisor process."""
+        assert (addr and port) or unix_socket or sock
 
         self._django_url = get_django_url(django_url)
-        if self._django_url.scheme == 'http+unix':
-            raise ValueError('http+unix scheme not currently supported with the gevent courier')
+        self._http_pool = self.create_http_pool()
 
         # Initialize Django
         django.setup()
 
-        logger.info('Django-RT gevent courier server running on '+':'.join([str(addr), str(port)]))
+        # Get broker and create shared subscription hub
+        self._broker = get_broker()
+        self._hub = SubscriptionHub(self._broker)
+
+        # Start heartbeat scheduler
+        if settings.RT_SSE_HEARTBEAT:
+            self._heartbeats = HeartbeatWheel(settings.RT_SSE_HEARTBEAT, settings.RT_SSE_HEARTBEAT_TICK,
+                self.send_heartbeat
+            )
+            self._heartbeat_greenlet = gevent.spawn(self.run_heartbeats)
+
+        if sock:
+            # Wrap socket (possibly created before gevent patched the socket module) in a cooperative socket
+            listener = socket.socket(sock.family, sock.type, fileno=sock.detach())
+            listen_str = str(listener.getsockname())
+        elif unix_socket:
+            listener = create_listen_socket(unix_socket=unix_socket)
+            listen_str = unix_socket
+        else:
+            listener = (addr, port)
+            listen_str = ':'.join([str(addr), str(port)])
+        logger.info('Django-RT gevent courier server running on '+listen_str)
 
-        self._wsgi_server = server = WSGIServer((addr, port), self.application)
+        self._wsgi_server = server = WSGIServer(listener, self.application)
+        if settings.RT_COURIER_TRACEMALLOC:
+            metrics.start_memory_tracing(settings.RT_COURIER_TRACEMALLOC)
         try:
             server.serve_forever()
         except KeyboardInterrupt:
             pass
+        finally:
+            if self._heartbeat_greenlet:
+                self._heartbeat_greenlet.kill()
+            self._hub.close()
+            self._http_pool.close()
 
     def stop(self):
-        # Stop WSGI server
-        self._wsgi_server.stop()
+        # Stop WSGI server, allowing open connections some time to finish
+        self._wsgi_server.stop(timeout=settings.RT_COURIER_SHUTDOWN_TIMEOUT)
 
 if __name__ == '__main__':
     GeventCourier().run('0.0.0.0', 15000)
@@ -0,0 +1,173 @@
+import time
+import gevent
+from gevent.lock import RLock
+from gevent.queue import Queue
+
+import logging
+logger = logging.getLogger(__name__)
+
+from django_rt.couriers.metrics import metrics
+from django_rt.couriers.common import ChannelConflator, ChannelEvent, SendQueueMixin
+
+class ClientQueue(SendQueueMixin, Queue):
+    """Bounded queue of ChannelEvents waiting to be written to one client."""
+
+    def get(self, *args, **kwargs):
+        # Also called by get_nowait()
+        item = super().get(*args, **kwargs)
+        self._taken(item)
+        return item
+
+class SubscriptionHub:
+    """Process-wide broker subscription shared by all clients of a gevent courier.
+
+    A single broker Subscriber is read by one listener greenlet. Channel subscriptions are reference counted, and
+    each message received from the broker is encoded into an SSE frame once before the same ChannelEvent
+    is put on the queue of every local client subscribed to its channel. On conflated channels, only the newest
+    events are held and dispatched at the channel's maximum flush rate.
+    """
+
+    # Listener poll interval, in seconds
+    POLL_TIMEOUT = 1.0
+
+    def __init__(self, broker):
+        self._broker = broker
+        self._lock = RLock()
+        self._subscriber = None
+        self._listener = None
+
+        # Maps full broker channel names to the set of client queues subscribed to them
+        self._channels = {}
+
+        # Maps full broker channel names of conflated channels to their ChannelConflator
+        self._conflators = {}
+
+    def _listen(self):
+        try:
+            while True:
+                msg = self._subscriber.get_message(timeout=self.POLL_TIMEOUT)
+                if not msg:
+                    continue
+
+                channel, data = msg
+                queues = self._channels.get(channel)
+                if not queues:
+                    continue
+
+                # Encode SSE frame once for all subscribers
+                metrics.events_received.inc()
+                conflator = self._conflators.get(channel)
+                try:
+                    event = ChannelEvent.from_message(data, channel, conflator and conflator.mode)
+                except (ValueError, KeyError, AssertionError):
+                    metrics.events_malformed.inc()
+                    logger.warning('Discarding malformed event on broker channel %s' % (channel,))
+                    continue
+
+                if conflator:
+                    if conflator.add(event):
+                        conflator.timer = gevent.spawn_later(conflator.get_delay(time.monotonic()),
+                            self._flush, channel
+                        )
+                else:
+                    for queue in queues:
+                        queue.offer(event)
+        except gevent.GreenletExit:
+            raise
+        except Exception:
+            metrics.broker_errors.inc()
+            logger.exception('Shared broker subscriber failed; disconnecting clients')
+            self._reset()
+
+    def _flush(self, channel):
+        """Dispatch the events held for a conflated channel."""
+        conflator = self._conflators.get(channel)
+        if not conflator:
+            return
+
+        events = conflator.take(time.monotonic())
+        for queue in self._channels.get(channel, ()):
+            for event in events:
+                queue.offer(event)
+
+    def _remove_conflator(self, channel):
+        conflator = self._conflators.pop(channel, None)
+        if conflator and conflator.timer:
+            conflator.timer.kill(block=False)
+
+    def _reset(self):
+        """Drop the subscriber connection and tell every client queue that the subscription has ended."""
+        for queues in self._channels.values():
+            for queue in queues:
+                queue.put_nowait(None)
+        self._channels = {}
+        for channel in list(self._conflators):
+            self._remove_conflator(channel)
+
+        if self._subscriber:
+            self._subscriber.close()
+        self._subscriber = None
+        self._listener = None
+
+    @property
+    def channel_count(self):
+        return len(self._channels)
+
+    def get_stats(self):
+        """Return the number of client subscriptions per channel, and the events and bytes waiting in client queues."""
+        queues = set(queue for queues in self._channels.values() for queue in queues)
+        return {
+            'channels': {channel: len(queues) for channel, queues in self._channels.items()},
+            'queued_events': sum(queue.qsize() for queue in queues),
+            'queued_bytes': sum(queue.buffered_bytes for queue in queues),
+        }
+
+    @property
+    def buffered_bytes(self):
+        """Total bytes of encoded frames waiting in client queues."""
+        return sum(queue.buffered_bytes for queues in self._channels.values() for queue in queues)
+
+    def subscribe(self, channel, conflate=None, max_rate=None):
+        """Subscribe to a broker channel. Returns a ClientQueue which receives a ChannelEvent for each message
+        published to the channel, or None if the subscription is terminated by the hub or the queue overflows.
+
+        If conflate is set (see get_conflation()), the channel is conflated with the given maximum flush rate. The
+        first subscriber to a channel decides whether it is conflated."""
+        queue = ClientQueue()
+
+        with self._lock:
+            queues = self._channels.get(channel)
+            if queues is None:
+                logger.debug('Subscribing to broker channel %s' % (channel,))
+                if not self._subscriber:
+                    self._subscriber = self._broker.subscriber()
+                self._subscriber.subscribe(channel)
+                queues = self._channels[channel] = set()
+                if conflate:
+                    self._conflators[channel] = ChannelConflator(conflate, max_rate)
+
+                # Listener can only be started once the subscriber exists
+                if not self._listener:
+                    self._listener = gevent.spawn(self._listen)
+            queues.add(queue)
+
+        return queue
+
+    def unsubscribe(self, channel, queue):
+        """Remove a client queue returned by subscribe()."""
+        with self._lock:
+            queues = self._channels.get(channel)
+            if not queues or queue not in queues:
+                return
+
+            queues.remove(queue)
+            if not queues:
+                del self._channels[channel]
+                self._remove_conflator(channel)
+                logger.debug('Unsubscribing from broker channel %s' % (channel,))
+                self._subscriber.unsubscribe(channel)
+
+    def close(self):
+        if self._listener:
+            self._listener.kill()
+        self._reset()
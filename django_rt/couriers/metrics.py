@@ -0,0 +1,217 @@
+import os
+import time
+import tracemalloc
+from bisect import bisect_left
+
+# Default histogram buckets for latencies, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)) + '}'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """Monotonically increasing value. Couriers update metrics from a single thread (an event loop, or cooperative
+    greenlets), so no locking is needed."""
+    __slots__ = ('value',)
+    TYPE = 'counter'
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, label_str):
+        yield name + label_str, self.value
+
+class Gauge(Counter):
+    """Value which can go up and down."""
+    __slots__ = ()
+    TYPE = 'gauge'
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+class Histogram:
+    """Distribution of observed values in fixed buckets."""
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+    TYPE = 'histogram'
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, label_str):
+        # Bucket samples need an extra 'le' label alongside any others
+        prefix = label_str[:-1] + ',' if label_str else '{'
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            yield '%s_bucket%sle="%s"}' % (name, prefix, _format_value(bound)), cumulative
+        yield name + '_sum' + label_str, self.sum
+        yield name + '_count' + label_str, self.count
+
+class Timer:
+    """Context manager observing the time spent in a block in a histogram."""
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.monotonic() - self.start)
+
+class MetricFamily:
+    """A named metric, optionally split by labels. Children are created on first use of each label combination."""
+
+    def __init__(self, name, help, metric_class, label_names=(), **kwargs):
+        self.name = name
+        self.help = help
+        self.metric_class = metric_class
+        self.label_names = tuple(label_names)
+        self._kwargs = kwargs
+        self._children = {}
+        if not self.label_names:
+            self._children[()] = metric_class(**kwargs)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            assert len(values) == len(self.label_names)
+            child = self._children[values] = self.metric_class(**self._kwargs)
+        return child
+
+    def render(self, lines):
+        lines.append('# HELP %s %s' % (self.name, self.help))
+        lines.append('# TYPE %s %s' % (self.name, self.metric_class.TYPE))
+        for values, child in self._children.items():
+            for sample_name, value in child.samples(self.name, _format_labels(self.label_names, values)):
+                lines.append('%s %s' % (sample_name, _format_value(value)))
+
+class CourierMetrics:
+    """Metrics collected by a courier process, rendered in the Prometheus text exposition format.
+
+    Each courier process (including each worker started with --workers) keeps its own metrics, and reports its process
+    ID in rt_courier_process_info. Rates, such as events delivered per second, are derived from the counters by the
+    scraper.
+    """
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self):
+        self._families = []
+        self._traced_baseline = None
+
+        self.connections = self._add('rt_courier_connections', 'Open client connections', Gauge, ('transport',))
+        self.handshake_seconds = self._add('rt_courier_handshake_seconds',
+            'Time spent in each stage of the subscription handshake', Histogram, ('stage',)
+        )
+        self.events_received = self._add('rt_courier_events_received_total', 'Events received from the broker', Counter)
+        self.events_malformed = self._add('rt_courier_events_malformed_total',
+            'Malformed events received from the broker and discarded', Counter
+        )
+        self.events_delivered = self._add('rt_courier_events_delivered_total', 'Events written to clients', Counter)
+        self.events_dropped = self._add('rt_courier_events_dropped_total',
+            'Events dropped by the client send queue policy', Counter
+        )
+        self.clients_evicted = self._add('rt_courier_clients_evicted_total',
+            'Clients disconnected by the client send queue policy', Counter
+        )
+        self.bytes_written = self._add('rt_courier_bytes_written_total', 'Bytes of events written to clients', Counter)
+        self.heartbeats_sent = self._add('rt_courier_heartbeats_sent_total', 'Heartbeats sent to idle clients', Counter)
+        self.django_errors = self._add('rt_courier_django_errors_total',
+            'Failed resource requests to Django, by HTTP status', Counter, ('status',)
+        )
+        self.broker_errors = self._add('rt_courier_broker_errors_total', 'Broker command and connection errors', Counter)
+        self.delivery_seconds = self._add('rt_courier_delivery_latency_seconds',
+            'Time from publish() until an event was received from the broker, and until it was written to each client, by '
+            'channel prefix (from RT_LATENCY_CHANNEL_PREFIXES)', Histogram, ('channel_prefix', 'stage')
+        )
+
+    def _add(self, name, help, metric_class, label_names=(), **kwargs):
+        """Register a metric family. Returns the family if it has labels, or else its single metric, so hot paths
+        update it directly."""
+        family = MetricFamily(name, help, metric_class, label_names, **kwargs)
+        self._families.append(family)
+        return family if label_names else family.labels()
+
+    def start_memory_tracing(self, frames=1):
+        """Start tracing memory allocations with tracemalloc, keeping the given number of stack frames per allocation.
+        Memory allocated after this call is reported per open connection, which estimates the cost of a connection
+        while clients are idle. Tracing slows the courier down, so it is meant for load tests."""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self._traced_baseline = tracemalloc.get_traced_memory()[0]
+
+    def render(self, hub=None):
+        """Render all metrics as text. Hub state (subscribers per channel and queued events) is sampled now."""
+        lines = []
+        for family in self._families:
+            family.render(lines)
+
+        if hub:
+            stats = hub.get_stats()
+
+            channel_clients = MetricFamily('rt_courier_channel_clients', 'Client subscriptions per broker channel',
+                Gauge, ('channel',)
+            )
+            for channel, count in stats['channels'].items():
+                channel_clients.labels(channel).set(count)
+            channel_clients.render(lines)
+
+            for name, help, key in (
+                ('rt_courier_queued_events', 'Events waiting in client send queues', 'queued_events'),
+                ('rt_courier_queued_bytes', 'Bytes of events waiting in client send queues', 'queued_bytes'),
+            ):
+                family = MetricFamily(name, help, Gauge)
+                family.labels().set(stats[key])
+                family.render(lines)
+
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            traced = MetricFamily('rt_courier_traced_memory_bytes', 'Memory allocated by Python, traced by tracemalloc',
+                Gauge, ('kind',)
+            )
+            traced.labels('current').set(current)
+            traced.labels('peak').set(peak)
+            traced.render(lines)
+
+            connections = sum(gauge.value for gauge in self.connections._children.values())
+            if connections and self._traced_baseline is not None:
+                family = MetricFamily('rt_courier_traced_memory_per_connection_bytes',
+                    'Traced memory allocated since tracing started, per open connection', Gauge
+                )
+                family.labels().set((current - self._traced_baseline) // connections)
+                family.render(lines)
+
+        pid = str(os.getpid())
+        lines.append('# HELP rt_courier_process_info Courier process')
+        lines.append('# TYPE rt_courier_process_info gauge')
+        lines.append('rt_courier_process_info{pid="%s"} 1' % (pid,))
+        return '\n'.join(lines) + '\n'
+
+# Process-wide metrics, updated by the subscription hubs and couriers
+metrics = CourierMetrics()
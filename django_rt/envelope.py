@@ -0,0 +1,57 @@
+"""Compact binary envelope for events published to Redis.
+
+An envelope is a msgpack array of [version, event type, timestamp, sequence number, payload]. The timestamp is the
+publish time stamped by publish() in integer microseconds since the epoch (0 if publish timestamps are disabled, so
+couriers do not record a delivery latency for the event), the sequence number counts events published by the process,
+and the payload is the serialized ResourceEvent JSON as UTF-8 bytes. Couriers read the header to route and frame an
+event without parsing its payload, which is passed on to clients as is.
+
+Envelopes start with a msgpack fixarray byte (0x90-0x9f), so they can be told apart from JSON messages (which start
+with '{') and retention stream IDs (which start with a digit); both formats may be received on the same channel.
+"""
+import itertools
+
+ENVELOPE_VERSION = 1
+
+# Length of the version 1 envelope array
+_ENVELOPE_FIELDS = 5
+
+_sequence = itertools.count(1)
+
+def is_envelope(message):
+    """Return True if a message (bytes) received from Redis is a binary envelope rather than JSON."""
+    return isinstance(message, bytes) and message[:1] != b'' and message[0] & 0xf0 == 0x90
+
+def pack_envelope(event):
+    """Serialize a ResourceEvent into a binary envelope. Requires msgpack."""
+    import msgpack
+
+    timestamp = int(event.published * 1000000) if event.published is not None else 0
+
+    return msgpack.packb([
+        ENVELOPE_VERSION,
+        event.event_type,
+        timestamp,
+        next(_sequence),
+        event.to_json().encode('utf-8'),
+    ], use_bin_type=True)
+
+def unpack_envelope(message):
+    """Return the (event type, timestamp, sequence number, payload) tuple of a binary envelope. Raises ValueError if
+    the envelope is malformed or of an unsupported version."""
+    import msgpack
+
+    try:
+        fields = msgpack.unpackb(message, raw=False)
+    except Exception as e:
+        raise ValueError('Malformed event envelope: %s' % (e,))
+
+    if not isinstance(fields, list) or len(fields) < _ENVELOPE_FIELDS:
+        raise ValueError('Malformed event envelope')
+    if fields[0] != ENVELOPE_VERSION:
+        raise ValueError('Unsupported event envelope version %r' % (fields[0],))
+
+    version, event_type, timestamp, seq, payload = fields[:_ENVELOPE_FIELDS]
+    if not isinstance(payload, bytes):
+        raise ValueError('Malformed event envelope')
+    return event_type, timestamp, seq, payload
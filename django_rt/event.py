@@ -1,14 +1,19 @@
 from django.utils import timezone
 
-from django_rt.utils import SerializableObject
+from django_rt.utils import SerializableObject, json_loads
 
 class ResourceEvent(SerializableObject):
-    def __init__(self, data=None, time=None, event_type=None):
+    __slots__ = ('data', 'time', 'event_type', 'published')
+
+    def __init__(self, data=None, time=None, event_type=None, published=None):
         assert data or event_type
 
         self.data = data
         self.event_type = event_type
 
+        # High-resolution publish timestamp, in seconds since the epoch, stamped by publish()
+        self.published = published
+
         if time:
             self.time = time
         else:
@@ -24,6 +29,8 @@ class ResourceEvent(SerializableObject):
             obj['data'] = self.data
         if self.event_type:
             obj['type'] = self.event_type
+        if self.published is not None:
+            obj['published'] = self.published
 
         return obj
 
@@ -33,4 +40,23 @@ class ResourceEvent(SerializableObject):
             data=data.get('data', None),
             time=data.get('time', None),
             event_type=data.get('type', None),
+            published=data.get('published', None),
         )
+
+def get_event_header(event_json):
+    """Return the event type (None if untyped) and publish timestamp (None if not stamped) of a serialized
+    ResourceEvent, validating it like ResourceEvent.from_json() but without building the event."""
+    data = json_loads(event_json)
+    if not isinstance(data, dict):
+        raise ValueError('Not a serialized ResourceEvent')
+    event_type = data.get('type', None)
+    assert data.get('data', None) or event_type
+
+    published = data.get('published', None)
+    if not isinstance(published, (int, float)):
+        published = None
+    return event_type, published
+
+def get_event_type(event_json):
+    """Return the event type of a serialized ResourceEvent (None if untyped)."""
+    return get_event_header(event_json)[0]
@@ -1,15 +1,50 @@
-import json
-import redis
+import asyncio
+import threading
+import time
+from django.core.signals import request_finished, request_started
+from django.db import transaction
+from django.dispatch import receiver
 from django.views.generic import View
 
+from django_rt.brokers import get_broker
+from django_rt.envelope import pack_envelope
 from django_rt.event import ResourceEvent
 from django_rt.settings import settings
-from django_rt.utils import get_full_channel_name
+from django_rt.utils import coroutine, json_dumps
 
-def publish(channel, event=None, data=None, time=None, event_type=None):
+_local = threading.local()
+
+def get_redis_connection():
+    """Return a Redis client backed by the Redis broker's connection pool. Only available when RT_BROKER is 'redis'
+    (or another RedisBroker)."""
+    return get_broker().get_connection()
+
+@coroutine
+def get_async_redis_pool(loop=None):
+    """Return the Redis broker's persistent asyncio_redis connection pool for the given (or current) event loop. Only
+    available when RT_BROKER is 'redis' (or another RedisBroker)."""
+    return (yield from get_broker().get_async(loop).get_pool())
+
+def _stamp_event(event):
+    """Stamp an event with the current time as it is published, if RT_PUBLISH_TIMESTAMP is enabled. Couriers measure
+    delivery latency from this timestamp. It is wall-clock time, since monotonic clocks cannot be compared between
+    processes or hosts; couriers treat negative latencies caused by clock adjustments as zero."""
+    if settings.RT_PUBLISH_TIMESTAMP:
+        event.published = time.time()
+    return event
+
+def _serialize_event(event):
+    """Stamp and serialize an event for publishing, in the format selected by RT_PUBLISH_FORMAT."""
+    _stamp_event(event)
+    if settings.RT_PUBLISH_FORMAT == 'msgpack':
+        return pack_envelope(event)
+    else:
+        return event.to_json()
+
+def _build_event(event, data, time, event_type, func_name='publish'):
     if data or time or event_type:
         if event:
-            raise RuntimeError("publish() cannot accept 'data', 'time', or 'event_type' arguments if 'event' is specified")
+            raise RuntimeError("%s() cannot accept 'data', 'time', or 'event_type' arguments if 'event' is specified" % (func_name,))
         # Create ResourceEvent
         event = ResourceEvent(
             data=data,
@@ -18,15 +53,182 @@ def publish(channel, event=None, data=None, time=None, event_type=None):
         )
     else:
         if not event:
-            raise RuntimeError("publish() called with no event or event data")
-        
-    redis_channel = get_full_channel_name(channel)
-    event_json = event.to_json()
-
-    r = redis.StrictRedis(
-        host=settings.RT_REDIS_HOST,
-        port=settings.RT_REDIS_PORT,
-        db=settings.RT_REDIS_DB,
-        password=settings.RT_REDIS_PASSWORD
-    )
-    r.publish(redis_channel, event_json)
+            raise RuntimeError("%s() called with no event or event data" % (func_name,))
+
+    return event
+
+class _DeferredBatch:
+    """Events buffered by deferred publishing, flushed together with publish_many()."""
+
+    def __init__(self):
+        self.events = []
+
+    def add(self, channel, event):
+        self.events.append((channel, event))
+
+    def _collapse(self, events):
+        """Drop all but the newest of any duplicate events to the same channel."""
+        seen = set()
+        collapsed = []
+        for channel, event in reversed(events):
+            key = (
+                channel,
+                event.event_type,
+                json_dumps(event.data, sort_keys=True)
+            )
+            if key not in seen:
+                seen.add(key)
+                collapsed.append((channel, event))
+        collapsed.reverse()
+        return collapsed
+
+    def flush(self):
+        events = self.events
+        self.events = []
+        if not events:
+            return
+
+        if settings.RT_PUBLISH_COLLAPSE_DUPLICATES:
+            events = self._collapse(events)
+        publish_many(events)
+
+class _Savepoint:
+    """on_commit() marker for the events published at one savepoint level. Django discards the callbacks registered
+    inside a savepoint when it is rolled back, so only the markers of surviving savepoints are called."""
+    __slots__ = ('committed',)
+
+    def __init__(self):
+        self.committed = False
+
+    def __call__(self):
+        self.committed = True
+
+class _TransactionBatch(_DeferredBatch):
+    """Events deferred until the outermost atomic block commits, kept in publishing order.
+
+    Each event is tagged with the _Savepoint marker of the savepoint level it was published at. The batch's own
+    callback is moved behind every marker, so by the time it runs the markers of rolled-back savepoints are the ones
+    left uncalled, and their events are dropped before the rest are published in a single publish_many() call.
+    """
+
+    def __init__(self, connection):
+        super().__init__()
+        self.connection = connection
+        self.savepoints = {} # savepoint IDs -> _Savepoint
+        transaction.on_commit(self.flush_on_commit, using=connection.alias)
+
+    def is_pending(self):
+        # Django discards the on_commit() callbacks of rolled-back transactions and savepoints
+        return any(entry[1] == self.flush_on_commit for entry in self.connection.run_on_commit)
+
+    def add(self, channel, event):
+        key = tuple(self.connection.savepoint_ids)
+        savepoint = self.savepoints.get(key)
+        if savepoint is None:
+            savepoint = self.savepoints[key] = _Savepoint()
+            transaction.on_commit(savepoint, using=self.connection.alias)
+
+            # Keep the batch's callback last, after the marker just registered
+            callbacks = self.connection.run_on_commit
+            for i, entry in enumerate(callbacks):
+                if entry[1] == self.flush_on_commit:
+                    callbacks.append(callbacks.pop(i))
+                    break
+        self.events.append((channel, event, savepoint))
+
+    def flush_on_commit(self):
+        batches = _local.transaction_batches
+        if batches.get(self.connection.alias) is self:
+            del batches[self.connection.alias]
+
+        self.events = [
+            (channel, event) for channel, event, savepoint in self.events
+            if savepoint.committed
+        ]
+        self.savepoints = {}
+        self.flush()
+
+def _get_transaction_batch():
+    """Return the deferred batch for the current transaction, or None if not in one.
+    A single batch is kept per outermost atomic block, so events are published in order whatever savepoints they
+    were published in, and those of rolled-back savepoints are dropped."""
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        return None
+
+    if not hasattr(_local, 'transaction_batches'):
+        _local.transaction_batches = {}
+    batches = _local.transaction_batches
+
+    batch = batches.get(connection.alias)
+    if batch is None or not batch.is_pending():
+        # Forget the batch of a rolled-back transaction
+        batch = batches[connection.alias] = _TransactionBatch(connection)
+
+    return batch
+
+@receiver(request_started)
+def _start_request_batch(**kwargs):
+    if settings.RT_PUBLISH_DEFERRED:
+        _local.request_batch = _DeferredBatch()
+
+@receiver(request_finished)
+def _flush_request_batch(**kwargs):
+    batch = getattr(_local, 'request_batch', None)
+    if batch:
+        _local.request_batch = None
+        batch.flush()
+
+def publish(channel, event=None, data=None, time=None, event_type=None):
+    """Publish an event to a channel. Returns the number of couriers which received it.
+
+    If the RT_PUBLISH_DEFERRED setting is enabled, events published inside an atomic block are buffered and
+    published as one batch when the transaction commits (or dropped if it rolls back), and events published
+    elsewhere during a request are published as one batch when the response is finished. Deferred events return
+    None instead of a receiver count.
+    """
+    event = _build_event(event, data, time, event_type)
+
+    if settings.RT_PUBLISH_DEFERRED:
+        batch = _get_transaction_batch() or getattr(_local, 'request_batch', None)
+        if batch:
+            batch.add(channel, event)
+            return None
+
+    return get_broker().publish_event(channel, _serialize_event(event))
+
+def publish_many(events):
+    """Publish a batch of events, in a single pipelined round trip with the Redis broker.
+    events is an iterable of (channel, ResourceEvent) tuples. Returns a list containing the number of couriers
+    which received each event, in the same order."""
+    return get_broker().publish_events([
+        (channel, _serialize_event(event))
+        for channel, event in events
+    ])
+
+@coroutine
+def apublish(channel, event=None, data=None, time=None, event_type=None, loop=None):
+    """Coroutine version of publish(), for use in async views, consumers and asyncio workers. Takes the same
+    arguments and returns the number of couriers which received the event.
+    Events are always published immediately; RT_PUBLISH_DEFERRED does not apply. Events are always published as
+    JSON, since the Redis broker's asyncio_redis pools encode messages as text; couriers accept both formats on any channel.
+    The broker's connections are kept open for the event loop until close_async() is called."""
+    event = _build_event(event, data, time, event_type, func_name='apublish')
+
+    broker = get_broker().get_async(loop)
+    return (yield from broker.publish_event(channel, _stamp_event(event).to_json()))
+
+@coroutine
+def apublish_many(events, loop=None):
+    """Coroutine version of publish_many(). With the Redis broker, the PUBLISH commands are issued together, so they
+    are pipelined over the pool's connections rather than waiting for each reply in turn."""
+    broker = get_broker().get_async(loop)
+    return (yield from broker.publish_events([
+        (channel, _stamp_event(event).to_json())
+        for channel, event in events
+    ]))
+
+def close_async(loop=None):
+    """Close the broker connections opened by apublish() and apublish_many() for the given (or current) event loop.
+    Call this before closing a loop which published events."""
+    get_broker().close_async(loop or asyncio.get_event_loop())
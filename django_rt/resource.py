@@ -1,4 +1,6 @@
-from django.core.signing import Signer
+import time
+from django.core import signing
+from django.core.signing import BadSignature, Signer, SignatureExpired
 
 from django_rt.utils import SerializableObject
 
@@ -17,7 +19,9 @@ class ResourceError(Exception):
         return 'Resource error'
 
 class Resource(SerializableObject):
+    __slots__ = ('path', 'channel')
     CONTENT_TYPE = 'x-djangort-resource'
+    RESUME_TOKEN_SALT = 'django_rt.resource.Resource.resume'
 
     def __init__(self, path, channel):
         self.path = path
@@ -36,6 +40,20 @@ class Resource(SerializableObject):
             channel=data['channel']
         )
 
+    def get_resume_token(self):
+        """Return a signed, timestamped token binding this resource's path and channel, which allows a client to
+        resubscribe without another authorization request."""
+        return signing.dumps(self.serialize(), salt=self.RESUME_TOKEN_SALT)
+
+    @classmethod
+    def from_resume_token(cls, token, path, max_age):
+        """Return the Resource bound by a resume token. Throw BadSignature if the token is invalid or was issued for a
+        different path, or SignatureExpired if it is more than max_age seconds old."""
+        res = cls.deserialize(signing.loads(token, salt=cls.RESUME_TOKEN_SALT, max_age=max_age))
+        if res.path != path:
+            raise BadSignature('Resume token was issued for a different resource')
+        return res
+
     @staticmethod
     def validate_content_type(ct):
         """Throw error if HTTP CONTENT_TYPE header is not acceptable for a serialized Resource"""
@@ -53,10 +71,11 @@ class Resource(SerializableObject):
             raise NotAnRtResourceError()
 
 class ResourceRequest(SerializableObject):
+    __slots__ = ('path', 'action', 'sub_id', 'timestamp', '_signature', '_prepared', '_headers')
     ACTIONS = ('subscribe',)
     CONTENT_TYPE = 'x-djangort-resource-request; charset=utf-8'
 
-    def __init__(self, path=None, action=None, sub_id=None, signature=None):
+    def __init__(self, path=None, action=None, sub_id=None, signature=None, timestamp=None):
         assert action in self.ACTIONS
 
         self.path = path
@@ -64,6 +83,12 @@ class ResourceRequest(SerializableObject):
         self.sub_id = sub_id
         self._signature = signature
 
+        if timestamp is not None:
+            self.timestamp = timestamp
+        else:
+            # Default to current time
+            self.timestamp = int(time.time())
+
         self._prepared = False
 
     def prepare(self, client_headers=None):
@@ -97,7 +122,8 @@ class ResourceRequest(SerializableObject):
         return '|'.join([
             str(self.path),
             str(self.action),
-            str(self.sub_id)
+            str(self.sub_id),
+            str(self.timestamp)
         ])
 
     def get_signature(self):
@@ -108,10 +134,18 @@ class ResourceRequest(SerializableObject):
         s = ':'.join([self._serialize_for_signing(), self._signature])
         Signer().unsign(s)
 
+    def verify_timestamp(self, max_age):
+        """Throw SignatureExpired if the request was created more than max_age seconds ago.
+        Only meaningful once the signature (which covers the timestamp) has been verified."""
+        age = time.time() - self.timestamp
+        if age > max_age or age < -max_age:
+            raise SignatureExpired('Resource request age %d > %d seconds' % (age, max_age))
+
     def serialize(self):
         return {
             'action': self.action,
             'subscription_id': self.sub_id,
+            'timestamp': self.timestamp,
             'signature': self.get_signature()
         }
 
@@ -120,5 +154,6 @@ class ResourceRequest(SerializableObject):
         return cls(
             action=data['action'],
             sub_id=data['subscription_id'],
-            signature=data['signature']
+            signature=data['signature'],
+            timestamp=data.get('timestamp', 0)
         )
@@ -1,12 +1,12 @@
 import os
 import sys
-import signal
 import argparse
 import re
 import stat
 import logging
 
 from django_rt import VERSION, VERSION_STATUS
+from django_rt.supervisor import CourierSupervisor, create_server, trap_quit_signals
 
 DEFAULT_ADDR = '0.0.0.0'
 DEFAULT_PORT = 8080
@@ -31,6 +31,12 @@ def main():
         metavar='FILE',
         help='URL to a running Django instance (overrides RT_DJANGO_URL setting); protocol may be "http" or "http+unix"'
     )
+    parser.add_argument('--workers',
+        metavar='N',
+        type=int,
+        default=1,
+        help='number of courier worker processes to run (default 1); workers share the listening address'
+    )
     parser.add_argument('--debug',
         action='store_const',
         const=True,
@@ -93,30 +99,23 @@ def main():
         except FileNotFoundError:
             pass
 
-    # Import appropriate server class and create instance
-    if args.server_type == 'asyncio':
-        from django_rt.couriers.asyncio_courier import AsyncioCourier
-        server = AsyncioCourier()
-    elif args.server_type == 'gevent':
-        from django_rt.couriers.gevent_courier import GeventCourier
-        server = GeventCourier()
+    if args.workers < 1:
+        print('--workers must be at least 1', file=sys.stderr)
+        sys.exit(1)
+
+    if args.workers > 1:
+        # Run supervisor process, which forks the workers
+        supervisor = CourierSupervisor(args.server_type, args.workers, addr, port, unix_socket, args.django_url)
+        supervisor.run()
+    else:
+        # Create server instance
+        server = create_server(args.server_type)
 
-    # Trap signals to shut down gracefully
-    def quit_handler(signum, frame):
-        signames = {
-            signal.SIGTERM: 'SIGTERM',
-            signal.SIGINT: 'SIGINT',
-            signal.SIGQUIT: 'SIGQUIT',
-        }
-        signal_name = signames[signum]
-        logging.info('Caught %s; shutting down...' % (signal_name,))
-        server.stop()
-    signal.signal(signal.SIGTERM, quit_handler)
-    signal.signal(signal.SIGINT, quit_handler)
-    signal.signal(signal.SIGQUIT, quit_handler)
+        # Trap signals to shut down gracefully
+        trap_quit_signals(server)
 
-    # Run server
-    server.run(addr, port, unix_socket, args.django_url)
+        # Run server
+        server.run(addr, port, unix_socket, args.django_url)
 
 if __name__ == '__main__':
     main()
@@ -4,13 +4,51 @@ DEFAULTS = {
     'RT_CORS_ALLOW_ORIGIN': None,
     'RT_CORS_ALLOW_CREDENTIALS': None,
     'RT_PREFIX': 'rt',
+    'RT_JSON_BACKEND': 'auto', # 'auto', 'orjson', 'ujson' or 'json'
     'RT_SSE_HEARTBEAT': 30, # in seconds
+    'RT_SSE_HEARTBEAT_TICK': 1.0, # in seconds; resolution of the couriers' heartbeat scheduler
+    'RT_BROKER': 'redis', # 'redis', 'local', 'memory', or dotted path to a django_rt.brokers.base.Broker subclass
+    'RT_LOCAL_BROKER_SOCKET_DIR': None, # directory of courier sockets for the local broker; None for <tempdir>/django_rt
+    'RT_LOCAL_BROKER_REDIS': False, # also publish events through Redis, for couriers on other hosts
+    'RT_LOCAL_BROKER_ORIGIN': None, # identifies this host in events published through Redis; None for the host name
+    'RT_LOCAL_BROKER_SEND_TIMEOUT': 1.0, # in seconds; time allowed for a courier to accept an event
     'RT_REDIS_HOST': 'localhost',
     'RT_REDIS_PORT': 6379,
     'RT_REDIS_DB': 0,
     'RT_REDIS_PASSWORD': None,
+    'RT_REDIS_MAX_CONNECTIONS': None, # per process; None for unlimited
+    'RT_REDIS_ASYNC_POOL_SIZE': 10, # per event loop
+    'RT_PUBLISH_DEFERRED': False,
+    'RT_PUBLISH_COLLAPSE_DUPLICATES': False,
+    'RT_PUBLISH_TIMESTAMP': True, # stamp events with their publish time, for delivery latency metrics
+    'RT_PUBLISH_FORMAT': 'json', # 'json', or 'msgpack' for binary envelopes (requires msgpack)
+    'RT_EVENT_RETENTION': None, # events retained per channel for replay; int, or dict of channel prefix -> int
+    'RT_REPLAY_MAX_EVENTS': 1000,
     'RT_SSE_RETRY': 2*1000, # in milliseconds
     'RT_COURIER_IPS': ['127.0.0.1'],
+    'RT_RESOLVE_CACHE_SIZE': 1024, # routes; 0 disables caching
+    'RT_RESOLVE_NEGATIVE_TTL': 5, # in seconds
+    'RT_SIGNED_HANDSHAKE': False,
+    'RT_SIGNED_HANDSHAKE_MAX_AGE': 30, # in seconds
+    'RT_RESUME_TOKEN_TTL': 0, # in seconds; 0 disables resume tokens
+    'RT_RESUME_COOKIE_NAME': 'rt_resume',
+    'RT_COURIER_REDIS_POOL_SIZE': 10,
+    'RT_COURIER_DJANGO_MAX_CONNECTIONS': 100, # per courier process
+    'RT_COURIER_DJANGO_TIMEOUT': 10.0, # in seconds
+    'RT_COURIER_DJANGO_KEEPALIVE': 30, # in seconds
+    'RT_COURIER_SHUTDOWN_TIMEOUT': 1.0, # in seconds
+    'RT_COURIER_METRICS': True, # serve Prometheus metrics at /metrics
+    'RT_COURIER_METRICS_IPS': ['127.0.0.1'], # clients allowed to read /metrics; None allows any
+    'RT_COURIER_TRACEMALLOC': 0, # stack frames traced per allocation for memory metrics; 0 disables (slow; for load tests)
+    'RT_LATENCY_CHANNEL_PREFIXES': [], # channel prefixes labelling delivery latency metrics
+    'RT_LATENCY_TRACE_RATE': 0.0, # fraction of deliveries logged to the django_rt.couriers.trace logger
+    'RT_SEND_QUEUE_MAX_EVENTS': 1000, # per client; None for unlimited
+    'RT_SEND_QUEUE_MAX_BYTES': 1024*1024, # per client; None for unlimited
+    'RT_SEND_QUEUE_POLICY': 'drop_oldest', # 'drop_oldest', 'drop_newest' or 'disconnect'
+    'RT_SEND_QUEUE_RETRY': 10*1000, # in milliseconds; retry hint sent to clients disconnected by the queue policy
+    'RT_MUX_MAX_RESOURCES': 50, # per multiplexed stream
+    'RT_CONFLATE': None, # None, 'channel' or 'event_type', or dict of channel prefix -> mode
+    'RT_CONFLATE_MAX_RATE': 10, # conflated events flushed per second (None for no limit); number, or dict of channel prefix -> number
 }
 
 class RtSettings:
@@ -1,4 +1,10 @@
+import json
+
+from django_rt.event import get_event_type
+
 class SseEvent:
+    __slots__ = ('event', 'id', 'data', 'retry')
+
     def __init__(self, event=None, id=None, data=None, retry=None):
         self.event = event
         self.id = id
@@ -29,9 +35,40 @@ class SseEvent:
             data=event.to_json()
         )
 
+class SseRetry:
+    """Standalone 'retry' field, sent once at the start of each stream."""
+    __slots__ = ('retry',)
+
+    def __init__(self, retry):
+        self.retry = retry
+
+    def __str__(self):
+        return 'retry: ' + str(int(self.retry)) + '\n\n'
+
+    def as_utf8(self):
+        return str(self).encode('utf-8')
+
 class SseHeartbeat:
+    __slots__ = ()
+
     def __str__(self):
         return ': ping\n'
 
     def as_utf8(self):
         return str(self).encode('utf-8')
+
+def encode_resource_event(event_json, id=None):
+    """Build the UTF-8 encoded SSE frame for a serialized ResourceEvent, as received from a Redis channel.
+    Couriers call this once per published message and write the resulting bytes to every subscriber."""
+    return encode_raw_event(event_json, get_event_type(event_json), id)
+
+def encode_raw_event(event_json, event_type=None, id=None):
+    """Build the SSE frame for a serialized ResourceEvent of a known type. The published JSON is forwarded as the
+    'data' field as it is, rather than decoded and encoded again."""
+    return SseEvent(event=event_type, id=id, data=event_json).as_utf8()
+
+def encode_mux_event(event_json, resource):
+    """Build the UTF-8 encoded SSE frame for a serialized ResourceEvent on a multiplexed stream. The event is wrapped
+    in an object tagged with the resource path it was published to, without decoding it."""
+    data = '{"resource": ' + json.dumps(resource) + ', "event": ' + event_json + '}'
+    return SseEvent(data=data).as_utf8()
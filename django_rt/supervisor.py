@@ -0,0 +1,188 @@
+import os
+import time
+import errno
+import signal
+import socket
+
+import logging
+logger = logging.getLogger(__name__)
+
+from django_rt.settings import settings
+from django_rt.utils import create_listen_socket
+
+def create_server(server_type):
+    """Import the appropriate courier server class and create an instance."""
+    if server_type == 'asyncio':
+        from django_rt.couriers.asyncio_courier import AsyncioCourier
+        return AsyncioCourier()
+    elif server_type == 'gevent':
+        from django_rt.couriers.gevent_courier import GeventCourier
+        return GeventCourier()
+    else:
+        raise ValueError('Unknown server type "%s"' % (server_type,))
+
+SIGNAL_NAMES = {
+    signal.SIGTERM: 'SIGTERM',
+    signal.SIGINT: 'SIGINT',
+    signal.SIGQUIT: 'SIGQUIT',
+}
+
+def trap_quit_signals(server):
+    """Trap signals to shut down the server gracefully."""
+    def quit_handler(signum, frame):
+        logging.info('Caught %s; shutting down...' % (SIGNAL_NAMES[signum],))
+        server.stop()
+
+    for signum in SIGNAL_NAMES:
+        signal.signal(signum, quit_handler)
+
+class CourierSupervisor:
+    """Pre-forks a number of courier worker processes which share a listening address.
+
+    With TCP, each worker binds its own socket to the same port with SO_REUSEPORT (where the platform supports it),
+    so the kernel balances new connections between workers; otherwise, and for Unix domain sockets, workers inherit
+    a single socket bound by the supervisor. Crashed workers are restarted. SIGTERM, SIGINT and SIGQUIT are
+    forwarded to all workers, which drain their connections; workers still running after
+    RT_COURIER_SHUTDOWN_TIMEOUT (plus a grace period) are killed.
+    """
+
+    # Minimum time between restarts of a crashing worker, in seconds
+    RESTART_DELAY = 1.0
+
+    # Extra time allowed for workers to exit after their drain timeout, in seconds
+    SHUTDOWN_GRACE = 5.0
+
+    def __init__(self, server_type, num_workers, addr=None, port=None, unix_socket=None, django_url=None):
+        self.server_type = server_type
+        self.num_workers = num_workers
+        self.addr = addr
+        self.port = port
+        self.unix_socket = unix_socket
+        self.django_url = django_url
+
+        self._workers = {} # pid -> start time
+        self._sock = None
+        self._reuse_port = not unix_socket and hasattr(socket, 'SO_REUSEPORT')
+        self._stopping = False
+
+    def _get_worker_socket(self):
+        if self._reuse_port:
+            return create_listen_socket(self.addr, self.port, reuse_port=True)
+        else:
+            return self._sock
+
+    def _worker_main(self):
+        """Entry point of a forked worker process; never returns."""
+        status = 0
+        try:
+            # Restore default signal dispositions before the worker installs its own
+            for signum in SIGNAL_NAMES:
+                signal.signal(signum, signal.SIG_DFL)
+
+            sock = self._get_worker_socket()
+            server = create_server(self.server_type)
+            trap_quit_signals(server)
+            server.run(django_url=self.django_url, sock=sock)
+        except Exception:
+            logger.exception('Courier worker %d failed' % (os.getpid(),))
+            status = 1
+        finally:
+            logging.shutdown()
+            os._exit(status)
+
+    def _spawn_worker(self):
+        pid = os.fork()
+        if pid == 0:
+            self._worker_main()
+
+        logger.info('Started courier worker %d' % (pid,))
+        self._workers[pid] = time.monotonic()
+
+    def _signal_workers(self, signum):
+        for pid in list(self._workers):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _quit_handler(self, signum, frame):
+        logger.info('Caught %s; stopping %d workers...' % (SIGNAL_NAMES[signum], len(self._workers)))
+        self._stopping = True
+        self._signal_workers(signum)
+
+    def _reap(self, block):
+        """Reap exited workers. Returns list of (pid, status) tuples."""
+        reaped = []
+        while self._workers:
+            try:
+                pid, status = os.waitpid(-1, 0 if block and not reaped else os.WNOHANG)
+            except ChildProcessError:
+                break
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            if pid == 0:
+                break
+            if pid in self._workers:
+                reaped.append((pid, status))
+        return reaped
+
+    def run(self):
+        if not self._reuse_port:
+            self._sock = create_listen_socket(self.addr, self.port, self.unix_socket)
+        else:
+            # Workers bind their own sockets; bind one here first, so errors such as the port being in use are raised
+            # once instead of making every worker crash and restart forever
+            create_listen_socket(self.addr, self.port, reuse_port=True).close()
+
+        for signum in SIGNAL_NAMES:
+            signal.signal(signum, self._quit_handler)
+
+        listen_str = self.unix_socket or ':'.join([str(self.addr), str(self.port)])
+        logger.info('Django-RT courier supervisor starting %d %s workers on %s%s' % (
+            self.num_workers, self.server_type, listen_str, ' (SO_REUSEPORT)' if self._reuse_port else ''
+        ))
+
+        for i in range(self.num_workers):
+            self._spawn_worker()
+
+        # Supervise workers, restarting any which exit unexpectedly
+        while not self._stopping:
+            for pid, status in self._reap(block=True):
+                started = self._workers.pop(pid)
+                if self._stopping:
+                    continue
+
+                if os.WIFSIGNALED(status):
+                    reason = 'killed by signal %d' % (os.WTERMSIG(status),)
+                else:
+                    reason = 'exit code %d' % (os.WEXITSTATUS(status),)
+                logger.warning('Courier worker %d exited unexpectedly (%s); restarting' % (pid, reason))
+                uptime = time.monotonic() - started
+                if uptime < self.RESTART_DELAY:
+                    # Avoid spinning if workers are crashing on startup
+                    time.sleep(self.RESTART_DELAY - uptime)
+                    if self._stopping:
+                        # A quit signal arrived during the delay
+                        continue
+                self._spawn_worker()
+
+        # Coordinated shutdown: wait for workers to drain, then kill stragglers
+        deadline = time.monotonic() + settings.RT_COURIER_SHUTDOWN_TIMEOUT + self.SHUTDOWN_GRACE
+        while self._workers and time.monotonic() < deadline:
+            for pid, status in self._reap(block=False):
+                del self._workers[pid]
+            time.sleep(0.1)
+
+        if self._workers:
+            logger.warning('Killing %d workers which failed to stop' % (len(self._workers),))
+            self._signal_workers(signal.SIGKILL)
+            while self._workers:
+                for pid, status in self._reap(block=True):
+                    del self._workers[pid]
+
+        if self._sock:
+            self._sock.close()
+        logger.info('All courier workers stopped')
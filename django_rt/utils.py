@@ -1,14 +1,26 @@
+import asyncio
 import json
+import socket
+import time
+import types
 import uuid
+from collections import OrderedDict
 from datetime import datetime
 from importlib import import_module
 from urllib.parse import urlparse
 
-from django.core.urlresolvers import resolve, Resolver404
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.core.urlresolvers import get_resolver, get_urlconf, resolve, Resolver404
+from django.dispatch import receiver
 from http.client import responses as REASON_PHRASES
 
 from django_rt.settings import settings
 
+# Generator-based coroutine decorator for the modules Django imports (publish and the brokers). asyncio.coroutine is
+# not available on newer Python versions, where types.coroutine makes the functions awaitable from native coroutines
+coroutine = getattr(asyncio, 'coroutine', types.coroutine)
+
 class JsonDateTimeEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, datetime):
@@ -16,7 +28,73 @@ class JsonDateTimeEncoder(json.JSONEncoder):
         else:
             return json.JSONEncoder.default(self, obj)
 
+def _json_default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError('%r is not JSON serializable' % (obj,))
+
+def _load_json_backend(name):
+    """Return (dumps, loads) functions for the named JSON backend. Raises ImportError if it is not installed."""
+    if name == 'orjson':
+        import orjson
+        def dumps(obj, sort_keys=False):
+            # orjson serializes datetimes natively, in the same ISO 8601 format as datetime.isoformat(). Like the json
+            # module, convert non-str dict keys to strings instead of raising TypeError.
+            option = orjson.OPT_NON_STR_KEYS
+            if sort_keys:
+                option |= orjson.OPT_SORT_KEYS
+            return orjson.dumps(obj, default=_json_default, option=option).decode('utf-8')
+        return dumps, orjson.loads
+    elif name == 'ujson':
+        import ujson
+        def dumps(obj, sort_keys=False):
+            return ujson.dumps(obj, default=_json_default, sort_keys=sort_keys, ensure_ascii=False, escape_forward_slashes=False)
+        return dumps, ujson.loads
+    elif name == 'json':
+        def dumps(obj, sort_keys=False):
+            return json.dumps(obj, sort_keys=sort_keys, cls=JsonDateTimeEncoder)
+        return dumps, json.loads
+    else:
+        raise ImproperlyConfigured('Unknown RT_JSON_BACKEND "%s"' % (name,))
+
+_json_backend = None
+
+def get_json_backend():
+    """Return the (dumps, loads) functions of the JSON backend selected by RT_JSON_BACKEND. 'auto' picks the
+    fastest installed backend: orjson, then ujson (>= 5.4), then the standard library."""
+    global _json_backend
+    if _json_backend is None:
+        name = settings.RT_JSON_BACKEND
+        if name == 'auto':
+            for name in ('orjson', 'ujson'):
+                try:
+                    _json_backend = _load_json_backend(name)
+                    break
+                except ImportError:
+                    pass
+            else:
+                _json_backend = _load_json_backend('json')
+        else:
+            _json_backend = _load_json_backend(name)
+    return _json_backend
+
+@receiver(setting_changed)
+def _reset_json_backend(setting, **kwargs):
+    global _json_backend
+    if setting == 'RT_JSON_BACKEND':
+        _json_backend = None
+
+def json_dumps(obj, sort_keys=False):
+    """Serialize obj to a JSON string with the configured backend. Datetimes are serialized in ISO 8601 format."""
+    return get_json_backend()[0](obj, sort_keys=sort_keys)
+
+def json_loads(data):
+    """Deserialize a JSON string (or UTF-8 bytes) with the configured backend."""
+    return get_json_backend()[1](data)
+
 class SerializableObject:
+    __slots__ = ()
+
     def serialize(self):
         raise NotImplementedError('serialize() not implemented')
 
@@ -25,11 +103,11 @@ class SerializableObject:
         raise NotImplementedError('deserialize() not implemented')
 
     def to_json(self):
-        return json.dumps(self.serialize(), cls=JsonDateTimeEncoder)
+        return json_dumps(self.serialize())
 
     @classmethod
     def from_json(cls, json_data):
-        return cls.deserialize(json.loads(json_data))
+        return cls.deserialize(json_loads(json_data))
 
 def get_cors_headers(origin):
     """Return dict containing the appropriate CORS headers for a courier response, given the request origin."""
@@ -66,18 +144,97 @@ def get_cors_headers(origin):
 
     return hdrs
 
+def is_metrics_client_allowed(addr):
+    """Return True if a client at the given address may read the courier's /metrics endpoint. addr is None for Unix
+    domain socket peers, which are always allowed."""
+    allowed = settings.RT_COURIER_METRICS_IPS
+    return allowed is None or addr is None or addr in allowed
+
 def get_full_channel_name(channel):
     return ':'.join((settings.RT_PREFIX, 'channel', channel))
 
+def get_stream_key(channel):
+    return ':'.join((settings.RT_PREFIX, 'stream', channel))
+
+def get_channel_setting(value, channel, default=None):
+    """Look up a per-channel setting value. The value may apply to all channels, or be a dict mapping channel name
+    prefixes to values; the longest matching prefix wins."""
+    if not isinstance(value, dict):
+        return value if value is not None else default
+
+    best = None
+    for prefix in value:
+        if channel.startswith(prefix) and (best is None or len(prefix) > len(best)):
+            best = prefix
+    return value[best] if best is not None else default
+
+def get_event_retention(channel):
+    """Return the maximum number of events retained for replay on the given channel, or 0 if retention is
+    disabled. RT_EVENT_RETENTION may be an integer applying to all channels, or a dict mapping channel name prefixes
+    to integers."""
+    return get_channel_setting(settings.RT_EVENT_RETENTION, channel, 0) or 0
+
+CONFLATE_CHANNEL = 'channel'
+CONFLATE_EVENT_TYPE = 'event_type'
+
+def get_conflation(channel, view_class=None):
+    """Return the conflation mode and maximum flush rate (per second) for a channel, as a tuple. The mode is None if
+    the channel is not conflated, CONFLATE_CHANNEL to keep only the newest event on the channel, or
+    CONFLATE_EVENT_TYPE to keep the newest event of each event type.
+
+    The rt_conflate and rt_conflate_rate attributes of the resource's view class take precedence over the
+    RT_CONFLATE and RT_CONFLATE_MAX_RATE settings, which may also be dicts mapping channel name prefixes to values."""
+    mode = getattr(view_class, 'rt_conflate', None) or get_channel_setting(settings.RT_CONFLATE, channel)
+    if not mode:
+        return None, None
+    if mode not in (CONFLATE_CHANNEL, CONFLATE_EVENT_TYPE):
+        raise ImproperlyConfigured('Unknown conflation mode "%s" for channel %s' % (mode, channel))
+
+    max_rate = getattr(view_class, 'rt_conflate_rate', None) or get_channel_setting(settings.RT_CONFLATE_MAX_RATE, channel)
+    return mode, max_rate
+
+def parse_event_id(id):
+    """Parse a Redis stream ID (as used for SSE event IDs) into a comparable tuple. Returns None if invalid."""
+    try:
+        ms, seq = id.split('-')
+        return (int(ms), int(seq))
+    except (AttributeError, ValueError):
+        return None
+
+def split_published_message(message):
+    """Split a message (str or bytes) received from a Redis channel into its event ID (None if the channel does not
+    retain events) and the serialized ResourceEvent, which is JSON or a binary envelope."""
+    if message[:1].isdigit():
+        if isinstance(message, bytes):
+            id, _, body = message.partition(b' ')
+            return id.decode('ascii'), body
+        else:
+            id, _, body = message.partition(' ')
+            return id, body
+    else:
+        return None, message
+
 def get_http_status_reason(status):
     if status in REASON_PHRASES:
         return REASON_PHRASES[status]
     else:
         return ''
 
-def verify_resource_view(route):
-    """Resolve the specified route with Django and verify that the view class is actually a Django-RT resource.
-    Will throw either a ResourceError or NotAnRtResource exception on failure."""
+# LRU cache of verify_resource_view() results; maps (URL resolver, route) to (view_class, status, expiry time).
+# django.urls.clear_url_caches() makes get_resolver() return a new resolver, so entries cached for the old one are
+# never hit again and age out of the cache.
+_resource_view_cache = OrderedDict()
+
+def clear_resource_view_cache():
+    """Forget all cached verify_resource_view() results."""
+    _resource_view_cache.clear()
+
+@receiver(setting_changed)
+def _clear_resource_view_cache(setting, **kwargs):
+    if setting in ('ROOT_URLCONF', 'RT_RESOLVE_CACHE_SIZE'):
+        clear_resource_view_cache()
+
+def _verify_resource_view(route):
     from django_rt.resource import ResourceError, NotAnRtResourceError
 
     # Resolve
@@ -98,12 +255,60 @@ def verify_resource_view(route):
     except AttributeError:
         raise NotAnRtResourceError()
 
+    return view_class
+
+def verify_resource_view(route):
+    """Resolve the specified route with Django and verify that the view class is actually a Django-RT resource.
+    Returns the view class, or throws either a ResourceError or NotAnRtResource exception on failure.
+
+    Results are kept in an LRU cache of RT_RESOLVE_CACHE_SIZE routes; failures are only cached for
+    RT_RESOLVE_NEGATIVE_TTL seconds."""
+    from django_rt.resource import ResourceError, NotAnRtResourceError
+
+    max_size = settings.RT_RESOLVE_CACHE_SIZE
+    if not max_size:
+        return _verify_resource_view(route)
+
+    key = (get_resolver(get_urlconf()), route)
+    entry = _resource_view_cache.get(key)
+    if entry:
+        view_class, status, expires = entry
+        if expires is None or expires > time.monotonic():
+            _resource_view_cache.move_to_end(key)
+            if status == 406:
+                raise NotAnRtResourceError()
+            elif status:
+                raise ResourceError(status)
+            return view_class
+
+    def store(view_class, status, expires):
+        _resource_view_cache[key] = (view_class, status, expires)
+        _resource_view_cache.move_to_end(key)
+        while len(_resource_view_cache) > max_size:
+            _resource_view_cache.popitem(last=False)
+
+    try:
+        view_class = _verify_resource_view(route)
+    except NotAnRtResourceError:
+        store(None, 406, time.monotonic() + settings.RT_RESOLVE_NEGATIVE_TTL)
+        raise
+    except ResourceError as e:
+        store(None, e.status, time.monotonic() + settings.RT_RESOLVE_NEGATIVE_TTL)
+        raise
+
+    store(view_class, None, None)
+    return view_class
+
 def generate_subscription_id():
     return uuid.uuid4().hex
 
 def get_subscription_key(id):
     return ':'.join((settings.RT_PREFIX, 'subscription', id))
 
+def get_mux_control_channel(stream_id):
+    """Return the Redis channel carrying subscription changes for a multiplexed stream."""
+    return ':'.join((settings.RT_PREFIX, 'mux', stream_id))
+
 def get_django_url(url):
     """Attempt to parse the Django server URL. If url is None, use the URL from the RT_DJANGO_URL setting instead.
     Returns parsed URL.
@@ -137,3 +342,21 @@ def get_django_url(url):
         raise ValueError('Unsupported Django server URL scheme "%s"' % (p.scheme,))
 
     return p
+
+def create_listen_socket(addr=None, port=None, unix_socket=None, reuse_port=False, backlog=1024):
+    """Create a listening socket for a courier server, on either a TCP address and port or a Unix domain socket.
+    If reuse_port is True, SO_REUSEPORT is set so several processes can each bind their own socket to the same
+    port, and the kernel balances incoming connections between them."""
+    if unix_socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(unix_socket)
+    else:
+        sock = socket.socket(socket.AF_INET6 if ':' in addr else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((addr, port))
+
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
@@ -1,15 +1,21 @@
-import redis
+from django.core.signing import SignatureExpired
 from django.views.generic import View
 from django.http import JsonResponse, HttpResponseForbidden, HttpResponseBadRequest
 from django.utils.crypto import get_random_string
 
-from django_rt.utils import get_subscription_key
+from django_rt.brokers import get_broker
 from django_rt.resource import Resource, ResourceRequest
 from django_rt.settings import settings
 
 class RtResourceView(View):
     _rt_is_resource = True
 
+    # Conflation of this resource's channel by couriers: None, 'channel' or 'event_type'. Overrides RT_CONFLATE.
+    rt_conflate = None
+
+    # Maximum rate at which conflated events are flushed, per second. Overrides RT_CONFLATE_MAX_RATE.
+    rt_conflate_rate = None
+
     def rt_get_permission(self, action, request):
         raise NotImplementedError('Classes deriving from RtResourceView must implement rt_get_permission()')
 
@@ -40,17 +46,22 @@ class RtResourceView(View):
         res_req.path = self.rt_get_path(request)
         res_req.verify_signature()
 
-        # Open Redis connection
-        redis_conn = redis.StrictRedis(
-            host=settings.RT_REDIS_HOST,
-            port=settings.RT_REDIS_PORT,
-            db=settings.RT_REDIS_DB,
-            password=settings.RT_REDIS_PASSWORD
-        )
+        if settings.RT_SIGNED_HANDSHAKE:
+            # Stateless handshake: the signed, timestamped request is all that's needed; no broker subscription status
+            try:
+                res_req.verify_timestamp(settings.RT_SIGNED_HANDSHAKE_MAX_AGE)
+            except SignatureExpired:
+                return HttpResponseBadRequest('Expired resource request')
+
+            if res_req.action == 'subscribe':
+                return self.rt_subscribe(request)
+            else:
+                # Shouldn't ever land here
+                assert False
 
         # Get subscription status
-        sub_key = get_subscription_key(res_req.sub_id)
-        sub_status = redis_conn.get(sub_key).decode('utf-8')
+        broker = get_broker()
+        sub_status = broker.get_subscription_status(res_req.sub_id)
         if not sub_status:
             return HttpResponseBadRequest('Invalid subscription ID')
 
@@ -61,23 +72,30 @@ class RtResourceView(View):
             if sub_status != 'requested':
                 return HttpResponseBadRequest('Invalid subscription ID')
 
-            # Check subscription is allowed
-            if self.rt_get_permission('subscribe', request) is not True:
-                return HttpResponseForbidden()
-
-            # Set subscription status to 'granted'
-            result = redis_conn.set(sub_key, 'granted')
-            assert result
+            response = self.rt_subscribe(request)
+            if response.status_code == 200:
+                # Set subscription status to 'granted'
+                result = broker.set_subscription_status(res_req.sub_id, 'granted')
+                assert result
 
-            # Return Resource object
-            res = self.rt_get_resource(request)
-            return JsonResponse(res.serialize(),
-                content_type=Resource.CONTENT_TYPE+'; charset=utf-8'
-            )
+            return response
         else:
             # Shouldn't ever land here
             assert False
 
+    def rt_subscribe(self, request):
+        """Handle a subscription request, once the ResourceRequest has been validated."""
+
+        # Check subscription is allowed
+        if self.rt_get_permission('subscribe', request) is not True:
+            return HttpResponseForbidden()
+
+        # Return Resource object
+        res = self.rt_get_resource(request)
+        return JsonResponse(res.serialize(),
+            content_type=Resource.CONTENT_TYPE+'; charset=utf-8'
+        )
+
     def rt_dispatch(self, request):
         # Catch resource requests
         if request.method.lower() == 'post':
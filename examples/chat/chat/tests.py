@@ -1,3 +1,442 @@
-from django.test import TestCase
+import queue
+import time
+import unittest
+import uuid
 
-# Create your tests here.
+import redis
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signing import BadSignature, SignatureExpired
+from django.db import transaction
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+
+from django_rt.brokers import get_broker
+from django_rt.couriers.common import (REPLAY_RESET_EVENT_TYPE, ChannelEvent, ClientConnection, HeartbeatWheel,
+    SendQueueMixin, get_missed_events)
+from django_rt.publish import publish
+from django_rt.resource import Resource, ResourceRequest
+from django_rt.settings import settings
+from django_rt.utils import get_full_channel_name
+
+def redis_available():
+    try:
+        return redis.StrictRedis(host=settings.RT_REDIS_HOST, port=settings.RT_REDIS_PORT,
+            socket_connect_timeout=0.5).ping()
+    except redis.RedisError:
+        return False
+
+@override_settings(RT_BROKER='memory', RT_PUBLISH_DEFERRED=True)
+class DeferredPublishTests(TransactionTestCase):
+    channel = 'deferred_test'
+
+    def setUp(self):
+        self.subscriber = get_broker().subscriber()
+        self.subscriber.subscribe(get_full_channel_name(self.channel))
+
+    def tearDown(self):
+        self.subscriber.close()
+
+    def received(self):
+        texts = []
+        while True:
+            message = self.subscriber.get_message(timeout=0.01)
+            if message is None:
+                return texts
+            texts.append(message[1].decode('utf-8'))
+
+    def assertReceived(self, *data):
+        texts = self.received()
+        self.assertEqual(len(texts), len(data))
+        for text, value in zip(texts, data):
+            self.assertIn('"%s"' % (value,), text)
+
+    def test_nested_atomic_keeps_order(self):
+        with transaction.atomic():
+            publish(self.channel, data='A')
+            with transaction.atomic():
+                publish(self.channel, data='B')
+            publish(self.channel, data='C')
+            self.assertReceived()
+        self.assertReceived('A', 'B', 'C')
+
+    def test_savepoint_rollback_drops_its_events(self):
+        with transaction.atomic():
+            publish(self.channel, data='A')
+            try:
+                with transaction.atomic():
+                    publish(self.channel, data='B')
+                    with transaction.atomic():
+                        publish(self.channel, data='C')
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+            publish(self.channel, data='D')
+        self.assertReceived('A', 'D')
+
+    def test_savepoint_rollback_before_commit(self):
+        with transaction.atomic():
+            publish(self.channel, data='A')
+            try:
+                with transaction.atomic():
+                    publish(self.channel, data='B')
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        self.assertReceived('A')
+
+    def test_first_event_in_rolled_back_savepoint(self):
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    publish(self.channel, data='A')
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+            publish(self.channel, data='B')
+        self.assertReceived('B')
+
+    def test_outer_rollback_drops_all_events(self):
+        try:
+            with transaction.atomic():
+                publish(self.channel, data='A')
+                with transaction.atomic():
+                    publish(self.channel, data='B')
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.assertReceived()
+
+        with transaction.atomic():
+            publish(self.channel, data='C')
+        self.assertReceived('C')
+
+class BrokerContractTests:
+    """Behaviour every broker must provide. Mixed into a TestCase per broker."""
+
+    def setUp(self):
+        # Streams outlive the test with Redis, so every test gets fresh channels
+        self.channel = 'contract_%s' % (uuid.uuid4().hex,)
+        self.broker = get_broker()
+        self.subscriber = self.broker.subscriber()
+
+    def tearDown(self):
+        self.subscriber.close()
+
+    def next_message(self):
+        deadline = time.time() + 2
+        while time.time() < deadline:
+            message = self.subscriber.get_message(timeout=0.1)
+            if message is not None:
+                return message
+        self.fail('No message received')
+
+    def assertNoMessage(self):
+        self.assertIsNone(self.subscriber.get_message(timeout=0.1))
+
+    def test_publish_subscribe(self):
+        full_name = get_full_channel_name(self.channel)
+        self.subscriber.subscribe(full_name)
+        self.assertEqual(self.broker.publish(full_name, 'hello'), 1)
+        channel, message = self.next_message()
+        self.assertEqual(message, b'hello')
+
+        self.subscriber.unsubscribe(full_name)
+        self.broker.publish(full_name, 'bye')
+        self.assertNoMessage()
+
+    @override_settings(RT_EVENT_RETENTION=10)
+    def test_publish_event_prefixes_retained_id(self):
+        self.subscriber.subscribe(get_full_channel_name(self.channel))
+        self.broker.publish_event(self.channel, '{"data": 1}')
+        channel, message = self.next_message()
+        id, _, body = message.partition(b' ')
+        self.assertEqual(body, b'{"data": 1}')
+
+        events, found = self.broker.get_events_after(self.channel, id.decode('ascii'), 10)
+        self.assertEqual(events, [])
+        self.assertTrue(found)
+
+    @override_settings(RT_EVENT_RETENTION=10)
+    def test_get_events_after(self):
+        ids = []
+        for i in range(5):
+            self.broker.publish_event(self.channel, '{"data": %d}' % (i,))
+            ids.append(self.broker.get_events_after(self.channel, '0-0', 10)[0][-1][0])
+
+        events, found = self.broker.get_events_after(self.channel, ids[1], 2)
+        self.assertTrue(found)
+        self.assertEqual([id for id, message in events], ids[2:4])
+        self.assertEqual(events[0][1], b'{"data": 2}')
+
+    @override_settings(RT_EVENT_RETENTION=10)
+    def test_get_events_after_unretained_id(self):
+        self.broker.publish_event(self.channel, '{"data": 1}')
+        events, found = self.broker.get_events_after(self.channel, '1-0', 10)
+        self.assertFalse(found)
+        self.assertEqual(len(events), 1)
+
+    def test_get_events_after_missing_stream(self):
+        self.assertEqual(self.broker.get_events_after(self.channel, '1-0', 10), ([], False))
+
+    def test_subscription_status(self):
+        sub_id = uuid.uuid4().hex
+        self.assertTrue(self.broker.create_subscription(sub_id))
+        self.assertFalse(self.broker.create_subscription(sub_id))
+        self.assertEqual(self.broker.get_subscription_status(sub_id), 'requested')
+        self.assertTrue(self.broker.set_subscription_status(sub_id, 'granted'))
+        self.assertEqual(self.broker.get_subscription_status(sub_id), 'granted')
+        self.assertTrue(self.broker.delete_subscription(sub_id))
+        self.assertFalse(self.broker.delete_subscription(sub_id))
+        self.assertIsNone(self.broker.get_subscription_status(sub_id))
+
+@override_settings(RT_BROKER='memory')
+class MemoryBrokerTests(BrokerContractTests, SimpleTestCase):
+    @override_settings(RT_EVENT_RETENTION=3)
+    def test_trimmed_stream(self):
+        for i in range(5):
+            self.broker.publish_event(self.channel, '{"data": %d}' % (i,))
+        events, found = self.broker.get_events_after(self.channel, '0-0', 10)
+        self.assertFalse(found)
+        self.assertEqual([message for id, message in events], [b'{"data": 2}', b'{"data": 3}', b'{"data": 4}'])
+
+@unittest.skipUnless(redis_available(), 'Redis server not available')
+@override_settings(RT_BROKER='redis')
+class RedisBrokerTests(BrokerContractTests, SimpleTestCase):
+    pass
+
+@override_settings(RT_BROKER='memory', RT_REPLAY_MAX_EVENTS=3)
+class MissedEventsTests(SimpleTestCase):
+    def setUp(self):
+        self.channel = 'replay_%s' % (uuid.uuid4().hex,)
+        self.broker = get_broker()
+
+    def publish(self, count):
+        for i in range(count):
+            self.broker.publish_event(self.channel, '{"data": %d}' % (i,))
+        return [id for id, message in self.broker.get_events_after(self.channel, '0-0', 100)[0]]
+
+    def assertReset(self, events, id):
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].id, id)
+        self.assertIn(('event: %s' % (REPLAY_RESET_EVENT_TYPE,)).encode('ascii'), events[0].frame)
+
+    @override_settings(RT_EVENT_RETENTION=10)
+    def test_replays_missed_events(self):
+        ids = self.publish(4)
+        events = get_missed_events(self.broker, self.channel, ids[1])
+        self.assertEqual([event.id for event in events], ids[2:])
+        self.assertIn(b'"data": 2', events[0].frame)
+
+    @override_settings(RT_EVENT_RETENTION=10)
+    def test_nothing_missed(self):
+        ids = self.publish(2)
+        self.assertEqual(get_missed_events(self.broker, self.channel, ids[-1]), [])
+
+    @override_settings(RT_EVENT_RETENTION=10)
+    def test_too_many_missed_events(self):
+        ids = self.publish(6)
+        self.assertReset(get_missed_events(self.broker, self.channel, ids[0]), ids[4])
+
+    @override_settings(RT_EVENT_RETENTION=2)
+    def test_trimmed_stream(self):
+        ids = self.publish(2)
+        self.publish(2)
+        later_ids = self.broker.get_events_after(self.channel, '0-0', 100)[0]
+        self.assertReset(get_missed_events(self.broker, self.channel, ids[0]), later_ids[-1][0])
+
+    def test_empty_stream(self):
+        self.assertReset(get_missed_events(self.broker, self.channel, '1-0'), None)
+
+class TestQueue(SendQueueMixin, queue.Queue):
+    def get(self, *args, **kwargs):
+        item = super().get(*args, **kwargs)
+        self._taken(item)
+        return item
+
+    def items(self):
+        items = []
+        while self.qsize():
+            items.append(self.get_nowait())
+        return items
+
+def event(n, key=None):
+    return ChannelEvent('%d-0' % (n,), ('data: %d\n\n' % (n,)).encode('ascii'), key)
+
+@override_settings(RT_SEND_QUEUE_MAX_EVENTS=3, RT_SEND_QUEUE_MAX_BYTES=None)
+class SendQueueTests(SimpleTestCase):
+    @override_settings(RT_SEND_QUEUE_POLICY='drop_oldest')
+    def test_drop_oldest(self):
+        q = TestQueue()
+        events = [event(i) for i in range(5)]
+        for e in events:
+            self.assertTrue(q.offer(e))
+        self.assertEqual(q.dropped, 2)
+        self.assertEqual(q.items(), events[2:])
+        self.assertEqual(q.buffered_bytes, 0)
+
+    @override_settings(RT_SEND_QUEUE_POLICY='drop_oldest')
+    def test_drop_oldest_keeps_control_events(self):
+        q = TestQueue()
+        control = ChannelEvent.control('courier', '{}')
+        q.offer(event(0))
+        q.offer(control)
+        q.offer(event(1))
+        q.offer(event(2))
+        items = q.items()
+        self.assertIn(control, items)
+        self.assertEqual(len(items), 3)
+        self.assertEqual(q.dropped, 1)
+
+    @override_settings(RT_SEND_QUEUE_POLICY='drop_newest')
+    def test_drop_newest(self):
+        q = TestQueue()
+        events = [event(i) for i in range(5)]
+        results = [q.offer(e) for e in events]
+        self.assertEqual(results, [True, True, True, False, False])
+        self.assertEqual(q.dropped, 2)
+        self.assertEqual(q.items(), events[:3])
+
+    @override_settings(RT_SEND_QUEUE_POLICY='disconnect')
+    def test_disconnect(self):
+        q = TestQueue()
+        for i in range(3):
+            q.offer(event(i))
+        self.assertFalse(q.offer(event(3)))
+        self.assertTrue(q.overflowed)
+        self.assertEqual(q.items(), [None])
+        self.assertFalse(q.offer(event(4)))
+
+    @override_settings(RT_SEND_QUEUE_MAX_EVENTS=None, RT_SEND_QUEUE_MAX_BYTES=20, RT_SEND_QUEUE_POLICY='drop_oldest')
+    def test_max_bytes(self):
+        q = TestQueue()
+        events = [event(i) for i in range(4)]
+        for e in events:
+            q.offer(e)
+        self.assertLessEqual(q.buffered_bytes, 20)
+        self.assertEqual(q.items()[-1], events[-1])
+
+    @override_settings(RT_SEND_QUEUE_POLICY='drop_oldest')
+    def test_conflated_events_are_stale(self):
+        q = TestQueue()
+        first, second = event(0, key=('c',)), event(1, key=('c',))
+        q.offer(first)
+        q.offer(second)
+        self.assertTrue(q.is_stale(first))
+        self.assertFalse(q.is_stale(second))
+        q.items()
+        self.assertFalse(q.is_stale(second))
+
+    @override_settings(RT_SEND_QUEUE_POLICY='bogus')
+    def test_unknown_policy(self):
+        with self.assertRaises(ImproperlyConfigured):
+            TestQueue()
+
+class HeartbeatWheelTests(SimpleTestCase):
+    def setUp(self):
+        self.sent = []
+        self.wheel = HeartbeatWheel(10, 1, self.sent.append)
+
+    def connection(self, last_write):
+        conn = ClientConnection(None)
+        conn.last_write = last_write
+        self.wheel.add(conn)
+        return conn
+
+    def test_idle_connection_gets_heartbeat(self):
+        now = time.monotonic()
+        conn = self.connection(now)
+        self.assertEqual(self.wheel.tick(now + 5), 0)
+        self.assertEqual(self.wheel.tick(now + 11), 1)
+        self.assertEqual(self.sent, [conn])
+        self.assertEqual(conn.last_write, now + 11)
+
+        # Rescheduled for the next interval
+        self.assertEqual(self.wheel.tick(now + 16), 0)
+        self.assertEqual(self.wheel.tick(now + 22), 1)
+        self.assertEqual(len(self.wheel), 1)
+
+    def test_active_connection_is_rescheduled(self):
+        now = time.monotonic()
+        conn = self.connection(now)
+        conn.last_write = now + 8
+        self.assertEqual(self.wheel.tick(now + 11), 0)
+        self.assertEqual(self.wheel.tick(now + 19.5), 1)
+        self.assertEqual(self.sent, [conn])
+
+    def test_removed_connection(self):
+        now = time.monotonic()
+        conn = self.connection(now)
+        self.wheel.remove(conn)
+        self.assertEqual(len(self.wheel), 0)
+        self.assertEqual(self.wheel.tick(now + 11), 0)
+
+    def test_stall(self):
+        now = time.monotonic()
+        conns = [self.connection(now) for i in range(3)]
+        self.assertEqual(self.wheel.tick(now + 1000), 3)
+        self.assertEqual(set(self.sent), set(conns))
+
+    def test_failing_heartbeat_drops_connection(self):
+        def send_heartbeat(conn):
+            raise IOError
+        self.wheel = HeartbeatWheel(10, 1, send_heartbeat)
+        now = time.monotonic()
+        self.connection(now)
+        self.assertEqual(self.wheel.tick(now + 11), 0)
+        self.assertEqual(len(self.wheel), 0)
+
+class ResourceRequestTests(SimpleTestCase):
+    def signed(self, **kwargs):
+        req = ResourceRequest(path='/chat/', action='subscribe', sub_id='abc', **kwargs)
+        data = req.serialize()
+        received = ResourceRequest.deserialize(data)
+        received.path = '/chat/'
+        return received
+
+    def test_signature(self):
+        req = self.signed()
+        req.verify_signature()
+        req.verify_timestamp(60)
+
+    def test_tampered_timestamp(self):
+        req = self.signed(timestamp=int(time.time()) - 3600)
+        req.timestamp = int(time.time())
+        with self.assertRaises(BadSignature):
+            req.verify_signature()
+
+    def test_tampered_path(self):
+        req = self.signed()
+        req.path = '/other/'
+        with self.assertRaises(BadSignature):
+            req.verify_signature()
+
+    def test_expired_timestamp(self):
+        req = self.signed(timestamp=int(time.time()) - 3600)
+        req.verify_signature()
+        with self.assertRaises(SignatureExpired):
+            req.verify_timestamp(60)
+
+    def test_future_timestamp(self):
+        req = self.signed(timestamp=int(time.time()) + 3600)
+        with self.assertRaises(SignatureExpired):
+            req.verify_timestamp(60)
+
+class ResumeTokenTests(SimpleTestCase):
+    def test_round_trip(self):
+        token = Resource('/chat/', 'chat').get_resume_token()
+        res = Resource.from_resume_token(token, '/chat/', 60)
+        self.assertEqual((res.path, res.channel), ('/chat/', 'chat'))
+
+    def test_other_path(self):
+        token = Resource('/chat/', 'chat').get_resume_token()
+        with self.assertRaises(BadSignature):
+            Resource.from_resume_token(token, '/other/', 60)
+
+    def test_tampered_token(self):
+        token = Resource('/chat/', 'chat').get_resume_token()
+        with self.assertRaises(BadSignature):
+            Resource.from_resume_token(token[:-1] + ('A' if token[-1] != 'A' else 'B'), '/chat/', 60)
+
+    def test_expired_token(self):
+        token = Resource('/chat/', 'chat').get_resume_token()
+        with self.assertRaises(SignatureExpired):
+            Resource.from_resume_token(token, '/chat/', -1)
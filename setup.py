@@ -12,10 +12,10 @@ setup(
     license='BSD',
     zip_safe=False,
 
-    packages=['django_rt', 'django_rt.couriers'],
+    packages=['django_rt', 'django_rt.bench', 'django_rt.brokers', 'django_rt.couriers'],
     install_requires=[
         'Django>=1.7',
-        'redis>=2.10',
+        'redis>=3.0',
     ],
 
     extras_require={
@@ -27,6 +27,15 @@ setup(
             'gevent>=1.1rc1',
             'urllib3>=1.12',
         ],
+        'orjson': [
+            'orjson>=3.0',
+        ],
+        'ujson': [
+            'ujson>=5.4',
+        ],
+        'msgpack': [
+            'msgpack>=0.5.2',
+        ],
     },
     scripts=['django_rt/bin/djangort-courier.py'],
     entry_points={